@@ -1,3 +1,4 @@
+#include <algorithm>
 #include <cassert>
 #include <cmath>
 #include <cstdio>
@@ -6,6 +7,8 @@
 
 using namespace std;
 
+const double Cuboid::BoundaryTolerance = 1e-10;
+
 
 void Cuboid::Initialize() {
     /* Assume that e1, e2, e3 are orthogonal (weird results if they aren't) */
@@ -169,21 +172,38 @@ vec3d Cuboid::Transform(const vec3d& x) const {
 }
 
 void Cuboid::Transform(double x1, double x2, double x3, double& r1, double& r2, double& r3) const {
+    const Cell* cell = NULL;
     for(vector<Cell>::const_iterator iter = cells.begin(); iter != cells.end(); iter++) {
-        const Cell& c = *iter;
-        if(c.contains(x1, x2, x3)) {
-            x1 += c.ix;
-            x2 += c.iy;
-            x3 += c.iz;
-            vec3d p = vec3d(x1, x2, x3);
-            r1 = dot(p, n1);
-            r2 = dot(p, n2);
-            r3 = dot(p, n3);
+        if(iter->contains(x1, x2, x3)) {
+            cell = &*iter;
+            break;
+        }
+    }
+
+    /* Points on a cell face may fail the plane tests of every cell through
+     * rounding; use the cell they are closest to */
+    if(cell == NULL) {
+        double best = -HUGE_VAL;
+        for(vector<Cell>::const_iterator iter = cells.begin(); iter != cells.end(); iter++) {
+            double m = iter->margin(x1, x2, x3);
+            if(m > best) {
+                best = m;
+                cell = &*iter;
+            }
+        }
+        if(best < -BoundaryTolerance) {
+            fprintf(stderr, "!! point (%g,%g,%g) not contained by any cell\n", x1, x2, x3);
             return;
         }
     }
 
-    fprintf(stderr, "!! point (%g,%g,%g) not contained by any cell\n", x1, x2, x3);
+    x1 += cell->ix;
+    x2 += cell->iy;
+    x3 += cell->iz;
+    vec3d p = vec3d(x1, x2, x3);
+    r1 = dot(p, n1);
+    r2 = dot(p, n2);
+    r3 = dot(p, n3);
 }
 
 vec3d Cuboid::InverseTransform(const vec3d& r) const {
@@ -232,3 +252,10 @@ bool Cuboid::Cell::contains(double x, double y, double z) const {
         b = b && (face[i].test(x, y, z) >= 0);
     return b;
 }
+
+double Cuboid::Cell::margin(double x, double y, double z) const {
+    double m = HUGE_VAL;
+    for(int i = 0; i < nfaces; i++)
+        m = std::min(m, face[i].test(x, y, z));
+    return m;
+}
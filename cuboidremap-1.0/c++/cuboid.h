@@ -61,7 +61,9 @@ public:
 
 
     /* Transform the point x in the unit cube [0,1]^3 to local coordinates in
-     * the fiducial cuboid [0,L1]x[0,L2]x[0,L3] */
+     * the fiducial cuboid [0,L1]x[0,L2]x[0,L3].  A point on a cell face that
+     * fails the plane tests of every cell through rounding is placed in the
+     * cell it is closest to, if within BoundaryTolerance of it. */
     vec3d Transform(const vec3d& x) const;
     void Transform(double x1, double x2, double x3, double& r1, double& r2, double& r3) const;
 
@@ -75,6 +77,8 @@ public:
      * to machine precision. */
 
 
+    static const double BoundaryTolerance;
+
     vec3d e1, e2, e3;   // vectors along the 3 primary directions
     vec3d n1, n2, n3;   // normal vectors along these directions
     double L1, L2, L3;  // dimensions of the cuboid
@@ -92,6 +96,9 @@ public:
 
         bool contains(const vec3d& p) const;
         bool contains(double x, double y, double z) const;
+
+        /* Smallest of the face tests, negative if the point is outside */
+        double margin(double x, double y, double z) const;
     };
 
     std::vector<Cell> cells;
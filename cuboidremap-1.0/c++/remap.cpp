@@ -4,6 +4,7 @@
  *
  */
 
+#include <cmath>
 #include <cstdio>
 #include <cstdlib>
 #include <cstring>
@@ -11,9 +12,10 @@
 #include "cuboid.h"
 
 void usage() {
-    printf("Usage: remap in=\"in file\" out=\"out file\" u=\"u11 u12 u13 u21 u22 u23 u31 u32 u33\"\n");
+    printf("Usage: remap in=\"in file\" out=\"out file\" u=\"u11 u12 u13 u21 u22 u23 u31 u32 u33\" [precision=N]\n");
     printf("If not given, 'in' defaults to stdin, 'out' defaults to stdout, and 'u' defaults\n");
-    printf("to the identity matrix.\n");
+    printf("to the identity matrix.  Coordinates are written with N significant digits\n");
+    printf("(default 6).\n");
     exit(0);
 }
 
@@ -21,6 +23,7 @@ int main(int argc, char* argv[]) {
     const char* infile = NULL;
     const char* outfile = NULL;
     int u[9] = { 1, 0, 0,   0, 1, 0,   0, 0, 1 };
+    int precision = 6;
 
     /* Parse command line arguments */
     if(argc == 1)
@@ -34,6 +37,8 @@ int main(int argc, char* argv[]) {
             infile = pos;
         else if(strcmp(argv[i], "out") == 0)
             outfile = pos;
+        else if(strcmp(argv[i], "precision") == 0)
+            precision = atoi(pos);
         else if(strcmp(argv[i], "u") == 0) {
             char* tok = strtok(pos, " ,");
             for(int k = 0; k < 9; k++) {
@@ -78,9 +83,11 @@ int main(int argc, char* argv[]) {
             warning = true;
         }
 
-        /* Remap point into cuboid, and print remapped coordinates */
+        /* Remap point into cuboid, and print remapped coordinates (nan for a
+         * point not contained by any cell) */
+        r1 = r2 = r3 = NAN;
         R.Transform(x1, x2, x3, r1, r2, r3);
-        fprintf(fout, "%g %g %g\n", r1, r2, r3);
+        fprintf(fout, "%.*g %.*g %.*g\n", precision, r1, precision, r2, precision, r3);
     }
 
     return 0;
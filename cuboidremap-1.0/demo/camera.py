@@ -3,20 +3,13 @@ from math import *
 from pyglet.gl import *
 from pyglet.window import key, mouse
 from vec3 import *
+from view import *
 
-class DemoCamera:
-    def __init__(self, width, height, center=(0,0,0), eye=(0,0,1), up=(0,1,0)):
-        self.width = width
-        self.height = height
-        self.z = 1.0
+class DemoCamera(View):
+    """Interactive camera, controlled with the mouse."""
 
-        if eye == center:
-            print >> sys.stderr, "?? eye and center position coincide"
-            eye = (center[0],center[1],center[2]+1)
-        self.center = vec3(center)
-        self.eye    = vec3(eye)
-        self.up     = vec3(up)
-        self._fixup()
+    def __init__(self, width, height, center=(0,0,0), eye=(0,0,1), up=(0,1,0)):
+        View.__init__(self, width, height, center, eye, up)
         self.mx = None
         self.my = None
         self.rotating_graphic = None
@@ -28,7 +21,7 @@ class DemoCamera:
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
         aspect = float(self.width)/float(self.height)
-        glOrtho(-self.z*aspect, self.z*aspect, -self.z, +self.z, 0.05, 100)
+        glOrtho(-self.z*aspect, self.z*aspect, -self.z, +self.z, self.near, self.far)
 
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
@@ -36,26 +29,6 @@ class DemoCamera:
                   self.center.x, self.center.y, self.center.z,
                   self.up.x,     self.up.y,     self.up.z)
 
-    def rotate(self, dphi, dtheta):
-        x,y,z,r = self._getbasis()
-        # First rotate horizontally (about y)
-        x, z = x*cos(dphi) + z*sin(dphi), -x*sin(dphi) + z*cos(dphi)
-        # Then rotate vertically (about x)
-        y, z = y*cos(dtheta) - z*sin(dtheta), y*sin(dtheta) + z*cos(dtheta)
-        # Then update parameters
-        self.up = y
-        self.eye = self.center + r*z
-
-    def translate(self, ax, ay):
-        x,y,z,r = self._getbasis()
-        self.center += ax*x + ay*y
-        self.eye += ax*x + ay*y
-
-    def zoom(self, dz):
-        self.z += dz*sqrt(self.z)
-        if self.z < 1e-2:
-            self.z = 1e-2
-
     def draw(self):
         """Draw a graphic to help orient the user if the camera is moving."""
         if self.rotating_graphic:
@@ -139,19 +112,3 @@ class DemoCamera:
 
     def on_mouse_scroll(self, mx, my, dx, dy):
         self.zoom(-0.1*dy)
-
-    def _getbasis(self):
-        r = length(self.eye - self.center)
-        z = vec3(self.eye - self.center)/r
-        y = self.up
-        x = cross(y,z)
-        return (x,y,z,r)
-
-    def _fixup(self):
-        """Adjust the up vector so that it's orthogonal to the view direction."""
-        n = unit(self.center - self.eye)
-        v = cross(n, self.up)
-        if v == vec3(0,0,0):
-            print >> sys.stderr, "?? up vector (%g,%g,%g) parallel to view vector (%g,%g,%g)" % (self.up.x,self.up.y,self.up.z,n.x,n.y,n.z)
-            v = find_basis(n)[0]
-        self.up = unit(cross(v, n))
@@ -0,0 +1,138 @@
+# cellcache.py
+#
+# Background computation and on-disk caching of the cell geometry displayed by
+# the demo.  Cutting the unit cube into the cells of a complicated remapping
+# takes a while, so it is done in a separate worker process and the
+# triangulated result is saved in a cache directory, keyed by the remapping
+# matrix.  Nothing here depends on pyglet.
+
+import os
+import sys
+import cPickle
+import multiprocessing
+import numpy as N
+from cuboid import *
+from poly import *
+
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+# Version of the cached geometry, stored in each cache file; increase it
+# whenever the clipper or the contents of the geometry change, so that files
+# written by older versions are recomputed
+cache_version = 2
+
+
+def triangulate(h):
+    """Return flat lists of vertex coordinates for the triangles (a fan over
+    each face) and for the edges of the polyhedron h."""
+    tris = [(f[0], f[k], f[k+1]) for f in h.faces for k in range(1, len(f) - 1)]
+    lines = [(f[k], f[(k+1) % len(f)]) for f in h.faces for k in range(len(f))]
+    return h.verts[N.array(tris, dtype=int)].ravel().tolist(), h.verts[N.array(lines, dtype=int)].ravel().tolist()
+
+def make_geometry(u):
+    """Compute the displayed geometry for the remapping u = (u1,u2,u3): a
+    dictionary with the cache version, the cell offsets (ix,iy,iz), and the
+    triangle and edge coordinates of each cell."""
+    u1, u2, u3 = u
+    C = Cuboid(u1=u1, u2=u2, u3=u3)
+    geometry = {'version': cache_version, 'u': u, 'L': (C.L1, C.L2, C.L3), 'offsets': [], 'tris': [], 'lines': []}
+    for c, h in zip(C.cells, cut_unitcubes([c.faces for c in C.cells])):
+        tris, lines = triangulate(h)
+        geometry['offsets'].append((c.ix, c.iy, c.iz))
+        geometry['tris'].append(tris)
+        geometry['lines'].append(lines)
+    return geometry
+
+def remap_key(u):
+    """A name for the remapping u, for use in file names."""
+    return "remap_" + "_".join(["%d" % x for v in u for x in v])
+
+def cache_path(u):
+    return os.path.join(cache_dir, remap_key(u) + ".pkl")
+
+def load_geometry(u):
+    """Compute the geometry for the remapping u, or load it from the disk
+    cache if it has been computed before by the same cache version."""
+    path = cache_path(u)
+    if os.path.exists(path):
+        try:
+            geometry = cPickle.load(open(path, "rb"))
+        except Exception:
+            print >> sys.stderr, "?? Ignoring unreadable cache file '%s'" % path
+        else:
+            if isinstance(geometry, dict) and geometry.get('version') == cache_version:
+                return geometry
+            print >> sys.stderr, "?? Ignoring cache file '%s' from another version" % path
+    geometry = make_geometry(u)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file first, so that readers never see a partial file
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        f = open(tmp, "wb")
+        cPickle.dump(geometry, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, path)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "?? Could not write cache file '%s': %s" % (path, e)
+    return geometry
+
+def read_remap_list(path):
+    """Read the matrices from a list of remappings written by genremap."""
+    remaps = []
+    for line in open(path):
+        words = line.split()
+        if len(words) < 12 or line.startswith('#'):
+            continue
+        u = [int(w) for w in words[3:12]]
+        remaps.append((tuple(u[0:3]), tuple(u[3:6]), tuple(u[6:9])))
+    return remaps
+
+
+class CellCache:
+    """Geometry for remappings, computed by background worker processes.
+
+    request(u) queues the remapping u (a tuple (u1,u2,u3)) for computation,
+    and get(u) returns its geometry if it is ready, or None otherwise.
+    Requests made with background=True (e.g. warming up the cache) go to a
+    second worker, so that they never hold up the remapping being waited
+    for.  Results are kept in memory once loaded, and on disk across runs."""
+
+    def __init__(self):
+        self.pool = multiprocessing.Pool(1)
+        self.background = multiprocessing.Pool(1)
+        self.ready = {}
+        self.pending = {}
+        self.waiting = set()
+
+    def request(self, u, background=False):
+        u = tuple([tuple(v) for v in u])
+        if u in self.ready:
+            return u
+        if not background and u not in self.waiting:
+            # Queue it ahead of any background work, even if the background
+            # worker already has it; whichever result comes first is used
+            self.pending.setdefault(u, []).append(self.pool.apply_async(load_geometry, (u,)))
+            self.waiting.add(u)
+        elif u not in self.pending:
+            self.pending[u] = [self.background.apply_async(load_geometry, (u,))]
+        return u
+
+    def get(self, u):
+        u = tuple([tuple(v) for v in u])
+        for result in [r for r in self.pending.get(u, []) if r.ready()]:
+            try:
+                self.ready[u] = result.get()
+                break
+            except Exception, e:
+                print >> sys.stderr, "!! Could not compute the geometry for u = %s: %s" % (u, e)
+                self.pending[u].remove(result)
+        if u in self.ready or self.pending.get(u) == []:
+            # Done, or failed everywhere (a later request tries again)
+            self.pending.pop(u, None)
+            self.waiting.discard(u)
+        return self.ready.get(u)
+
+    def close(self):
+        self.pool.terminate()
+        self.background.terminate()
@@ -2,65 +2,84 @@
 #
 # demo.py
 
+import os
 import sys
-import copy
 import random
+from ctypes import byref
 from math import *
 import pyglet
 from pyglet.gl import *
+
+# The clipper used by poly.py (clip.py) is shared with the Python remap library
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
 from camera import *
+from view import colors
 from cuboid import *
 from poly import *
+from cellcache import *
 
-colors = [
-          (1,0,0),
-          (0,1,0),
-          (0,0,1),
-          (1,1,0),
-          (1,0,1),
-          (0,1,1),
-          (1,0.5,0),
-          (1,0,0.5),
-          (0.5,0,1),
-          (0.5,1,0),
-          (0,1,0.5),
-          (0,0.5,1),
-          (0.5,0.5,0),
-          (0.5,0,0.5),
-          (0,0.5,0.5),
-          (0.5,0.5,0.5)
-]*8
-
-def draw_polygon(g, color=(1,0,0), outline=True):
-    # Fill in polygon at 50% opacity
-    glColor4f(color[0], color[1], color[2], 0.7)
-#    glDepthMask(GL_FALSE)
-    glBegin(GL_POLYGON)
-    for v in g.verts:
-        glVertex3f(v.x, v.y, v.z)
-    glEnd()
-#    glDepthMask(GL_TRUE)
-
-    # Outline polygon in bold
-    if outline:
-        glColor4f(color[0], color[1], color[2], 1)
-        glBegin(GL_LINE_LOOP)
-        for v in g.verts:
-            glVertex3d(v.x, v.y, v.z)
-        glEnd()
+class CellBuffer:
+    """All cell polyhedra of a remapping (as computed by make_geometry),
+    stored in a single vertex buffer.  The triangles and edges of polyhedron
+    i occupy the vertex ranges tris[i] and lines[i] (as (first,count) pairs),
+    so drawing a cell costs one call for its faces and one for its outline,
+    however many vertices it has."""
+
+    def __init__(self, geometry):
+        data = []
+        self.u = geometry['u']
+        self.offsets = geometry['offsets']
+        self.tris = []
+        self.lines = []
+        for tris, lines in zip(geometry['tris'], geometry['lines']):
+            self.tris.append((len(data)//3, len(tris)//3))
+            data.extend(tris)
+            self.lines.append((len(data)//3, len(lines)//3))
+            data.extend(lines)
+
+        # Edges of the unit cube, for the black frame
+        cube = triangulate(unitcube())[1]
+        self.frame = (len(data)//3, len(cube)//3)
+        data.extend(cube)
+
+        self.vbo = GLuint()
+        glGenBuffers(1, byref(self.vbo))
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, 4*len(data), (GLfloat * len(data))(*data), GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
 
-def draw_polyhedron(h, color=(1,0,0), outline=True):
-    for f in h.faces:
-        draw_polygon(f, color, outline)
+    def delete(self):
+        glDeleteBuffers(1, byref(self.vbo))
 
-def make_polyhedron_from_cell(c):
-    h = unitcube()
-    h.translate(vec3(0.5e-6, 2.3e-6, 1.7e-6))
-    for P in c.faces:
-        h.cut(P)
-    return h
+    def bind(self):
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 0, 0)
 
+    def unbind(self):
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
 
+    def draw_frame(self, dx):
+        glPushMatrix()
+        glTranslatef(dx.x, dx.y, dx.z)
+        glColor4f(0, 0, 0, 1)
+        glDrawArrays(GL_LINES, *self.frame)
+        glPopMatrix()
+
+    def draw_cell(self, i, dx, color):
+        glPushMatrix()
+        glTranslatef(dx[0], dx[1], dx[2])
+        glColor4f(color[0], color[1], color[2], 0.7)
+        glDrawArrays(GL_TRIANGLES, *self.tris[i])
+        glColor4f(color[0], color[1], color[2], 1)
+        glDrawArrays(GL_LINES, *self.lines[i])
+        glPopMatrix()
+
+
+# Cell geometry is computed by a background process, which is started before
+# the window is opened
+cache = CellCache()
 
 # Initialize window
 width = 800
@@ -76,10 +95,63 @@ glCullFace(GL_BACK)
 # Initialize camera
 camera = DemoCamera(width, height, center=(0.5,0.5,0.5), eye=(0,3,0.), up=(1,0,0))
 
-# Initialize cuboid
-C = Cuboid(u1=(3,2,1), u2=(-1,1,2), u3=(1,1,1))
-polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-print len(polyhedra)
+# Frame rate counter (pyglet 1.4 replaced ClockDisplay with FPSDisplay)
+if hasattr(pyglet.window, 'FPSDisplay'):
+    fps_display = pyglet.window.FPSDisplay(window)
+else:
+    fps_display = pyglet.clock.ClockDisplay()
+fps_on = True
+
+# Preset remappings for the number keys
+presets = {
+    pyglet.window.key._1: ((1,0,0), (0,1,0), (0,0,1)),
+    pyglet.window.key._2: ((1,1,0), (0,0,1), (1,0,0)),
+    pyglet.window.key._3: ((1,1,0), (1,0,1), (1,0,0)),
+    pyglet.window.key._4: ((1,1,1), (1,0,0), (0,1,0)),
+    pyglet.window.key._5: ((1,1,1), (1,-1,0), (1,0,0)),
+    pyglet.window.key._6: ((3,2,1), (-1,1,2), (1,1,1)),
+    pyglet.window.key._7: ((2,1,0), (1,0,1), (1,0,0)),
+    pyglet.window.key._8: ((7,6,4), (3,3,2), (0,1,1)),
+    pyglet.window.key._9: ((3,2,1), (-1,1,2), (1,1,1)),
+}
+
+# Remappings read from a list written by genremap, for the N and P keys
+remap_list = []
+remap_index = -1
+for arg in sys.argv[1:]:
+    pair = arg.split('=', 1)
+    if len(pair) == 2 and pair[0] == "list":
+        remap_list = read_remap_list(pair[1])
+    else:
+        print >> sys.stderr, "Usage: python demo.py [list=../genremap/list7.txt]"
+        sys.exit(1)
+
+# Cell geometry is swapped in when the background worker has it ready
+buffer = None
+wanted = None
+
+def set_remapping(u1, u2, u3):
+    global wanted
+    wanted = cache.request((u1, u2, u3))
+    check_remapping()
+
+def check_remapping(dt=0):
+    global buffer
+    if buffer is not None and buffer.u == wanted:
+        return
+    geometry = cache.get(wanted)
+    if geometry is not None:
+        if buffer is not None:
+            buffer.delete()
+        buffer = CellBuffer(geometry)
+        window.set_caption("u = %s, L = (%.4f, %.4f, %.4f), %d cells" % ((wanted,) + geometry['L'] + (len(geometry['offsets']),)))
+
+pyglet.clock.schedule_interval(check_remapping, 0.05)
+
+# Initialize cuboid, and warm up the cache for the presets
+set_remapping((3,2,1), (-1,1,2), (1,1,1))
+for u in presets.values():
+    cache.request(u, background=True)
 
 anim_on = False
 anim_t = 0.0
@@ -97,31 +169,33 @@ def on_draw():
     camera.apply()
     camera.draw()
 
-    def carray(data):
-        return (GLfloat * len(data))(*data)
-
-    # Draw black frame around unit cube
-    cube = unitcube()
-    n = unit(camera.eye - camera.center)
-    cube.translate(0.001*n)
-    glPushAttrib(GL_ENABLE_BIT | GL_POLYGON_BIT)
-    glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
-    glDisable(GL_CULL_FACE)
-    draw_polyhedron(cube, color=(0,0,0), outline=False)
-    glPopAttrib()
-
-    # Draw polyhedra
-    glEnable(GL_BLEND)
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-    i = 0
-    for h in polyhedra:
-        c = C.cells[i]
-        h = copy.deepcopy(h)
+    if buffer is not None:
+        buffer.bind()
+
+        # Draw black frame around unit cube
+        n = unit(camera.eye - camera.center)
+        buffer.draw_frame(0.001*n)
+
+        # Draw polyhedra, each translated by a fraction of its cell offset
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
         s = 0.5 * (1 - cos(anim_t))
-        h.translate(vec3(s*c.ix, s*c.iy, s*c.iz))
-        draw_polyhedron(h, colors[i])
-        i += 1
-    glDisable(GL_BLEND)
+        for i, (ix, iy, iz) in enumerate(buffer.offsets):
+            buffer.draw_cell(i, (s*ix, s*iy, s*iz), colors[i % len(colors)])
+        glDisable(GL_BLEND)
+
+        buffer.unbind()
+
+    # Draw frame rate in window coordinates
+    if fps_on:
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(0, width, 0, height, -1, 1)
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+        glDisable(GL_DEPTH_TEST)
+        fps_display.draw()
+        glEnable(GL_DEPTH_TEST)
 
 
 @window.event
@@ -134,7 +208,7 @@ def on_resize(w, h):
 
 @window.event
 def on_key_press(symbol, modifiers):
-    global C, polyhedra, camera, anim_on, anim_t
+    global camera, anim_on, anim_t, fps_on, remap_index
     if symbol == pyglet.window.key.S:
         # Save image to file
         image = pyglet.image.get_buffer_manager().get_color_buffer()
@@ -156,42 +230,16 @@ def on_key_press(symbol, modifiers):
         else:
             pyglet.clock.schedule_interval(update_animation, 1/30.)
             anim_on = True
-    elif symbol == pyglet.window.key._1:
-        C = Cuboid(u1=(1,0,0), u2=(0,1,0), u3=(0,0,1))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
-    elif symbol == pyglet.window.key._2:
-        C = Cuboid(u1=(1,1,0), u2=(0,0,1), u3=(1,0,0))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
-    elif symbol == pyglet.window.key._3:
-        C = Cuboid(u1=(1,1,0), u2=(1,0,1), u3=(1,0,0))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
-    elif symbol == pyglet.window.key._4:
-        C = Cuboid(u1=(1,1,1), u2=(1,0,0), u3=(0,1,0))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
-    elif symbol == pyglet.window.key._5:
-        C = Cuboid(u1=(1,1,1), u2=(1,-1,0), u3=(1,0,0))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
-    elif symbol == pyglet.window.key._6:
-        C = Cuboid(u1=(3,2,1), u2=(-1,1,2), u3=(1,1,1))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
-    elif symbol == pyglet.window.key._7:
-        C = Cuboid(u1=(2,1,0), u2=(1,0,1), u3=(1,0,0))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
-    elif symbol == pyglet.window.key._8:
-        C = Cuboid(u1=(7,6,4), u2=(3,3,2), u3=(0,1,1))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
-    elif symbol == pyglet.window.key._9:
-        C = Cuboid(u1=(3,2,1), u2=(-1,1,2), u3=(1,1,1))
-        polyhedra = [make_polyhedron_from_cell(cell) for cell in C.cells]
-        print len(polyhedra)
+    elif symbol == pyglet.window.key.F:
+        fps_on = not fps_on
+    elif symbol in presets:
+        set_remapping(*presets[symbol])
+    elif symbol in (pyglet.window.key.N, pyglet.window.key.P) and len(remap_list) > 0:
+        remap_index += 1 if symbol == pyglet.window.key.N else -1
+        remap_index %= len(remap_list)
+        set_remapping(*remap_list[remap_index])
+        # Start computing the next one in the list before it is asked for
+        cache.request(remap_list[(remap_index + 1) % len(remap_list)], background=True)
 
 
 @window.event
@@ -211,3 +259,4 @@ def on_mouse_scroll(x, y, dx, dy):
     camera.on_mouse_scroll(x, y, dx, dy)
 
 pyglet.app.run()
+cache.close()
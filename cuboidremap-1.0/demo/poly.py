@@ -6,6 +6,8 @@
 # Written by Jordan Carlson (jwgcarlson@berkeley.edu)
 
 from vec3 import *
+import numpy as N
+import clip     # the array-based clipper of the Python remap library (../python)
 
 def rotleft(a, k):
     """Rotate the elements of the array a by k elements to the left."""
@@ -18,7 +20,7 @@ def rotleft(a, k):
 
 
 class Plane:
-    epsilon = 0      # threshold for point-plane comparisons
+    epsilon = clip.epsilon      # threshold for point-plane comparisons
 
     def __init__(self, p=vec3(0,0,0), n=vec3(0,0,1)):
         self.a = n.x
@@ -31,15 +33,15 @@ class Plane:
         return self.a*x + self.b*y + self.c*z + self.d
 
     def contains(self, p):
-        return fabs(self.test(p.x, p.y, p.z)) <= epsilon
+        return fabs(self.test(p.x, p.y, p.z)) <= self.epsilon
 
     def inside(self, p):
         """Check whether the point p lies (strictly) inside the plane."""
-        return self.test(p.x, p.y, p.z) > epsilon
+        return self.test(p.x, p.y, p.z) > self.epsilon
 
     def outside(self, p):
         """Check whether the point p lies (strictly) outside the plane."""
-        return self.test(p.x, p.y, p.z) < -epsilon
+        return self.test(p.x, p.y, p.z) < -self.epsilon
 
     def normal(self):
         L = sqrt(self.a**2 + self.b**2 + self.c**2)
@@ -73,100 +75,63 @@ class Polygon:
 
 
 class Polyhedron:
-    def __init__(self, faces=[]):
+    """A convex polyhedron, stored as an (n,3) array of vertices and a list of
+    faces (lists of vertex indices, counter-clockwise as seen from outside).
+    See ../python/clip.py for the clipping algorithm."""
+
+    def __init__(self, faces=[], verts=None):
+        """Initialize from a list of Polygons, or from an array of vertices
+        and a list of index faces."""
+        if verts is None:
+            # Merge the vertices shared between polygons
+            index = {}
+            verts = []
+            indexfaces = []
+            for f in faces:
+                g = []
+                for v in f.verts:
+                    key = (round(v[0]/clip.epsilon), round(v[1]/clip.epsilon), round(v[2]/clip.epsilon))
+                    if key not in index:
+                        index[key] = len(verts)
+                        verts.append((v[0], v[1], v[2]))
+                    g.append(index[key])
+                indexfaces.append(g)
+            faces = indexfaces
+        self.verts = N.array(verts, dtype=float).reshape(-1, 3)
         self.faces = faces
 
+    def polygons(self):
+        """Return the faces as a list of Polygons."""
+        return [Polygon([vec3(self.verts[k]) for k in f]) for f in self.faces]
+
     def center(self):
         if len(self.faces) == 0:
             return vec3(0,0,0)
         else:
-            return sum([f.center() for f in self.faces])/len(self.faces)
+            return vec3(sum([self.verts[f].mean(axis=0) for f in self.faces])/len(self.faces))
 
     def translate(self, dx):
-        for f in self.faces:
-            f.translate(dx)
-
-    def cut(self, P):
-        """Cut the current polyhedron by the plane P."""
-        newedges = []
-        j = 0
-        while j < len(self.faces):
-            f = self.faces[j]
-            n = len(f.verts)
-            # Find one vertex inside the plane, and one vertex outside the plane
-            kin = -1
-            kout = -1
-            kon = -1
-            k = 0
-            while k < len(f.verts):
-                if P.inside(f.verts[k]):
-                    kin = k
-                elif P.outside(f.verts[k]):
-                    kout = k
-                else:
-                    kon = k
-                k += 1
-            if kon != -1 and (kin == -1 or kout == -1):
-                # The plane just grazes the face; see if it grazes a point or a whole edge
-                if P.contains(f.verts[kon-1]):
-                    newedges.append((f.verts[kon-1], f.verts[kon]))
-                elif P.contains(f.verts[(kon+1) % n]):
-                    newedges.append((f.verts[kon], f.verts[(kon+1) % n]))
-            if kin == -1:
-                # No vertices of the face lie inside the plane; remove the whole face
-                del self.faces[j]
-                continue
-            elif kout == -1:
-                # All vertices are inside the plane; keep face as is
-                j += 1
-                continue
-            else:
-                # Move kin forward until vertex (kin+1) lies outside
-                while P.inside(f.verts[(kin+1) % n]):
-                    kin += 1
-                # Move kout forward until vertex (kout+1) lies inside
-                while P.outside(f.verts[(kout+1) % n]):
-                    kout += 1
-
-                # Get the two new vertices
-                vA = P.line_intersection(f.verts[kin % n], f.verts[(kin+1) % n])
-                vB = P.line_intersection(f.verts[kout % n], f.verts[(kout+1) % n])
-                newedges.append((vA,vB))
-
-                # Define the vertices of the new face
-                newf = [vA, vB]
-                k = kout + 1    # start with first vertex inside plane
-                while (k % n) != ((kin+1) % n):
-                    newf.append(vec3(f.verts[k % n]))
-                    k += 1
-
-                self.faces[j] = Polygon(newf)
-                j += 1
-
-        n = len(newedges)
-        if n >= 3:
-            # Put the edges in order, so that newedges[k][1] == newedges[k+1][0]
-            k = 0
-            while k < n:
-                k2 = k + 1
-                while k2 < n:
-                    if newedges[k][1] == newedges[k2][0]:
-                        newedges[k+1], newedges[k2] = newedges[k2], newedges[k+1]
-                        break
-                    k2 += 1
-                k += 1
-
-            newedges.reverse()
-            # Now combine all the new edges into a new face of the polyhedron
-            newf = [vec3(edge[0]) for edge in newedges]
-            self.faces.append(Polygon(newf))
+        self.verts += (dx[0], dx[1], dx[2])
+
+    def volume(self):
+        return clip.volume(self.verts, self.faces)
+
+    def cut(self, P, tol=None):
+        """Cut the current polyhedron by the plane P, keeping the part inside
+        the plane.  Vertices within tol (by default P.epsilon) of the plane are
+        considered to lie on it."""
+        if tol is None:
+            tol = P.epsilon
+        self.verts, self.faces = clip.clip(self.verts, self.faces, (P.a, P.b, P.c, P.d), tol)
 
 
 def unitcube():
-    back    = Polygon([vec3(0,0,0), vec3(0,0,1), vec3(0,1,1), vec3(0,1,0)])
-    left    = Polygon([vec3(0,0,0), vec3(1,0,0), vec3(1,0,1), vec3(0,0,1)])
-    bottom  = Polygon([vec3(0,0,0), vec3(0,1,0), vec3(1,1,0), vec3(1,0,0)])
-    front   = Polygon([vec3(1,0,0), vec3(1,1,0), vec3(1,1,1), vec3(1,0,1)])
-    right   = Polygon([vec3(0,1,0), vec3(0,1,1), vec3(1,1,1), vec3(1,1,0)])
-    top     = Polygon([vec3(0,0,1), vec3(1,0,1), vec3(1,1,1), vec3(0,1,1)])
-    return Polyhedron([back, left, bottom, front, right, top])
+    verts, faces = clip.cube()
+    return Polyhedron(verts=verts, faces=faces)
+
+def cut_unitcubes(planesets, tol=clip.epsilon):
+    """Return the polyhedra obtained by cutting the unit cube by each of a
+    list of sets of Planes.  This gives the same result as calling cut() for
+    each plane, but handles all the sets at once."""
+    planes = [[(P.a, P.b, P.c, P.d) for P in ps] for ps in planesets]
+    return [Polyhedron(verts=v, faces=f) for v, f in clip.clip_cubes(planes, tol)]
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+#
+# render.py
+#
+# Offscreen rendering of the demo scene to PNG files, for making figures of
+# many remappings without a display.  The cells are projected with the same
+# view math as the demo window (view.py) and rasterized with Numpy: every
+# triangle and edge is broken into fragments (the pixels it covers), and the
+# depth test and alpha blending are then resolved for all fragments at once,
+# with the same result as drawing the primitives one by one in the order the
+# demo draws them.  Nothing here depends on pyglet or OpenGL.
+
+import os
+import sys
+import time
+import struct
+import zlib
+import multiprocessing
+from math import *
+import numpy as N
+
+# The clipper used by poly.py (clip.py) is shared with the Python remap library
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+from vec3 import *
+from view import *
+from poly import unitcube
+from cellcache import load_geometry, triangulate, read_remap_list, remap_key
+
+alpha = 0.7             # opacity of the cell faces, as in demo.py
+background = (1, 1, 1)  # clear color, as in demo.py
+line_bias = 1e-4        # depth offset that keeps edges in front of their faces
+
+
+def _expand(count):
+    """For groups of the given sizes, return the group index and the index
+    within the group of each element."""
+    owner = N.repeat(N.arange(len(count)), count)
+    return owner, N.arange(len(owner)) - N.repeat(N.cumsum(count) - count, count)
+
+def _triangle_fragments(w):
+    """Find the pixels covered by the triangles with window coordinates w
+    (an (n,3,3) array), skipping triangles that face away from the viewer.
+    Returns the triangle index, pixel coordinates and depth of each
+    fragment."""
+    x, y, z = w[...,0], w[...,1], w[...,2]
+    area = (x[:,1] - x[:,0])*(y[:,2] - y[:,0]) - (x[:,2] - x[:,0])*(y[:,1] - y[:,0])
+    front = N.nonzero(area > 0)[0]
+    x, y, z, area = x[front], y[front], z[front], area[front]
+
+    # Depth varies linearly over each triangle
+    dzdx = ((z[:,1] - z[:,0])*(y[:,2] - y[:,0]) - (z[:,2] - z[:,0])*(y[:,1] - y[:,0]))/area
+    dzdy = ((x[:,1] - x[:,0])*(z[:,2] - z[:,0]) - (x[:,2] - x[:,0])*(z[:,1] - z[:,0]))/area
+    z0 = z[:,0] - dzdx*x[:,0] - dzdy*y[:,0]
+
+    # Scan the rows of pixels whose centers lie within each triangle, and
+    # find where each row enters and leaves it
+    ylo = N.ceil(y.min(axis=1) - 0.5).astype(int)
+    yhi = N.floor(y.max(axis=1) - 0.5).astype(int)
+    t, row = _expand(N.maximum(yhi - ylo + 1, 0))
+    py = ylo[t] + row
+    cy = py + 0.5
+    xmin = N.empty(len(t))
+    xmax = N.empty(len(t))
+    xmin[:] = N.inf
+    xmax[:] = -N.inf
+    for a, b in [(0, 1), (1, 2), (2, 0)]:
+        ya, yb = y[t,a], y[t,b]
+        cross = (N.minimum(ya, yb) <= cy) & (cy <= N.maximum(ya, yb)) & (ya != yb)
+        xc = x[t,a] + (cy - ya)*(x[t,b] - x[t,a])/N.where(cross, yb - ya, 1)
+        xmin = N.where(cross, N.minimum(xmin, xc), xmin)
+        xmax = N.where(cross, N.maximum(xmax, xc), xmax)
+    xlo = N.ceil(xmin - 0.5).astype(int)
+    xhi = N.floor(xmax - 0.5).astype(int)
+
+    # Expand the row spans into pixels
+    r, col = _expand(N.maximum(xhi - xlo + 1, 0))
+    t, px, py = t[r], xlo[r] + col, py[r]
+    return front[t], px, py, z0[t] + dzdx[t]*(px + 0.5) + dzdy[t]*(py + 0.5)
+
+def _line_fragments(w):
+    """Find the pixels covered by the line segments with window coordinates
+    w (an (n,2,3) array), by sampling each segment once per pixel along its
+    longest direction.  Returns the segment index, pixel coordinates and
+    depth of each fragment."""
+    d = w[:,1] - w[:,0]
+    count = N.ceil(N.maximum(N.abs(d[:,0]), N.abs(d[:,1]))).astype(int) + 1
+    owner, k = _expand(count)
+    t = k/N.maximum(count[owner] - 1, 1).astype(float)
+    p = w[owner,0] + t[:,None]*d[owner]
+    return owner, N.floor(p[:,0]).astype(int), N.floor(p[:,1]).astype(int), p[:,2] - line_bias
+
+def _resolve(width, height, pixel, seq, depth, color, opaque):
+    """Combine fragments into an image.  Fragments are drawn in order of
+    seq, with a depth test (GL_LESS) and, for those not opaque, alpha
+    blending.  color and opaque are indexed by seq (one entry per
+    primitive).  Returns a (height,width,3) array of colors in [0,1]."""
+    image = N.empty((width*height, 3))
+    image[:] = background
+    if len(pixel) == 0:
+        return image.reshape(height, width, 3)
+
+    # Sort by pixel, then by drawing order; one combined key sorts faster
+    # than lexsort
+    nseq = len(color)
+    key = pixel*nseq + seq
+    order = N.argsort(key)
+    key, depth = key[order], depth[order]
+
+    # A fragment passes the depth test if it is nearer than all earlier
+    # fragments of the same pixel (failed fragments never lower the depth
+    # buffer, so they can be included).  Shifting each pixel's depths below
+    # those of the previous pixels lets one running minimum handle them all.
+    pixel = key//nseq
+    start = N.ones(len(pixel), dtype=bool)
+    start[1:] = (pixel[1:] != pixel[:-1])
+    g = N.cumsum(start) - 1
+    v = depth - 2*g
+    nearest = N.empty(len(v))
+    nearest[1:] = N.minimum.accumulate(v)[:-1]
+    nearest[start] = 1 - 2*g[start]
+    passed = (v < nearest)
+    key, g = key[passed], g[passed]
+    pixel, seq = key//nseq, key % nseq
+    start = N.ones(len(pixel), dtype=bool)
+    start[1:] = (pixel[1:] != pixel[:-1])
+    g = N.cumsum(start) - 1
+
+    # Only the last opaque fragment of each pixel and the translucent ones
+    # after it are visible; each translucent fragment is dimmed by those
+    # drawn after it
+    first = N.nonzero(start)[0]
+    last = N.concatenate((first[1:], [len(g)])) - 1
+    pos = N.arange(len(g))
+    lastopaque = N.maximum.reduceat(N.where(opaque[seq], pos, -1), first)
+    base = N.empty((len(first), 3))
+    base[:] = background
+    base[lastopaque >= 0] = color[seq[lastopaque[lastopaque >= 0]]]
+    after = N.nonzero(pos > lastopaque[g])[0]
+    ga = g[after]
+    nafter = N.bincount(ga, minlength=len(first))
+    weight = alpha*(1 - alpha)**(last[ga] - after)
+    result = base*((1 - alpha)**nafter)[:,None]
+    ca = color[seq[after]]
+    for c in range(3):
+        result[:,c] += N.bincount(ga, weight*ca[:,c], minlength=len(first))
+    image[pixel[first]] = result
+    return image.reshape(height, width, 3)
+
+def render(geometry, view, s=0.0):
+    """Render the cells of a remapping (as computed by make_geometry) as the
+    demo draws them: the black frame of the unit cube, then each cell, with
+    translucent faces and opaque edges, translated by the fraction s of its
+    offset (0 for the unit cube, 1 for the cuboid).  Returns the image as a
+    (height,width,3) array of bytes, top row first."""
+    width, height = view.width, view.height
+    n = unit(view.eye - view.center)
+    frame = N.reshape(triangulate(unitcube())[1], (-1, 2, 3)) + 0.001*N.asarray(n)
+    tris = [N.zeros((0, 3, 3))]
+    lines = [frame]
+    color = [N.zeros((len(frame), 3))]
+    opaque = [N.ones(len(frame), dtype=bool)]
+    tseq = [N.zeros(0, dtype=int)]
+    lseq = [N.arange(len(frame))]
+    nseq = len(frame)
+    for i, offset in enumerate(geometry['offsets']):
+        dx = s*N.asarray(offset, dtype=float)
+        t = N.reshape(geometry['tris'][i], (-1, 3, 3)) + dx
+        l = N.reshape(geometry['lines'][i], (-1, 2, 3)) + dx
+        tris.append(t)
+        lines.append(l)
+        color.append(N.tile(colors[i % len(colors)], (len(t) + len(l), 1)))
+        opaque.append(N.arange(len(t) + len(l)) >= len(t))
+        tseq.append(nseq + N.arange(len(t)))
+        lseq.append(nseq + len(t) + N.arange(len(l)))
+        nseq += len(t) + len(l)
+    tris, lines = N.concatenate(tris), N.concatenate(lines)
+
+    ti, tx, ty, tz = _triangle_fragments(view.project(tris.reshape(-1, 3)).reshape(-1, 3, 3))
+    li, lx, ly, lz = _line_fragments(view.project(lines.reshape(-1, 3)).reshape(-1, 2, 3))
+    x = N.concatenate((tx, lx))
+    y = N.concatenate((ty, ly))
+    depth = N.concatenate((tz, lz))
+    seq = N.concatenate((N.concatenate(tseq)[ti], N.concatenate(lseq)[li]))
+
+    # Clip to the window and the near and far planes
+    keep = (x >= 0) & (x < width) & (y >= 0) & (y < height) & (depth >= 0) & (depth < 1)
+    image = _resolve(width, height, (y*width + x)[keep], seq[keep], depth[keep], N.concatenate(color), N.concatenate(opaque))
+    return (255*image[::-1] + 0.5).astype(N.uint8)
+
+def fit_view(geometry, view, s=0.0, margin=1.1):
+    """Center the view on the cells (translated as by render) and zoom so
+    that they fill the window, keeping the viewing direction."""
+    p = [N.reshape(t, (-1, 3)) + s*N.asarray(o, dtype=float) for t, o in zip(geometry['tris'], geometry['offsets'])]
+    p = N.concatenate(p + [N.array([(0,0,0), (1,1,1)], dtype=float)])
+    center = vec3(0.5*(p.min(axis=0) + p.max(axis=0)))
+    view.eye = center + (view.eye - view.center)
+    view.center = center
+    x, y, z, r = view._getbasis()
+    q = p - N.asarray(center)
+    aspect = float(view.width)/float(view.height)
+    view.z = margin*max(N.abs(N.dot(q, x)).max()/aspect, N.abs(N.dot(q, y)).max())
+
+def write_png(path, image):
+    """Write a (height,width,3) array of bytes to a PNG file."""
+    height, width = image.shape[0:2]
+    raw = N.empty((height, 1 + 3*width), dtype=N.uint8)
+    raw[:,0] = 0        # no filtering
+    raw[:,1:] = image.reshape(height, 3*width)
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    f = open(path, "wb")
+    f.write("\x89PNG\r\n\x1a\n")
+    f.write(chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+    f.write(chunk("IDAT", zlib.compress(raw.tostring(), 6)))
+    f.write(chunk("IEND", ""))
+    f.close()
+
+def render_file(job):
+    """Render the remapping u to a PNG file, for use by a process pool: job
+    is a tuple (u, path, width, height, s, eye, up, fit)."""
+    u, path, width, height, s, eye, up, fit = job
+    geometry = load_geometry(u)
+    view = View(width, height, center=(0.5,0.5,0.5), eye=eye, up=up)
+    if fit:
+        fit_view(geometry, view, s)
+    write_png(path, render(geometry, view, s))
+    return path
+
+
+def abort(msg=None, code=1):
+    if msg:
+        print >> sys.stderr, msg
+    sys.exit(code)
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "list": params['list'] = str(val)
+            elif name == "u": params['u'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "out": params['out'] = str(val)
+            elif name == "size": params['size'] = [int(f) for f in val.replace('x', ' ').replace(',', ' ').split()]
+            elif name == "s": params['s'] = float(val)
+            elif name == "eye": params['eye'] = [float(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "up": params['up'] = [float(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "processes": params['processes'] = int(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "--nofit":
+                params['nofit'] = True
+            elif arg == "-h" or arg == "--help":
+                print "Usage: python render.py [list=FILE] [u=\"u11 ... u33\"] [out=DIR] [size=\"W H\"] [s=0] [eye=\"x y z\"] [up=\"x y z\"] [processes=P] [--nofit]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    remaps = []
+    if 'list' in params:
+        remaps.extend(read_remap_list(params['list']))
+    if 'u' in params:
+        u = params['u']
+        if len(u) != 9:
+            abort("!! u must have 9 components")
+        remaps.append((tuple(u[0:3]), tuple(u[3:6]), tuple(u[6:9])))
+    if len(remaps) == 0:
+        abort("!! No remappings given (use list=... or u=...)")
+
+    outdir = params.get('out', "figures")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    width, height = params.get('size', (400, 300))
+    s = params.get('s', 0.0)
+    eye = vec3(0.5,0.5,0.5) + vec3(params.get('eye', (-0.5,2.5,-0.5)))
+    up = params.get('up', (1,0,0))
+    jobs = [(u, os.path.join(outdir, remap_key(u) + ".png"), width, height, s, tuple(eye), up, not params.get('nofit'))
+            for u in remaps]
+
+    t0 = time.time()
+    processes = params.get('processes', multiprocessing.cpu_count())
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(render_file, jobs)
+    else:
+        results = (render_file(job) for job in jobs)
+    for k, path in enumerate(results):
+        print path
+    if processes > 1:
+        pool.close()
+        pool.join()
+    dt = time.time() - t0
+    print >> sys.stderr, "Rendered %d figures in %.1f seconds (%.1f per second)" % (len(jobs), dt, len(jobs)/max(dt, 1e-9))
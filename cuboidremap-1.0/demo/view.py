@@ -0,0 +1,104 @@
+# view.py
+#
+# View math for the demo, independent of OpenGL: the position and orientation
+# of the camera, and the orthographic projection used to draw the scene.  The
+# interactive camera (camera.py) and the offscreen renderer (render.py) both
+# build on the View class, so that rendered figures look like the demo window.
+
+import sys
+from math import *
+import numpy as N
+from vec3 import *
+
+# Cell colors, in the order the cells are drawn
+colors = [
+          (1,0,0),
+          (0,1,0),
+          (0,0,1),
+          (1,1,0),
+          (1,0,1),
+          (0,1,1),
+          (1,0.5,0),
+          (1,0,0.5),
+          (0.5,0,1),
+          (0.5,1,0),
+          (0,1,0.5),
+          (0,0.5,1),
+          (0.5,0.5,0),
+          (0.5,0,0.5),
+          (0,0.5,0.5),
+          (0.5,0.5,0.5)
+]*8
+
+
+class View:
+    """An orthographic view of the scene: the camera looks from eye towards
+    center, with the given up direction, and the window shows the region
+    [-z*aspect, z*aspect] x [-z, z] around the line of sight."""
+
+    near = 0.05         # near and far clipping distances
+    far = 100
+
+    def __init__(self, width, height, center=(0,0,0), eye=(0,0,1), up=(0,1,0)):
+        self.width = width
+        self.height = height
+        self.z = 1.0
+
+        if eye == center:
+            print >> sys.stderr, "?? eye and center position coincide"
+            eye = (center[0],center[1],center[2]+1)
+        self.center = vec3(center)
+        self.eye    = vec3(eye)
+        self.up     = vec3(up)
+        self._fixup()
+
+    def rotate(self, dphi, dtheta):
+        x,y,z,r = self._getbasis()
+        # First rotate horizontally (about y)
+        x, z = x*cos(dphi) + z*sin(dphi), -x*sin(dphi) + z*cos(dphi)
+        # Then rotate vertically (about x)
+        y, z = y*cos(dtheta) - z*sin(dtheta), y*sin(dtheta) + z*cos(dtheta)
+        # Then update parameters
+        self.up = y
+        self.eye = self.center + r*z
+
+    def translate(self, ax, ay):
+        x,y,z,r = self._getbasis()
+        self.center += ax*x + ay*y
+        self.eye += ax*x + ay*y
+
+    def zoom(self, dz):
+        self.z += dz*sqrt(self.z)
+        if self.z < 1e-2:
+            self.z = 1e-2
+
+    def project(self, p):
+        """Project an (n,3) array of points to window coordinates, as OpenGL
+        would with the matrices set by DemoCamera.apply() and a viewport of
+        (0, 0, width, height).  Returns an (n,3) array of (x, y, depth), with
+        x and y in pixels from the lower left corner of the window, and depth
+        in [0,1] for points between the near and far clipping planes."""
+        x,y,z,r = self._getbasis()
+        aspect = float(self.width)/float(self.height)
+        q = N.asarray(p, dtype=float) - N.asarray(self.eye)
+        w = N.empty(q.shape)
+        w[:,0] = (N.dot(q, x)/(self.z*aspect) + 1)*0.5*self.width
+        w[:,1] = (N.dot(q, y)/self.z + 1)*0.5*self.height
+        w[:,2] = (-N.dot(q, z) - self.near)/(self.far - self.near)
+        return w
+
+    def _getbasis(self):
+        r = length(self.eye - self.center)
+        z = vec3(self.eye - self.center)/r
+        y = self.up
+        x = cross(y,z)
+        return (x,y,z,r)
+
+    def _fixup(self):
+        """Adjust the up vector so that it's orthogonal to the view direction."""
+        n = unit(self.center - self.eye)
+        v = cross(n, self.up)
+        if square(v) == 0:
+            print >> sys.stderr, "?? up vector (%g,%g,%g) parallel to view vector (%g,%g,%g)" % (self.up.x,self.up.y,self.up.z,n.x,n.y,n.z)
+            v = find_basis(n)[0]
+        self.up = unit(cross(v, n))
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+#
+# genremap.py
+#
+# Parallel, resumable version of the genremap program.  The search over the
+# first lattice vector u1 is split into chunks which are handed out to a pool
+# of worker processes.  Each worker finds all invertible matrices for its
+# chunk of u1 values, keeps only the best matrix for each distinct cuboid
+# shape, and writes the result to a sorted shard file in the work directory.
+# Finished shards act as checkpoints: if the run is interrupted, rerunning
+# the same command skips the chunks that are already done.  The shards are
+# finally merged with the same best-score rule as genremap.cpp, and the list
+# is printed in the same format.
+
+import os
+import sys
+import signal
+import multiprocessing
+import numpy as N
+
+# Record type for a remapping: ordered cuboid lengths (Lmax,Lmid,Lmin), the
+# genremap score, the position of the matrix in the search order, and the
+# matrix coefficients
+record_dtype = N.dtype([('key', 'f8', 3), ('score', 'i4'), ('ordinal', 'i8'), ('u', 'i2', 9)])
+
+# Number of (u2,u3) pairs tested at once
+block_size = 1 << 22
+
+# Compact the list of candidates for a chunk once it grows beyond this size
+compact_size = 1 << 20
+
+
+def abort(msg=None, code=1):
+    if msg:
+        print >> sys.stderr, msg
+    sys.exit(code)
+
+def gcd(a, b):
+    """Return the greatest common divisor of a and b."""
+    a, b = abs(a), abs(b)
+    while b != 0:
+        a, b = b, a % b
+    return a
+
+def coprime_triples(Nmax):
+    """Return an (n,3) array of the mutually coprime triplets of integers in
+    the range [-Nmax,+Nmax], in the same order as genremap.cpp."""
+    r = range(-Nmax, Nmax+1)
+    return N.array([(a,b,c) for a in r for b in r for c in r if gcd(a, gcd(b, c)) == 1], dtype=N.int64)
+
+def remappings(u1, u2, u3, ordinal):
+    """Compute the records for the invertible matrices with rows u1, u2, u3
+    (arrays of shape (n,3)), exactly as the Remapping struct of genremap.cpp
+    does."""
+    u1 = u1.astype(float)
+    u2 = u2.astype(float)
+    u3 = u3.astype(float)
+    s1 = N.sum(u1*u1, axis=1)
+    s2 = N.sum(u2*u2, axis=1)
+    d12 = N.sum(u1*u2, axis=1)
+    d23 = N.sum(u2*u3, axis=1)
+    d13 = N.sum(u1*u3, axis=1)
+    alpha = -d12/s1
+    gamma = -(alpha*d13 + d23)/(alpha*d12 + s2)
+    beta = -(d13 + gamma*d12)/s1
+    e2 = u2 + alpha[:,None]*u1
+    e3 = u3 + beta[:,None]*u1 + gamma[:,None]*u2
+    L = N.empty((len(u1), 3), dtype=N.float32)
+    for k, e in enumerate((u1, e2, e3)):
+        L[:,k] = N.sqrt(e[:,0]*e[:,0] + e[:,1]*e[:,1] + e[:,2]*e[:,2])
+
+    # Ordered lengths, computed as in Remapping::get_ordered_lengths().  Note
+    # that the lengths are summed in single precision, so the same shape can
+    # give slightly different values of Lmid (and hence separate entries in
+    # the list) depending on the order of L1, L2, L3.
+    u = N.hstack((u1, u2, u3)).astype(int)
+    R = N.empty(len(u), dtype=record_dtype)
+    Lmax = N.max(L, axis=1).astype(float)
+    Lmin = N.min(L, axis=1).astype(float)
+    R['key'][:,0] = Lmax
+    R['key'][:,1] = (L[:,0] + L[:,1] + L[:,2]).astype(float) - Lmax - Lmin
+    R['key'][:,2] = Lmin
+    R['score'] = N.sum(N.abs(u), axis=1) + N.sum(u < 0, axis=1) - 10*((L[:,0] > L[:,1]) & (L[:,1] > L[:,2]))
+    R['ordinal'] = ordinal
+    R['u'] = u
+    return R
+
+def best_per_shape(R):
+    """Keep only the best remapping for each distinct cuboid shape, sorted by
+    shape.  As in genremap.cpp, the lowest score wins, and ties go to the
+    matrix that comes last in the search order."""
+    if len(R) == 0:
+        return R
+    order = N.lexsort((-R['ordinal'], R['score'], R['key'][:,2], R['key'][:,1], R['key'][:,0]))
+    R = R[order]
+    k = R['key']
+    first = N.ones(len(R), dtype=bool)
+    first[1:] = N.any(k[1:] != k[:-1], axis=1)
+    return R[first]
+
+def search_chunk(V, i1min, i1max, Nold=0):
+    """Find the best remapping for each cuboid shape over all invertible
+    matrices whose first row is one of V[i1min:i1max].  If Nold > 0, only
+    matrices with at least one coefficient outside [-Nold,+Nold] are
+    searched."""
+    nv = len(V)
+    nblock = max(1, block_size // nv)
+    # The triple products are at most 6*Nmax^3 in magnitude, so they can be
+    # computed exactly (and much faster) in single precision
+    Vt = V.T.astype(N.float32)
+    core = N.max(N.abs(V), axis=1) <= Nold
+    everything = N.arange(nv)
+    shell = N.nonzero(~core)[0]
+    found = []
+    nfound = 0
+    for i1 in range(i1min, i1max):
+        u1 = V[i1]
+        if core[i1]:
+            # Either u2 or u3 must have a coefficient in the new shell
+            groups = [(shell, everything), (N.nonzero(core)[0], shell)]
+        else:
+            groups = [(everything, everything)]
+        for I2, I3 in groups:
+            W = Vt[:,I3]
+            for j in range(0, len(I2), nblock):
+                # Triple scalar products u1 . (u2 x u3) = (u1 x u2) . u3 for a block of u2's and all u3's
+                c = N.cross(u1, V[I2[j:j+nblock]]).astype(N.float32)
+                i2, i3 = N.nonzero(N.dot(c, W) == 1)
+                if len(i2) == 0:
+                    continue
+                i2 = I2[i2 + j]
+                i3 = I3[i3]
+                R = remappings(N.tile(u1, (len(i2), 1)), V[i2], V[i3], (i1*nv + i2)*nv + i3)
+                R = best_per_shape(R)
+                found.append(R)
+                nfound += len(R)
+                if nfound > compact_size:
+                    found = [best_per_shape(N.concatenate(found))]
+                    nfound = len(found[0])
+    if len(found) == 0:
+        return N.empty(0, dtype=record_dtype)
+    return best_per_shape(N.concatenate(found))
+
+
+def shard_path(workdir, k):
+    return os.path.join(workdir, "chunk-%05d.npy" % k)
+
+def init_worker():
+    # Leave it to the parent process to handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_chunk(args):
+    """Worker task: search one chunk of u1 values and write its shard."""
+    Nmax, Nold, workdir, k, i1min, i1max = args
+    V = coprime_triples(Nmax)
+    R = search_chunk(V, i1min, i1max, Nold)
+    # Write to a temporary file first, so that a shard only exists once it is complete
+    tmp = shard_path(workdir, k) + ".tmp"
+    f = open(tmp, "wb")
+    N.save(f, R)
+    f.close()
+    os.rename(tmp, shard_path(workdir, k))
+    return k
+
+def merge_shards(paths, R=None):
+    """Merge sorted shard files (and optionally the records R), keeping the
+    best remapping for each shape.  Shards are folded in one at a time, so
+    memory use is proportional to the number of distinct shapes."""
+    if R is None:
+        R = N.empty(0, dtype=record_dtype)
+    for path in paths:
+        R = best_per_shape(N.concatenate((R, N.load(path))))
+    return R
+
+def check_workdir(workdir, Nmax, Nold, nchunks):
+    """Create the work directory, or check that an existing one belongs to
+    the same run."""
+    params = "Nmax = %d\nNold = %d\nchunks = %d\n" % (Nmax, Nold, nchunks)
+    path = os.path.join(workdir, "params.txt")
+    if os.path.exists(path):
+        if open(path).read() != params:
+            abort("!! Work directory '%s' belongs to a different run" % workdir)
+    else:
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        open(path, "w").write(params)
+
+def read_list(f):
+    """Read a list of remappings written by genremap.  Return the value of
+    Nmax it was generated with, and an (n,9) array of matrix coefficients."""
+    Nmax = None
+    u = []
+    for line in f:
+        line = line.strip()
+        if line.startswith('#'):
+            words = line.lstrip('#').split()
+            if len(words) == 3 and words[0:2] == ["Nmax", "="]:
+                Nmax = int(words[2])
+            continue
+        elif len(line) == 0:
+            continue
+        words = line.split()
+        if len(words) < 12:
+            abort("!! Malformed line in remapping list: '%s'" % line)
+        u.append([int(w) for w in words[3:12]])
+    if Nmax is None:
+        abort("!! Remapping list has no '# Nmax = ...' header")
+    return Nmax, N.array(u, dtype=N.int64).reshape(-1, 9)
+
+def base_records(V, Nmax, u):
+    """Compute the records for the remappings u of an existing list, with
+    their positions in the search order for the (larger) value Nmax."""
+    # V is sorted lexicographically, so its rows are sorted by this code
+    m = 2*Nmax + 1
+    code = lambda v: ((v[:,0] + Nmax)*m + v[:,1] + Nmax)*m + v[:,2] + Nmax
+    Vcode = code(V)
+    i1, i2, i3 = [N.searchsorted(Vcode, code(u[:,3*k:3*k+3])) for k in range(3)]
+    nv = len(V)
+    return remappings(u[:,0:3], u[:,3:6], u[:,6:9], (i1*nv + i2)*nv + i3)
+
+def generate(Nmax, workdir, processes=None, nchunks=None, base=None, verbose=False):
+    """Generate the list of remappings for the given Nmax, reusing any
+    shards already present in workdir.  If base = (Nold,u) is the content of
+    an existing list for Nold < Nmax, only matrices with coefficients larger
+    than Nold are searched, and the results are merged with the base list."""
+    V = coprime_triples(Nmax)
+    nv = len(V)
+    Nold = 0
+    R = None
+    if base is not None:
+        Nold, u = base
+        if Nold >= Nmax:
+            abort("!! Base list was generated with Nmax = %d, nothing to do for Nmax = %d" % (Nold, Nmax))
+        R = best_per_shape(base_records(V, Nmax, u))
+    if nchunks is None:
+        nchunks = min(nv, 16*(processes or multiprocessing.cpu_count()))
+    check_workdir(workdir, Nmax, Nold, nchunks)
+
+    bounds = [nv*k//nchunks for k in range(nchunks+1)]
+    tasks = [(Nmax, Nold, workdir, k, bounds[k], bounds[k+1]) for k in range(nchunks)
+             if not os.path.exists(shard_path(workdir, k))]
+    if verbose:
+        print >> sys.stderr, "%d coprime vectors, %d of %d chunks to go" % (nv, len(tasks), nchunks)
+
+    if len(tasks) > 0:
+        pool = multiprocessing.Pool(processes, init_worker)
+        try:
+            for done, k in enumerate(pool.imap_unordered(run_chunk, tasks)):
+                if verbose:
+                    print >> sys.stderr, "Finished chunk %d (%d/%d)" % (k, done+1, len(tasks))
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            abort("!! Interrupted; rerun the same command to resume")
+        pool.join()
+
+    return merge_shards([shard_path(workdir, k) for k in range(nchunks)], R)
+
+def is_int_vector(e):
+    return N.all(N.abs(e - N.round(e)) < 1e-9, axis=-1)
+
+def write_list(f, Nmax, R):
+    """Print a list of remappings in the same format as genremap.cpp."""
+    u = R['u'].astype(int)
+    u1, u2, u3 = u[:,0:3].astype(float), u[:,3:6].astype(float), u[:,6:9].astype(float)
+    s1 = N.sum(u1*u1, axis=1)
+    s2 = N.sum(u2*u2, axis=1)
+    d12 = N.sum(u1*u2, axis=1)
+    d23 = N.sum(u2*u3, axis=1)
+    d13 = N.sum(u1*u3, axis=1)
+    alpha = -d12/s1
+    gamma = -(alpha*d13 + d23)/(alpha*d12 + s2)
+    beta = -(d13 + gamma*d12)/s1
+    e2 = u2 + alpha[:,None]*u1
+    e3 = u3 + beta[:,None]*u1 + gamma[:,None]*u2
+    periodic = N.array([is_int_vector(u1), is_int_vector(e2), is_int_vector(e3)]).T
+    L = N.empty((len(u), 3), dtype=N.float32)
+    for k, e in enumerate((u1, e2, e3)):
+        L[:,k] = N.sqrt(e[:,0]*e[:,0] + e[:,1]*e[:,1] + e[:,2]*e[:,2])
+
+    print >> f, "# Nmax = %d" % Nmax
+    print >> f, "# L1 L2 L3   u11 u12 u13   u21 u22 u23   u31 u32 u33   (periodicity)"
+    for i in range(len(R)):
+        p = "".join([str(k+1) for k in range(3) if periodic[i,k]])
+        print >> f, "%1.4f %1.4f %1.4f   %d %d %d   %d %d %d   %d %d %d   (%s)" % (tuple(L[i]) + tuple(u[i]) + (p,))
+
+
+if __name__ == '__main__':
+    Nmax = 3
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "processes": params['processes'] = int(val)
+            elif name == "chunks": params['chunks'] = int(val)
+            elif name == "work": params['work'] = str(val)
+            elif name == "out": params['out'] = str(val)
+            elif name == "base": params['base'] = str(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        elif arg == "-v" or arg == "--verbose":
+            params['verbose'] = True
+        elif arg == "-h" or arg == "--help":
+            print "Usage: python genremap.py Nmax [base=LIST] [processes=P] [chunks=K] [work=DIR] [out=FILE] [-v]"
+            sys.exit(0)
+        else:
+            try:
+                Nmax = int(arg)
+            except ValueError:
+                abort("Unrecognized option '%s'" % arg)
+
+    if Nmax < 1:
+        abort("Error: Nmax must be >= 1", 2)
+    elif Nmax > 63:
+        abort("Error: Nmax of %d is too large" % Nmax, 3)
+
+    base = None
+    if 'base' in params:
+        fbase = open(params['base'], "r")
+        base = read_list(fbase)
+        fbase.close()
+
+    workdir = params.get('work', "genremap%d.work" % Nmax)
+    R = generate(Nmax, workdir, params.get('processes'), params.get('chunks'), base, params.get('verbose', False))
+
+    if 'out' not in params or params['out'] == "stdout":
+        fout = sys.stdout
+    else:
+        fout = open(params['out'], "w")
+    write_list(fout, Nmax, R)
+    fout.close()
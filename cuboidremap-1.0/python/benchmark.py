@@ -0,0 +1,63 @@
+#!/usr/bin/python
+#
+# benchmark.py
+#
+# Measure the speed of Cuboid.transform_array on random points, for a range
+# of thread counts.  Each timing is the best of a few repetitions, and the
+# speedup is relative to a single thread.
+
+import sys
+import time
+import numpy as N
+from remap import Cuboid, abort
+
+
+def best_time(func, repeat=3):
+    """Return the shortest of 'repeat' timings of func()."""
+    best = None
+    for k in range(repeat):
+        t0 = time.time()
+        func()
+        dt = time.time() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+def thread_scaling(C, x, threads=(1, 2, 4, 8, 16, 32), repeat=3, engine=None):
+    """Time C.transform_array(x) for each thread count, writing into a
+    preallocated output array.  Returns a list of (threads, seconds)."""
+    out = N.empty_like(x)
+    C.transform_array(x[:1], engine=engine)     # compile the kernel, if any
+    return [(t, best_time(lambda: C.transform_array(x, threads=t, out=out, engine=engine), repeat)) for t in threads]
+
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "u": params['u'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "n": params['n'] = int(float(val))
+            elif name == "threads": params['threads'] = [int(f) for f in val.replace(',', ' ').split()]
+            elif name == "repeat": params['repeat'] = int(val)
+            elif name == "engine": params['engine'] = str(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python benchmark.py [u=\"u11 ... u33\"] [n=1e7] [threads=\"1 2 4 8 16 32\"] [repeat=3] [engine=numpy|numba|lookup|fixed|auto]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    u = params.get('u', [3,2,1, -1,1,2, 1,1,1])
+    if len(u) != 9: abort("!! Input matrix 'u' should have 9 components, not %d" % len(u))
+    C = Cuboid(u[0:3], u[3:6], u[6:9])
+    n = params.get('n', 10000000)
+    x = N.random.RandomState(0).rand(n, 3)
+
+    print "# %d cells, %d points" % (len(C.cells), n)
+    print "# threads  seconds  points/s  speedup"
+    timings = thread_scaling(C, x, params.get('threads', (1, 2, 4, 8, 16, 32)), params.get('repeat', 3), params.get('engine'))
+    t1 = timings[0][1]
+    for t, dt in timings:
+        print "%9d  %7.3f  %8.3g  %7.2f" % (t, dt, n/dt, t1/dt)
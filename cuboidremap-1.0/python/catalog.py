@@ -0,0 +1,170 @@
+#!/usr/bin/python
+#
+# catalog.py
+#
+# Compact binary format for lists of cuboid remappings.  A catalog file is a
+# 16-byte header followed by fixed-width records, one per remapping:
+#     L          3 x float64   cuboid dimensions L1, L2, L3
+#     u          9 x int8      matrix coefficients u11 u12 ... u33
+#     periodicity  uint8       bit k set if e_{k+1} is a lattice vector
+# for 34 bytes per remapping.  The header holds the magic string "BOXREMAP"
+# followed by the value of Nmax the list was generated with, and the number
+# of records (both as little-endian int32).  Records are sorted by the
+# longest cuboid edge Lmax, so that remappings in a range of Lmax can be
+# found by binary search without reading the whole file.
+
+import sys
+import bisect
+import numpy as N
+from remap import edge_vectors, abort, sliver_volume
+
+magic = "BOXREMAP"
+header_dtype = N.dtype([('magic', 'S8'), ('Nmax', '<i4'), ('count', '<i4')])
+record_dtype = N.dtype([('L', '<f8', 3), ('u', 'i1', 9), ('periodicity', 'u1')])
+
+
+def make_records(u):
+    """Build catalog records for an (n,9) array of matrix coefficients.  The
+    cuboid dimensions and periodicity are recalculated from the matrices."""
+    u = N.asarray(u, dtype=int).reshape(-1, 9)
+    if len(u) > 0 and N.abs(u).max() > 127:
+        raise ValueError("matrix coefficients do not fit in the catalog format")
+    e = edge_vectors(u)
+    R = N.empty(len(u), dtype=record_dtype)
+    R['L'] = N.sqrt(N.sum(e*e, axis=2))
+    R['u'] = u
+    lattice = N.all(N.abs(e - N.round(e)) < 1e-9, axis=2)
+    R['periodicity'] = N.dot(lattice, [1, 2, 4])
+    return R
+
+def read_text(f):
+    """Read a list of remappings in the text format written by genremap.
+    Return the value of Nmax it was generated with (or 0 if unknown) and the
+    catalog records."""
+    Nmax = 0
+    u = []
+    for line in f:
+        line = line.strip()
+        if line.startswith('#'):
+            words = line.lstrip('#').split()
+            if len(words) == 3 and words[0:2] == ["Nmax", "="]:
+                Nmax = int(words[2])
+            continue
+        elif len(line) == 0:
+            continue
+        words = line.split()
+        if len(words) < 12:
+            raise ValueError("malformed line in remapping list: '%s'" % line)
+        u.append([int(w) for w in words[3:12]])
+    return Nmax, make_records(u)
+
+def write_text(f, R, Nmax=0, stats=None):
+    """Write catalog records in the text format written by genremap.  If
+    stats is given (a dictionary of arrays as returned by
+    CuboidTable.stats()), the cell statistics are appended to each line."""
+    if Nmax > 0:
+        print >> f, "# Nmax = %d" % Nmax
+    if stats is None:
+        print >> f, "# L1 L2 L3   u11 u12 u13   u21 u22 u23   u31 u32 u33   (periodicity)"
+    else:
+        print >> f, "# L1 L2 L3   u11 u12 u13   u21 u22 u23   u31 u32 u33   (periodicity)   ncells vmin vmax slivers"
+    for i, r in enumerate(R):
+        p = "".join([str(k+1) for k in range(3) if r['periodicity'] & (1 << k)])
+        line = "%1.4f %1.4f %1.4f   %d %d %d   %d %d %d   %d %d %d   (%s)" % (tuple(r['L']) + tuple(r['u']) + (p,))
+        if stats is not None:
+            line += "   %d %1.3e %1.3e %d" % (stats['ncells'][i], stats['vmin'][i], stats['vmax'][i], stats['slivers'][i])
+        print >> f, line
+
+def write(path, R, Nmax=0):
+    """Write catalog records to a binary catalog file, sorted by Lmax."""
+    R = R[N.argsort(N.max(R['L'], axis=1), kind='mergesort')]
+    header = N.array([(magic, Nmax, len(R))], dtype=header_dtype)
+    f = open(path, "wb")
+    header.tofile(f)
+    R.tofile(f)
+    f.close()
+
+
+class _Lmax:
+    """Lazy sequence of the Lmax values of a catalog, for use with bisect."""
+    def __init__(self, R):
+        self.R = R
+
+    def __len__(self):
+        return len(self.R)
+
+    def __getitem__(self, i):
+        return max(self.R[i]['L'])
+
+
+class Catalog:
+    """A binary catalog file, memory-mapped for reading."""
+
+    def __init__(self, path):
+        header = N.fromfile(path, dtype=header_dtype, count=1)
+        if len(header) != 1 or header['magic'][0] != magic:
+            raise IOError("'%s' is not a remapping catalog" % path)
+        self.Nmax = int(header['Nmax'][0])
+        count = int(header['count'][0])
+        if count > 0:
+            self.records = N.memmap(path, dtype=record_dtype, mode='r', offset=header_dtype.itemsize, shape=(count,))
+        else:
+            self.records = N.empty(0, dtype=record_dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def search(self, Lmin=0, Lmax=N.inf):
+        """Return the records with Lmin <= max(L1,L2,L3) < Lmax, found by
+        binary search."""
+        s = _Lmax(self.records)
+        return self.records[bisect.bisect_left(s, Lmin):bisect.bisect_left(s, Lmax)]
+
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "in": params['in'] = str(val)
+            elif name == "out": params['out'] = str(val)
+            elif name == "Lmax": params['Lmax'] = [float(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "sliver": params['sliver'] = float(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "--stats":
+                params['stats'] = True
+            elif arg == "-h" or arg == "--help":
+                print "Usage: python catalog.py in=list7.txt out=list7.cat"
+                print "       python catalog.py in=list7.cat [Lmax=\"min max\"] [out=FILE] [--stats [sliver=V]]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    if 'in' not in params:
+        abort("!! No input file given")
+    if open(params['in'], "rb").read(len(magic)) == magic:
+        # Query a binary catalog, printing the matching entries as text
+        cat = Catalog(params['in'])
+        L = params.get('Lmax', [])
+        lo = L[0] if len(L) > 0 else 0
+        hi = L[1] if len(L) > 1 else N.inf
+        R = cat.search(lo, hi)
+        stats = None
+        if params.get('stats'):
+            from cuboidtable import CuboidTable
+            stats = CuboidTable(R['u']).stats(params.get('sliver', sliver_volume))
+        fout = open(params['out'], "w") if 'out' in params else sys.stdout
+        write_text(fout, R, cat.Nmax, stats)
+    else:
+        # Convert a text list to a binary catalog
+        if 'out' not in params:
+            abort("!! No output file given")
+        fin = open(params['in'], "r")
+        Nmax, R = read_text(fin)
+        fin.close()
+        write(params['out'], R, Nmax)
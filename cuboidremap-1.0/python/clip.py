@@ -0,0 +1,292 @@
+# clip.py
+#
+# Array-based clipping of convex polyhedra by planes.  A polyhedron is given
+# by an (n,3) array of vertex coordinates and a list of faces, each face being
+# a list of vertex indices ordered counter-clockwise as seen from outside.
+# Clipping classifies all vertices against the plane in one step, clips each
+# face with the Sutherland-Hodgman rule, and closes the hole left by the cut
+# with a new face whose vertices are ordered by angle.
+#
+# Cutting the unit cube into cells is done for many cells at once by
+# clip_cubes().  Each cell is written as an intersection of slabs, one for
+# each direction of its normals, and its vertices are found as the feasible
+# intersection points of the slab planes of three directions, all in a few
+# array operations.
+#
+# Only Numpy is needed.  The module is used here for computing cell volumes,
+# and by the demo (../demo/poly.py), which imports it from this directory.
+
+import itertools
+import numpy as N
+
+# Default tolerance for deciding whether a vertex lies on a plane
+epsilon = 1e-9
+
+# Largest number of distinct plane directions handled together by clip_cubes()
+max_directions = 9
+
+
+# The faces of the unit cube, as planes (a,b,c,d) with the cube on the positive side
+cube_planes = N.array([(1,0,0,0), (-1,0,0,1), (0,1,0,0), (0,-1,0,1), (0,0,1,0), (0,0,-1,1)], dtype=float)
+
+# Choice of lo (0) or hi (1) bound for each of three directions
+_corners = N.array(list(itertools.product((0, 1), repeat=3)), dtype=int)
+
+
+def cube():
+    """Return the vertices and faces of the unit cube [0,1]^3."""
+    verts = N.array([(0,0,0), (0,0,1), (0,1,0), (0,1,1), (1,0,0), (1,0,1), (1,1,0), (1,1,1)], dtype=float)
+    faces = [[0, 1, 3, 2], [0, 4, 5, 1], [0, 2, 6, 4], [4, 6, 7, 5], [2, 3, 7, 6], [1, 5, 7, 3]]
+    return verts, faces
+
+def clip(verts, faces, plane, tol=epsilon):
+    """Clip the convex polyhedron (verts, faces) by plane = (a,b,c,d), keeping
+    the part where a*x + b*y + c*z + d >= 0.  Vertices within tol of the
+    plane are considered to lie on it.  Returns the new (verts, faces), with
+    no faces if nothing is left."""
+    n = N.asarray(plane[0:3], dtype=float)
+    s = N.dot(verts, n) + plane[3]
+    inside = s > tol
+    outside = s < -tol
+    if not N.any(outside):
+        return verts, faces
+    if not N.any(inside):
+        return N.empty((0, 3)), []
+
+    # Intersection points of the plane with all edges that cross it strictly
+    # (each edge is shared by two faces, so only compute them once)
+    nv = len(verts)
+    edges = N.array([(f[k], f[(k+1) % len(f)]) for f in faces for k in range(len(f))])
+    i, j = edges[:,0], edges[:,1]
+    crossing = (inside[i] & outside[j]) | (outside[i] & inside[j])
+    a = N.minimum(i[crossing], j[crossing])
+    b = N.maximum(i[crossing], j[crossing])
+    keys, first = N.unique(a*nv + b, return_index=True)
+    a, b = a[first], b[first]
+    t = s[a]/(s[a] - s[b])
+    newverts = verts[a] + t[:,None]*(verts[b] - verts[a])
+    newindex = dict(zip(keys.tolist(), range(nv, nv + len(keys))))
+
+    # Clip each face, keeping vertices inside or on the plane and inserting
+    # the intersection points where edges cross it
+    keep = ~outside
+    newfaces = []
+    capped = False
+    for f in faces:
+        if not N.any(keep[f]):
+            continue
+        if not N.any(inside[f]) and N.any(outside[f]):
+            # Face only touches the plane along an edge or at a vertex
+            continue
+        g = []
+        for k in range(len(f)):
+            p, q = f[k], f[(k+1) % len(f)]
+            if keep[p]:
+                g.append(p)
+            if (inside[p] and outside[q]) or (outside[p] and inside[q]):
+                g.append(newindex[min(p, q)*nv + max(p, q)])
+        if len(g) >= 3:
+            newfaces.append(g)
+            if not N.any(inside[f]):
+                # The face lies in the plane, so it already closes the cut
+                capped = True
+
+    verts = N.concatenate((verts, newverts))
+    if not capped:
+        # Close the cut with a face made of all vertices on the plane, ordered
+        # counter-clockwise about the outward normal -n
+        onplane = N.concatenate((N.nonzero(keep & ~inside)[0], N.arange(nv, nv + len(newverts))))
+        used = N.zeros(len(verts), dtype=bool)
+        used[[k for g in newfaces for k in g]] = True
+        onplane = onplane[used[onplane]]
+        if len(onplane) >= 3:
+            x, y = _basis(n)
+            p = verts[onplane] - verts[onplane].mean(axis=0)
+            angle = N.arctan2(N.dot(p, y), N.dot(p, x))
+            newfaces.append(onplane[N.argsort(-angle)].tolist())
+
+    return _compact(verts, newfaces)
+
+def _basis(n):
+    """Return unit vectors x, y such that (x, y, n/|n|) is a right-handed
+    orthonormal basis.  Also works for an (m,3) array of normals."""
+    z = n/N.sqrt(N.sum(n*n, axis=-1))[...,None]
+    # x is z cross (1,0,0), or z cross (0,1,0) if z is close to (1,0,0)
+    near = (N.abs(z[...,0]) >= 0.9)
+    x = N.empty_like(z)
+    x[...,0] = N.where(near, -z[...,2], 0)
+    x[...,1] = N.where(near, 0, z[...,2])
+    x[...,2] = N.where(near, z[...,0], -z[...,1])
+    x /= N.sqrt(N.sum(x*x, axis=-1))[...,None]
+    y = N.empty_like(z)
+    y[...,0] = z[...,1]*x[...,2] - z[...,2]*x[...,1]
+    y[...,1] = z[...,2]*x[...,0] - z[...,0]*x[...,2]
+    y[...,2] = z[...,0]*x[...,1] - z[...,1]*x[...,0]
+    return x, y
+
+def _compact(verts, faces):
+    """Drop unused vertices and renumber the faces."""
+    used = N.zeros(len(verts), dtype=bool)
+    for f in faces:
+        used[f] = True
+    index = N.cumsum(used) - 1
+    return verts[used], [index[f].tolist() for f in faces]
+
+def volume(verts, faces):
+    """Return the volume of the polyhedron (verts, faces)."""
+    v = 0.0
+    for f in faces:
+        p = verts[f]
+        # Sum of signed tetrahedra spanned by the origin and a fan over the face
+        v += N.sum(p[0,0]*(p[1:-1,1]*p[2:,2] - p[1:-1,2]*p[2:,1])
+                 + p[0,1]*(p[1:-1,2]*p[2:,0] - p[1:-1,0]*p[2:,2])
+                 + p[0,2]*(p[1:-1,0]*p[2:,1] - p[1:-1,1]*p[2:,0]))
+    return v/6.0
+
+def volumes(polyhedra):
+    """Return the volumes of a list of polyhedra (verts, faces), as volume()
+    would compute them one by one."""
+    verts = [N.empty((0, 3))]
+    tris = []
+    owner = []
+    offset = 0
+    for i, (v, faces) in enumerate(polyhedra):
+        n = len(tris)
+        tris.extend([(offset + f[0], offset + f[k], offset + f[k+1]) for f in faces for k in range(1, len(f) - 1)])
+        owner.extend([i]*(len(tris) - n))
+        verts.append(v)
+        offset += len(v)
+    p = N.concatenate(verts)[N.array(tris, dtype=int).reshape(-1, 3)]
+    det = N.sum(p[:,0]*N.cross(p[:,1], p[:,2]), axis=1)
+    return N.bincount(N.array(owner, dtype=int), det, minlength=len(polyhedra))/6.0
+
+def clip_cube(planes, tol=epsilon):
+    """Return the vertices and faces of the part of the unit cube on the
+    positive side of all the given planes (a,b,c,d)."""
+    verts, faces = cube()
+    for P in planes:
+        verts, faces = clip(verts, faces, P, tol)
+        if len(faces) == 0:
+            break
+    return verts, faces
+
+def clip_cubes(planes, tol=epsilon):
+    """Clip the unit cube by each of a list of sets of planes, e.g. the faces
+    of all the cells of a remapping.  planes[i] is a sequence of planes
+    (a,b,c,d) and the result is a list of (verts, faces), the i-th being the
+    part of the unit cube on the positive side of all the planes in
+    planes[i], as clip_cube(planes[i]) would return it."""
+    if len(planes) == 0:
+        return []
+    P = N.array([P for p in planes for P in p], dtype=float).reshape(-1, 4)
+    owner = N.repeat(N.arange(len(planes)), [len(p) for p in planes])
+    return _clip_cubes(P, owner, len(planes), tol)
+
+def _clip_cubes(planes, owner, m, tol):
+    """Clip the unit cube by the (n,4) array of planes, plane i belonging to
+    cell owner[i] of m cells (owner being sorted)."""
+    # All planes of each cell, normalized, including the faces of the cube.
+    # Planes with no normal either hold everywhere or empty the cell.
+    P = N.concatenate((N.tile(cube_planes, (m, 1)), planes))
+    cell = N.concatenate((N.repeat(N.arange(m), 6), owner))
+    norm = N.sqrt(N.sum(P[:,0:3]**2, axis=1))
+    empty = N.zeros(m, dtype=bool)
+    empty[cell[(norm == 0) & (P[:,3] < -tol)]] = True
+    P, cell, norm = P[norm > 0], cell[norm > 0], norm[norm > 0]
+    P /= norm[:,None]
+
+    # Each cell is an intersection of slabs lo <= D.x <= hi, one for each
+    # direction D of the normals (taken up to sign, with the first nonzero
+    # coordinate positive).  The cells of a remapping only have the three
+    # directions of the cube and the three of the cuboid.  Split the batch
+    # if there are too many.
+    n = P[:,0:3]
+    upper = (n[N.arange(len(n)), N.argmax(n != 0, axis=1)] < 0)
+    n[upper] *= -1
+    order = N.lexsort(n.T)
+    new = N.ones(len(n), dtype=bool)
+    new[1:] = N.any(n[order[1:]] != n[order[:-1]], axis=1)
+    D = n[order[new]]
+    u = len(D)
+    if u > max_directions:
+        if m == 1:
+            return [clip_cube(planes, tol)]
+        h = N.searchsorted(owner, m//2)
+        return _clip_cubes(planes[:h], owner[:h], m//2, tol) + _clip_cubes(planes[h:], owner[h:] - m//2, m - m//2, tol)
+    direction = N.empty(len(n), dtype=int)
+    direction[order] = N.cumsum(new) - 1
+
+    # The bounds, as a (2u,m) array of lo for each direction then hi for
+    # each direction, infinite where a cell has no such plane
+    B = N.empty((2, u, m))
+    B[0] = -N.inf
+    B[1] = N.inf
+    B = B.reshape(-1)
+    slot = (upper*u + direction)*m + cell
+    N.maximum.at(B, slot[~upper], -P[~upper,3])
+    N.minimum.at(B, slot[upper], P[upper,3])
+    B = B.reshape(2*u, m)
+
+    # Candidate vertices are the intersection points of the bounding planes
+    # of three independent directions, with a shared inverse matrix for each
+    # triple of directions.  Only those in the cube are kept, which also
+    # drops those involving infinite bounds (they come out infinite or nan).
+    T = N.array(list(itertools.combinations(range(u), 3)), dtype=int).reshape(-1, 3)
+    T = T[N.abs(N.linalg.det(D[T])) > tol]
+    inverse = N.repeat(N.linalg.inv(D[T]), 8, axis=0)
+    J = (_corners[None,:,:]*u + T[:,None,:]).reshape(-1, 3)
+    with N.errstate(invalid='ignore'):
+        x = N.matmul(inverse, B[J])
+        inside = N.all((x >= -tol) & (x <= 1 + tol), axis=1)
+    c, cell = N.nonzero(inside)
+    x = x[c,:,cell].T
+
+    # Keep those within all the slabs of their cell
+    s = N.dot(D, x)
+    bounds = B[:,cell]
+    inside = N.flatnonzero(N.all((s >= bounds[:u] - tol) & (s <= bounds[u:] + tol), axis=0))
+    cell, x, s, bounds = cell[inside], x.take(inside, axis=1), s.take(inside, axis=1), bounds.take(inside, axis=1)
+
+    # Merge the copies of vertices where more than three planes meet, which
+    # are recognized by lying on the same set of planes
+    k = 2*u
+    on = (N.abs(N.concatenate((s, s)) - bounds) <= tol)
+    signature = N.dot(1 << N.arange(k), on)
+    order = N.lexsort((signature, cell))
+    cell, x, on, signature = cell[order], x[:,order], on[:,order], signature[order]
+    first = N.ones(len(cell), dtype=bool)
+    first[1:] = (cell[1:] != cell[:-1]) | (signature[1:] != signature[:-1])
+    cell, x, on = cell[first], x[:,first], on[:,first]
+
+    # Each plane containing at least three vertices of a cell is a face.
+    # Order its vertices counter-clockwise about the outward normal, which
+    # is -D for lo planes and D for hi planes.
+    j, v = N.nonzero(on)
+    group = cell[v]*k + j
+    count = N.bincount(group, minlength=m*k)
+    big = (count[group] >= 3)
+    v, j, group = v[big], j[big], group[big]
+    center = N.array([N.bincount(group, x[c,v], minlength=m*k) for c in range(3)])/N.maximum(count, 1)
+    ex, ey = _basis(D)
+    ex, ey = N.concatenate((ex, ex)).T, N.concatenate((ey, -ey)).T
+    p = x[:,v] - center[:,group]
+    angle = N.arctan2(N.sum(p*ey[:,j], axis=0), N.sum(p*ex[:,j], axis=0))
+    order = N.argsort(8*group - angle)
+    v, group = v[order], group[order]
+    x = x.T.copy()
+
+    # Split into separate polyhedra, numbering the vertices of each from 0
+    vstart = N.searchsorted(cell, N.arange(m + 1))
+    fstart = N.searchsorted(group, N.arange(m + 1)*k)
+    breaks = N.concatenate(([0], N.nonzero(N.diff(group))[0] + 1, [len(group)])).tolist()
+    w = (v - vstart[cell[v]]).tolist()
+    faces = [w[a:b] for a, b in zip(breaks[:-1], breaks[1:])]
+    fstart = N.searchsorted(breaks, fstart).tolist()
+    result = []
+    for i in range(m):
+        if fstart[i+1] - fstart[i] < 4 or empty[i]:
+            # Nothing left, or only a flat piece of a plane
+            result.append((N.empty((0, 3)), []))
+        else:
+            result.append((x[vstart[i]:vstart[i+1]], faces[fstart[i]:fstart[i+1]]))
+    return result
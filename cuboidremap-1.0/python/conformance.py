@@ -0,0 +1,268 @@
+#!/usr/bin/python
+#
+# conformance.py
+#
+# Check that all transform engines of Cuboid.transform_array, and the C++
+# remap program, agree with each other and remap the unit cube one-to-one
+# onto the cuboid, for a sample of remappings from a genremap list.  The
+# points are deterministic: uniform random points, points exactly on the
+# cell faces and just off them, and points of a rational grid, which lie on
+# many lattice planes at once.  Each engine is also timed, and the timings
+# may be compared against those of an earlier run to catch slowdowns.
+
+import os
+import sys
+import time
+import json
+import subprocess
+import tempfile
+import numpy as N
+import remap
+from remap import Cuboid, abort
+from catalog import read_text
+
+# Offsets of the points placed just off the cell faces
+face_offsets = (1e-15, 1e-12, 1e-9)
+
+# Denominator of the rational grid of test points
+grid_denominator = 12
+
+# Largest allowed slowdown relative to a baseline run
+slowdown_limit = 0.25
+
+
+def sample_matrices(R, count):
+    """Return the matrices of 'count' remappings from the catalog records R,
+    spread evenly over the list sorted by the longest edge Lmax (including
+    the first and the last)."""
+    Lmax = R['L'].max(axis=1)
+    order = N.argsort(Lmax, kind='mergesort')
+    picks = N.unique(N.round(N.linspace(0, len(R) - 1, min(count, len(R)))).astype(int))
+    return [tuple(R['u'][order[i]]) for i in picks]
+
+def test_points(C, n, seed=0):
+    """Return deterministic test points in the unit cube [0,1)^3 for the
+    Cuboid C, as a dictionary of (k,3) arrays: 'uniform' random points,
+    'face' points on the non-trivial cell faces, 'near' points at distances
+    face_offsets on either side of the faces, and 'grid' points (i,j,k)/q
+    for q = grid_denominator."""
+    rs = N.random.RandomState(seed)
+    points = {'uniform': rs.rand(n, 3)}
+    planes = [(f.a, f.b, f.c, f.d) for c in C.cells for f in c.faces]
+    face, near = [], []
+    if len(planes) > 0:
+        m = max(1, n//(10*len(planes)))
+        for a, b, c, d in planes:
+            normal = N.array([a, b, c])
+            x = rs.rand(m, 3)
+            p = x - N.outer(N.dot(x, normal) + d, normal)
+            face.append(p)
+            for eps in face_offsets:
+                near.append(p + eps*normal)
+                near.append(p - eps*normal)
+    q = grid_denominator
+    points['face'] = _in_cube(N.concatenate(face) if len(face) > 0 else N.zeros((0, 3)))
+    points['near'] = _in_cube(N.concatenate(near) if len(near) > 0 else N.zeros((0, 3)))
+    points['grid'] = N.indices((q, q, q)).reshape(3, -1).T/float(q)
+    return points
+
+def _in_cube(x):
+    return x[N.all((x >= 0) & (x < 1), axis=1)]
+
+def transform_points(C, x, engine, block=1024):
+    """Remap the points x with the given engine.  Points that are in no cell
+    get NaN coordinates.  Returns the remapped points and the number of such
+    failures."""
+    try:
+        return C.transform_array(x, engine=engine), 0
+    except RuntimeError:
+        pass
+    r = N.empty(x.shape)
+    failed = 0
+    for i0 in range(0, len(x), block):
+        try:
+            r[i0:i0+block] = C.transform_array(x[i0:i0+block], engine=engine)
+        except RuntimeError:
+            for i in range(i0, min(i0 + block, len(x))):
+                try:
+                    r[i] = C.transform_array(x[i:i+1], engine=engine)
+                except RuntimeError:
+                    r[i] = N.nan
+                    failed += 1
+    return r, failed
+
+def valid(C, x, r, tol):
+    """Return which of the remapped points r lie in the cuboid
+    [0,L1)x[0,L2)x[0,L3) (within tol) and map back to the original points x
+    under InverseTransform (within tol, modulo 1)."""
+    L = N.array([C.L1, C.L2, C.L3])
+    ok = N.all(N.isfinite(r), axis=1)
+    r = N.where(ok[:,None], r, 0)
+    ok &= N.all((r >= -tol) & (r < L + tol), axis=1)
+    dx = C.inverse_transform_array(r) - x
+    dx -= N.round(dx)
+    ok &= N.all(N.abs(dx) <= tol, axis=1)
+    return ok
+
+def run_cpp(program, u, x):
+    """Remap the points x with the C++ remap program, printing them to full
+    precision.  Returns the remapped points (NaN for points it found in no
+    cell), the number of such failures, and the time taken by the program,
+    including reading and writing text."""
+    fd, inpath = tempfile.mkstemp(suffix=".dat")
+    f = os.fdopen(fd, "w")
+    N.savetxt(f, x, fmt="%.17g")
+    f.close()
+    try:
+        t0 = time.time()
+        p = subprocess.Popen([program, "in=%s" % inpath, "u=%s" % " ".join([str(c) for c in u]), "precision=17"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        dt = time.time() - t0
+    finally:
+        os.remove(inpath)
+    if p.returncode != 0:
+        raise RuntimeError("'%s' failed: %s" % (program, err.strip()))
+    r = N.array([[float(c) for c in line.split()] for line in out.splitlines() if len(line.split()) == 3]).reshape(-1, 3)
+    if len(r) != len(x):
+        raise RuntimeError("'%s' returned %d points for %d" % (program, len(r), len(x)))
+    return r, int(N.sum(N.any(N.isnan(r), axis=1))), dt
+
+def differ(a, b, tol):
+    """Return which rows of the (k,3) arrays a and b differ by more than tol
+    in some coordinate, or are NaN."""
+    with N.errstate(invalid='ignore'):
+        return N.any(~(N.abs(a - b) <= tol), axis=1)
+
+def best_time(func, repeat=3):
+    """Return the shortest of 'repeat' timings of func()."""
+    best = None
+    for k in range(repeat):
+        t0 = time.time()
+        func()
+        dt = time.time() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+def check_matrix(u, n, tol=1e-8, seed=0, repeat=3, cpp=None, cpp_points=10000):
+    """Run all available engines (and the C++ program cpp, if given) on the
+    test points for the remapping u.  Returns the Cuboid and a list of
+    result dictionaries, one per engine, with the number of points each
+    engine found in no cell ('failures'), remapped incorrectly ('invalid')
+    or remapped differently from the 'numpy' engine on uniform points
+    ('mismatches'), the number of cuboid points not recovered by remapping
+    their inverse images ('unrecovered'), and the time in seconds to remap
+    the uniform points ('time')."""
+    C = Cuboid(u[0:3], u[3:6], u[6:9])
+    points = test_points(C, n, seed)
+    x = N.concatenate([points[k] for k in ('uniform', 'face', 'near', 'grid')])
+    y = N.concatenate(list(C.random_points(n, seed)))
+    ref = None
+    results = []
+    for name in remap.engine_order:
+        if not remap.engines[name][1]():
+            continue
+        r, failed = transform_points(C, x, name)
+        ok = valid(C, x, r, tol)
+        if ref is None:
+            ref = r[:n]
+        ry, failed_y = transform_points(C, C.inverse_transform_array(y), name)
+        C.transform_array(points['uniform'][:1], engine=name)    # compile or set up, untimed
+        results.append({'engine': name,
+                        'failures': failed,
+                        'invalid': int(N.sum(~ok)) - failed,
+                        'mismatches': int(N.sum(differ(r[:n], ref, tol))),
+                        'unrecovered': int(N.sum(differ(ry, y, tol))),
+                        'time': best_time(lambda: C.transform_array(points['uniform'], engine=name), repeat)})
+    if cpp is not None:
+        # The C++ program also remaps the inverse images of the first
+        # cpp_points cuboid points, after the test points
+        k = min(cpp_points, n)
+        xc = N.concatenate((points['uniform'][:k], points['face'], points['near'], points['grid']))
+        r, failed, dt = run_cpp(cpp, u, N.concatenate((xc, C.inverse_transform_array(y[:k]))))
+        r, ry = r[:len(xc)], r[len(xc):]
+        failed = int(N.sum(N.any(N.isnan(r), axis=1)))
+        ok = valid(C, xc, r, tol)
+        results.append({'engine': 'c++',
+                        'failures': failed,
+                        'invalid': int(N.sum(~ok)) - failed,
+                        'mismatches': int(N.sum(differ(r[:k], ref[:k], tol))),
+                        'unrecovered': int(N.sum(differ(ry, y[:k], tol))),
+                        'time': dt*len(points['uniform'])/float(len(xc) + k)})
+    return C, results
+
+def matrix_key(u):
+    return " ".join([str(c) for c in u])
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "list": params['list'] = str(val)
+            elif name == "matrices": params['matrices'] = int(val)
+            elif name == "n": params['n'] = int(float(val))
+            elif name == "seed": params['seed'] = int(val)
+            elif name == "tol": params['tol'] = float(val)
+            elif name == "repeat": params['repeat'] = int(val)
+            elif name == "cpp": params['cpp'] = str(val)
+            elif name == "baseline": params['baseline'] = str(val)
+            elif name == "save": params['save'] = str(val)
+            elif name == "slowdown": params['slowdown'] = float(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "--build":
+                params['build'] = True
+            elif arg == "-h" or arg == "--help":
+                print "Usage: python conformance.py [list=list7.txt] [matrices=12] [n=1e5] [seed=0] [tol=1e-8] [repeat=3] [cpp=../c++/remap] [--build] [baseline=FILE] [save=FILE] [slowdown=0.25]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    # Build and locate the C++ program
+    cppdir = os.path.join(here, "..", "c++")
+    cpp = params.get('cpp', os.path.join(cppdir, "remap"))
+    if params.get('build'):
+        if subprocess.call(["make", "-C", cppdir, "remap"]) != 0:
+            abort("!! Could not build the C++ remap program")
+    if not os.path.exists(cpp):
+        print >> sys.stderr, "?? C++ program '%s' not found (build it with --build); skipping it" % cpp
+        cpp = None
+
+    Nmax, R = read_text(open(params.get('list', os.path.join(here, "..", "genremap", "list7.txt"))))
+    matrices = sample_matrices(R, params.get('matrices', 12))
+    baseline = json.load(open(params['baseline'])) if 'baseline' in params else {}
+    limit = params.get('slowdown', slowdown_limit)
+    n = params.get('n', 100000)
+    tol = params.get('tol', 1e-8)
+
+    timings = {}
+    errors = 0
+    slowdowns = 0
+    print "# u11 ... u33   ncells   engine   failures invalid mismatches unrecovered   seconds   baseline"
+    for u in matrices:
+        key = matrix_key(u)
+        C, results = check_matrix(u, n, tol, params.get('seed', 0), params.get('repeat', 3), cpp)
+        timings[key] = {}
+        for res in results:
+            e = res['engine']
+            timings[key][e] = {'time': res['time'], 'failures': res['failures']}
+            notes = []
+            base = baseline.get(key, {}).get(e, {})
+            if res['invalid'] > 0 or res['mismatches'] > 0 or res['unrecovered'] > 0 or res['failures'] > base.get('failures', 0):
+                errors += 1
+                notes.append("ERROR")
+            t0 = base.get('time')
+            if t0 is not None and res['time'] > (1 + limit)*t0:
+                slowdowns += 1
+                notes.append("SLOWER")
+            line = "%-30s %4d   %-6s   %6d %6d %6d %6d" % (key, len(C.cells), e, res['failures'], res['invalid'], res['mismatches'], res['unrecovered'])
+            print "%s   %8.4f   %s %s" % (line, res['time'], "%8.4f" % t0 if t0 is not None else "       -", " ".join(notes))
+    if 'save' in params:
+        f = open(params['save'], "w")
+        json.dump(timings, f, indent=1, sort_keys=True)
+        f.close()
+    print "# %d errors, %d slowdowns" % (errors, slowdowns)
+    sys.exit(1 if errors > 0 or slowdowns > 0 else 0)
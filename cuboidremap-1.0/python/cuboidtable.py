@@ -0,0 +1,221 @@
+#!/usr/bin/python
+#
+# cuboidtable.py
+#
+# Construct the geometry of many cuboid remappings at once.  A CuboidTable
+# holds the same information as a list of Cuboid objects (edge vectors,
+# dimensions, normals, and the list of cells with their non-trivial faces),
+# but stored in flat Numpy arrays and computed in a few vectorized passes.
+# This makes it practical to sweep over an entire list of remappings.
+
+import sys
+import multiprocessing
+import numpy as N
+import clip
+from remap import Cuboid, edge_vectors, abort, sliver_volume
+
+# Approximate number of candidate cells processed per vectorized pass
+block_size = 1 << 18
+
+# Number of cells clipped together when computing cell volumes
+volume_block_size = 1 << 12
+
+
+def _geometry(u):
+    """Compute edge vectors, dimensions and normals for an (n,3,3) array of
+    matrices, falling back to the identity for invalid matrices as
+    Cuboid.__init__ does."""
+    u1, u2, u3 = u[:,0], u[:,1], u[:,2]
+    tsp = N.sum(u1*N.cross(u2, u3), axis=1)
+    valid = (tsp == 1)
+    e = N.empty(u.shape, dtype=float)
+    e[~valid] = N.identity(3)
+    if N.any(valid):
+        e[valid] = edge_vectors(u[valid])
+    L = N.sqrt(e[...,0]**2 + e[...,1]**2 + e[...,2]**2)
+    n = e/L[...,None]
+    return valid, e, L, n
+
+def _vertices(e):
+    """Vertices of the cuboids, in the same order as Cuboid.v"""
+    z = N.zeros_like(e[:,0])
+    e1, e2, e3 = e[:,0], e[:,1], e[:,2]
+    return N.array([z, z + e3, z + e2, z + e2 + e3, z + e1, z + e1 + e3, z + e1 + e2, z + e1 + e2 + e3])
+
+def _bounds(v):
+    """Integer bounding boxes of the cuboids with vertices v."""
+    return N.floor(v.min(axis=0)).astype(int), N.ceil(v.max(axis=0)).astype(int)
+
+def _cells(e, n):
+    """Find the non-trivial cells (and faces) for a block of remappings, as
+    Cuboid.__init__ does.  Returns the number of cells for each remapping,
+    the cell shifts (ix,iy,iz), the number of faces of each cell, and the
+    faces as rows (a,b,c,d)."""
+    m = len(e)
+    v = _vertices(e)
+    imin, imax = _bounds(v)
+
+    # Enumerate all candidate cells (ix,iy,iz) within the bounding boxes
+    dims = imax - imin
+    count = N.prod(dims, axis=1)
+    owner = N.repeat(N.arange(m), count)
+    k = N.arange(count.sum()) - N.repeat(N.cumsum(count) - count, count)
+    d = dims[owner]
+    shift = imin[owner] + N.array([k // (d[:,1]*d[:,2]), (k // d[:,2]) % d[:,1], k % d[:,2]]).T
+
+    # Faces of the cuboid translated by -shift, in the same order as
+    # Cuboid.__init__: each face passes through the vertex v[vface[f]] and
+    # has the inward normal nface[:,f]
+    vface = [0, 4, 0, 2, 0, 1]
+    nface = N.array([n[:,0], -n[:,0], n[:,1], -n[:,1], n[:,2], -n[:,2]]).transpose(1, 0, 2)
+    s = -shift.astype(float)
+    dface = N.empty((len(s), 6))
+    for f in range(6):
+        nf = [N.repeat(nface[:,f,k], count) for k in range(3)]
+        vf = [N.repeat(v[vface[f],:,k], count) for k in range(3)]
+        dface[:,f] = -((vf[0] + s[:,0])*nf[0] + (vf[1] + s[:,1])*nf[1] + (vf[2] + s[:,2])*nf[2])
+
+    # UnitCubeTest for every face.  The largest and smallest values of the
+    # plane test over the corners of the unit cube come from the corners
+    # picking out the positive and negative coefficients, and since rounding
+    # is monotonic this gives exactly the same answer as testing all 8
+    # corners.
+    high = (N.maximum(nface[...,0], 0) + N.maximum(nface[...,1], 0)) + N.maximum(nface[...,2], 0)
+    low = (N.minimum(nface[...,0], 0) + N.minimum(nface[...,1], 0)) + N.minimum(nface[...,2], 0)
+    above = (high[owner] + dface) > 0
+    below = (low[owner] + dface) < 0
+    keepface = above & below
+    keepcell = ~N.any(below & ~above, axis=1) & N.any(keepface, axis=1)
+    faces = N.concatenate((nface[owner[keepcell]], dface[keepcell][...,None]), axis=2)
+
+    # The identity remapping (or any remapping without non-trivial cells) uses exactly one cell
+    ncells = N.bincount(owner[keepcell], minlength=m)
+    empty = (ncells == 0)
+    shift = shift[keepcell]
+    keepface = keepface[keepcell]
+    cellowner = owner[keepcell]
+    if N.any(empty):
+        cellowner = N.concatenate((cellowner, N.nonzero(empty)[0]))
+        order = N.argsort(cellowner, kind='mergesort')
+        shift = N.concatenate((shift, N.zeros((empty.sum(), 3), dtype=int)))[order]
+        keepface = N.concatenate((keepface, N.zeros((empty.sum(), 6), dtype=bool)))[order]
+        faces = N.concatenate((faces, N.zeros((empty.sum(), 6, 4))))[order]
+        ncells[empty] = 1
+    return ncells, shift, keepface.sum(axis=1), faces[keepface]
+
+def _build(u):
+    """Compute all table columns for an (n,3,3) block of matrices."""
+    valid, e, L, n = _geometry(u)
+    ncells, shift, nfaces, faces = _cells(e, n)
+    return valid, e, L, n, ncells, shift, nfaces, faces
+
+
+class CuboidTable:
+    """Geometry of many cuboid remappings, stored as flat arrays.
+
+    For remapping i, u[i], e[i], L[i] and n[i] hold the matrix, the edge
+    vectors, the dimensions and the unit normals (n1,n2,n3), and valid[i]
+    tells whether the matrix was a valid (unimodular) remapping.  Its cells
+    are cell_shift[cell_offset[i]:cell_offset[i+1]], and the non-trivial
+    faces of cell j are the rows (a,b,c,d) of
+    faces[face_offset[j]:face_offset[j+1]].  Everything agrees exactly with
+    the corresponding Cuboid objects."""
+
+    def __init__(self, u, processes=None):
+        """Initialize from an (n,9) or (n,3,3) array of integer matrices.  If
+        processes is given, blocks of matrices are handled by a pool of that
+        many worker processes."""
+        self.u = N.asarray(u, dtype=int).reshape(-1, 3, 3)
+
+        # Split into blocks with roughly block_size candidate cells each
+        imin, imax = _bounds(_vertices(_geometry(self.u)[1]))
+        total = N.cumsum(N.prod(imax - imin, axis=1))
+        splits = N.searchsorted(total, N.arange(block_size, total[-1] if len(total) else 0, block_size))
+        blocks = [b for b in N.split(self.u, N.unique(splits)) if len(b) > 0]
+        if processes is not None and processes > 1 and len(blocks) > 1:
+            pool = multiprocessing.Pool(processes)
+            results = pool.map(_build, blocks)
+            pool.close()
+            pool.join()
+        else:
+            results = [_build(b) for b in blocks]
+
+        columns = zip(*results) if len(results) > 0 else [[N.empty((0,) + s)] for s in [(), (3,3), (3,), (3,3), (), (3,), (), (4,)]]
+        self.valid, self.e, self.L, self.n, ncells, self.cell_shift, nfaces, self.faces = [N.concatenate(c) for c in columns]
+        self.valid = self.valid.astype(bool)
+        self.cell_shift = self.cell_shift.astype(int)
+        self.cell_offset = N.concatenate(([0], N.cumsum(ncells))).astype(int)
+        self.face_offset = N.concatenate(([0], N.cumsum(nfaces))).astype(int)
+
+    def __len__(self):
+        return len(self.u)
+
+    def ncells(self):
+        """Return the number of cells of each remapping."""
+        return N.diff(self.cell_offset)
+
+    def nfaces(self):
+        """Return the total number of non-trivial faces of each remapping."""
+        return N.diff(self.face_offset[self.cell_offset])
+
+    def cells(self, i):
+        """Return the cell shifts of remapping i, and the list of face arrays
+        (one (nfaces,4) array per cell)."""
+        c0, c1 = self.cell_offset[i], self.cell_offset[i+1]
+        faces = [self.faces[self.face_offset[j]:self.face_offset[j+1]] for j in range(c0, c1)]
+        return self.cell_shift[c0:c1], faces
+
+    def cell_volumes(self):
+        """Return the volume of the part of the unit cube covered by each cell,
+        in the same order as cell_shift, as Cuboid.cell_volumes() would."""
+        v = N.empty(len(self.cell_shift))
+        for c0 in range(0, len(v), volume_block_size):
+            c1 = min(c0 + volume_block_size, len(v))
+            planes = [self.faces[self.face_offset[j]:self.face_offset[j+1]] for j in range(c0, c1)]
+            v[c0:c1] = clip.volumes(clip.clip_cubes(planes))
+        return v
+
+    def stats(self, sliver=sliver_volume):
+        """Return the statistics of Cuboid.stats() for all remappings, as a
+        dictionary of arrays."""
+        v = self.cell_volumes()
+        if len(v) == 0:
+            return {'ncells': self.ncells(), 'vmin': v, 'vmax': v, 'slivers': N.zeros(0, dtype=int)}
+        start = self.cell_offset[:-1]
+        return {'ncells': self.ncells(),
+                'vmin': N.minimum.reduceat(v, start),
+                'vmax': N.maximum.reduceat(v, start),
+                'slivers': N.add.reduceat((v < sliver).astype(int), start)}
+
+    def cuboid(self, i):
+        """Construct the Cuboid object for remapping i."""
+        u = self.u[i]
+        return Cuboid(u[0], u[1], u[2])
+
+
+if __name__ == '__main__':
+    # Print a summary table for a list of remappings
+    from catalog import read_text
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "in": params['in'] = str(val)
+            elif name == "processes": params['processes'] = int(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python cuboidtable.py in=list7.txt [processes=P]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    fin = open(params['in'], "r") if 'in' in params else sys.stdin
+    Nmax, R = read_text(fin)
+    T = CuboidTable(R['u'], params.get('processes'))
+    ncells = T.ncells()
+    nfaces = T.nfaces()
+    print "# L1 L2 L3   u11 u12 u13   u21 u22 u23   u31 u32 u33   ncells nfaces"
+    for i in range(len(T)):
+        print "%1.4f %1.4f %1.4f   %d %d %d   %d %d %d   %d %d %d   %d %d" % (tuple(T.L[i]) + tuple(T.u[i].ravel()) + (ncells[i], nfaces[i]))
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#
+# fieldremap.py
+#
+# Remap a field sampled on a regular mesh over the periodic unit cube (e.g. a
+# density or displacement mesh) onto a regular mesh covering the cuboid.
+# Rather than pushing every input voxel through Cuboid.Transform, each output
+# voxel is pulled back into the unit cube with the inverse map and the field
+# is gathered there, one slab of the output grid at a time.
+
+import sys
+import numpy as N
+from remap import Cuboid, abort
+
+# Default number of output voxels handled per slab
+slab_voxels = 1 << 20
+
+
+def cuboid_shape(C, n):
+    """Return the shape of an output mesh over the cuboid C with the same
+    resolution as an n^3 mesh over the unit cube."""
+    return tuple([max(1, int(round(L*n))) for L in (C.L1, C.L2, C.L3)])
+
+def output_dtype(field, order=1, vector=False):
+    """Return the dtype of the remapped mesh: that of the field, except that
+    an integer (or boolean) field becomes a float mesh when it is
+    interpolated (order 1) or rotated as a vector, so it is not truncated."""
+    dtype = N.dtype(field.dtype)
+    if (order >= 1 or vector) and dtype.kind not in 'fc':
+        dtype = N.dtype(float)
+    return dtype
+
+def _gather(field, x, order, centered):
+    """Sample the periodic mesh 'field' at the (...,3) unit cube positions x,
+    using nearest grid point (order=0) or trilinear (order=1) interpolation."""
+    n = N.array(field.shape[:3])
+    t = x*n
+    if centered:
+        t -= 0.5
+    if order == 0:
+        i = N.floor(t + 0.5).astype(int) % n
+        return field[i[...,0], i[...,1], i[...,2]]
+
+    i0 = N.floor(t)
+    f = t - i0
+    i0 = i0.astype(int) % n
+    i1 = (i0 + 1) % n
+    if field.ndim > 3:
+        # Broadcast the weights over the component axis
+        f = f.reshape(f.shape[:-1] + (1,)*(field.ndim - 3) + (3,))
+    fx, fy, fz = f[...,0], f[...,1], f[...,2]
+    gx, gy, gz = 1 - fx, 1 - fy, 1 - fz
+    a, b, c = i0[...,0], i0[...,1], i0[...,2]
+    A, B, C = i1[...,0], i1[...,1], i1[...,2]
+    return (gx*(gy*(gz*field[a,b,c] + fz*field[a,b,C])
+              + fy*(gz*field[a,B,c] + fz*field[a,B,C]))
+          + fx*(gy*(gz*field[A,b,c] + fz*field[A,b,C])
+              + fy*(gz*field[A,B,c] + fz*field[A,B,C])))
+
+def remap_field(C, field, shape=None, order=1, centered=True, vector=False, slab=None, out=None):
+    """Remap the periodic unit cube mesh 'field' onto the cuboid C.
+
+    'field' has shape (n0,n1,n2) or (n0,n1,n2,k) and may be a memory-mapped
+    array.  The output mesh has the given 'shape' (m1,m2,m3) along the cuboid
+    axes, defaulting to the resolution of the input mesh.  Samples sit at
+    voxel centres if 'centered' is true, otherwise at voxel corners.  If
+    'vector' is true, the trailing axis of length 3 is treated as a vector
+    (e.g. a displacement) and rotated into the cuboid basis (n1,n2,n3).
+
+    The output is computed 'slab' planes of axis 1 at a time, so only the
+    slab itself needs to fit in memory; pass a preallocated (or
+    memory-mapped) array as 'out' to bound memory for the result as well.
+    The result has the dtype given by output_dtype; an integer array given
+    as 'out' is rejected where that is a float type."""
+    if order not in (0, 1):
+        raise ValueError("interpolation order must be 0 (nearest) or 1 (trilinear)")
+    if vector and (field.ndim != 4 or field.shape[3] != 3):
+        raise ValueError("vector fields must have shape (n0,n1,n2,3)")
+    if shape is None:
+        shape = cuboid_shape(C, field.shape[0])
+    m1, m2, m3 = shape
+    dtype = output_dtype(field, order, vector)
+    if out is None:
+        out = N.empty(tuple(shape) + field.shape[3:], dtype=dtype)
+    elif dtype.kind == 'f' and out.dtype.kind not in 'fc':
+        raise ValueError("an interpolated or rotated field needs a floating-point output array, not %s" % out.dtype)
+    if slab is None:
+        slab = max(1, slab_voxels // (m2*m3))
+
+    # Cuboid coordinates of the output samples along each axis
+    s = 0.5 if centered else 0.0
+    n = N.array([C.n1, C.n2, C.n3])
+    p2 = ((N.arange(m2) + s)*(C.L2/m2))[:,None]*n[1]
+    p3 = ((N.arange(m3) + s)*(C.L3/m3))[:,None]*n[2]
+    p23 = p2[:,None,:] + p3[None,:,:]
+    for k in range(0, m1, slab):
+        r1 = (N.arange(k, min(k + slab, m1)) + s)*(C.L1/m1)
+        p = r1[:,None,None,None]*n[0] + p23[None,:,:,:]
+        x = N.fmod(p, 1)
+        x += (p < 0)
+        values = _gather(field, x, order, centered)
+        if vector:
+            values = N.dot(values, n.T)
+        out[k:k+len(r1)] = values
+    return out
+
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "u": params['u'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "shape": params['shape'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "order": params['order'] = int(val)
+            elif name == "slab": params['slab'] = int(val)
+            elif name == "in": params['in'] = str(val)
+            elif name == "out": params['out'] = str(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "--vector":
+                params['vector'] = True
+            elif arg == "--corners":
+                params['centered'] = False
+            elif arg == "-h" or arg == "--help":
+                print "Usage: python fieldremap.py in=mesh.npy out=cuboid.npy u=\"u11 ... u33\" [order=0|1] [shape=m1,m2,m3] [slab=N] [--vector] [--corners]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    if 'in' not in params or 'out' not in params:
+        abort("!! Both 'in' and 'out' mesh files (.npy) must be given")
+    u = params.get('u', [1,0,0, 0,1,0, 0,0,1])
+    if len(u) != 9: abort("!! Input matrix 'u' should have 9 components, not %d" % len(u))
+    C = Cuboid(u[0:3], u[3:6], u[6:9])
+
+    # Memory-map both meshes, so that only one slab is ever held in memory
+    field = N.load(params['in'], mmap_mode='r')
+    if field.ndim not in (3, 4):
+        abort("!! Input mesh should have 3 dimensions (or 4 for vector fields), not %d" % field.ndim)
+    shape = tuple(params.get('shape', cuboid_shape(C, field.shape[0])))
+    order = params.get('order', 1)
+    out = N.lib.format.open_memmap(params['out'], mode='w+', dtype=output_dtype(field, order, params.get('vector', False)), shape=shape + field.shape[3:])
+    remap_field(C, field, shape, order=order, centered=params.get('centered', True),
+                vector=params.get('vector', False), slab=params.get('slab'), out=out)
+    out.flush()
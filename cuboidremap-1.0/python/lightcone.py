@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# lightcone.py
+#
+# Build a mock lightcone from a series of snapshots in a single pass.  Each
+# snapshot is remapped to the cuboid a chunk at a time, and only particles
+# that fall in one of the radial shells assigned to that snapshot (distances
+# measured from an observer inside the cuboid) are kept, along with their
+# sky coordinates.  Nothing is written for the rest, so the output is a
+# small fraction of the size of the remapped snapshots.
+
+import sys
+import numpy as N
+from remap import Cuboid, abort
+
+# Default number of particles remapped per chunk
+chunk_size = 1 << 20
+
+
+def sky_coordinates(r, observer):
+    """Return the right ascension and declination (in degrees) and distance
+    of the (n,3) cuboid positions r as seen from the observer.  The cuboid
+    axes (n1,n2,n3) serve as the x, y and z axes of the sky frame."""
+    d = N.asarray(r) - N.asarray(observer, dtype=float)
+    dist = N.sqrt(N.sum(d*d, axis=1))
+    ra = N.degrees(N.arctan2(d[:,1], d[:,0])) % 360
+    dec = N.degrees(N.arcsin(N.clip(d[:,2]/N.where(dist > 0, dist, 1), -1, 1)))
+    return ra, dec, dist
+
+def distance_range(C, observer):
+    """Return the smallest and largest distance from the observer to any
+    point of the cuboid [0,L1]x[0,L2]x[0,L3]."""
+    o = N.asarray(observer, dtype=float)
+    L = N.array([C.L1, C.L2, C.L3])
+    near = o - N.clip(o, 0, L)
+    far = N.maximum(N.abs(o), N.abs(L - o))
+    return N.sqrt(N.sum(near**2)), N.sqrt(N.sum(far**2))
+
+def select_shells(C, x, observer, shells):
+    """Remap the (n,3) unit cube positions x and find the particles lying in
+    any of the shells, a list of (rmin, rmax) distance ranges (rmin <= dist <
+    rmax).  Returns the indices of the selected particles within x, their
+    cuboid positions, right ascension, declination and distance."""
+    r = C.transform_array(x)
+    ra, dec, dist = sky_coordinates(r, observer)
+    keep = N.zeros(len(r), dtype=bool)
+    for rmin, rmax in shells:
+        keep |= (dist >= rmin) & (dist < rmax)
+    k = N.nonzero(keep)[0]
+    return k, r[k], ra[k], dec[k], dist[k]
+
+def lightcone(C, snapshots, observer, boxsize=1.0, chunk=chunk_size):
+    """Generate the lightcone particles for a list of snapshots.
+
+    'snapshots' is a list of (snapshot, rmin, rmax) entries, where each
+    snapshot is an (n,3) array of positions in [0,boxsize)^3 (e.g. a
+    memory-mapped .npy file) and particles at distances rmin <= dist < rmax
+    from the observer are taken from it; a snapshot may appear in several
+    entries.  The observer position is in cuboid coordinates, and all
+    distances are in the same units as boxsize.  Yields one tuple (i, index,
+    r, ra, dec, dist) per chunk with selected particles, where i is the
+    position of the snapshot in the list (of its first entry), index the
+    particle indices within the snapshot, and r the cuboid positions.
+    Snapshots whose shells miss the cuboid entirely are not read at all."""
+    observer = N.asarray(observer, dtype=float)/boxsize
+    dmin, dmax = distance_range(C, observer)
+    groups = []
+    for i, (snapshot, rmin, rmax) in enumerate(snapshots):
+        rmin, rmax = rmin/float(boxsize), rmax/float(boxsize)
+        if rmax <= dmin or rmin > dmax or rmax <= rmin:
+            continue
+        for g in groups:
+            if g[1] is snapshot:
+                g[2].append((rmin, rmax))
+                break
+        else:
+            groups.append((i, snapshot, [(rmin, rmax)]))
+
+    for i, snapshot, shells in groups:
+        for start in range(0, len(snapshot), chunk):
+            x = N.asarray(snapshot[start:start+chunk], dtype=float)/boxsize
+            k, r, ra, dec, dist = select_shells(C, x, observer, shells)
+            if len(k) > 0:
+                yield i, start + k, boxsize*r, ra, dec, boxsize*dist
+
+def read_shells(f):
+    """Read a list of shells, one 'snapshot rmin rmax' line per shell, where
+    snapshot is the path of a .npy file of positions."""
+    shells = []
+    for line in f:
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        words = line.split()
+        if len(words) != 3:
+            raise ValueError("expecting 'snapshot rmin rmax', not '%s'" % line)
+        shells.append((words[0], float(words[1]), float(words[2])))
+    return shells
+
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "u": params['u'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "observer": params['observer'] = [float(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "boxsize": params['boxsize'] = float(val)
+            elif name == "chunk": params['chunk'] = int(val)
+            elif name == "shells": params['shells'] = str(val)
+            elif name == "out": params['out'] = str(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python lightcone.py u=\"u11 ... u33\" shells=shells.txt observer=\"r1 r2 r3\" [out=lightcone.txt] [boxsize=B] [chunk=N]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    if 'shells' not in params:
+        abort("!! A list of shells must be given")
+    u = params.get('u', [1,0,0, 0,1,0, 0,0,1])
+    if len(u) != 9: abort("!! Input matrix 'u' should have 9 components, not %d" % len(u))
+    observer = params.get('observer', [0,0,0])
+    if len(observer) != 3: abort("!! Observer position should have 3 components, not %d" % len(observer))
+    C = Cuboid(u[0:3], u[3:6], u[6:9])
+
+    # Memory-map each snapshot once; snapshots are numbered in order of
+    # first appearance in the shell list
+    shells = read_shells(open(params['shells'], "r"))
+    paths = []
+    files = {}
+    snapshots = []
+    for path, rmin, rmax in shells:
+        if path not in files:
+            paths.append(path)
+            files[path] = N.load(path, mmap_mode='r')
+        snapshots.append((files[path], rmin, rmax))
+
+    fout = open(params['out'], "w") if params.get('out', "stdout") != "stdout" else sys.stdout
+    for k, path in enumerate(paths):
+        print >> fout, "# snapshot %d = %s" % (k, path)
+    print >> fout, "# snapshot index r1 r2 r3 ra dec dist"
+    for i, index, r, ra, dec, dist in lightcone(C, snapshots, observer, params.get('boxsize', 1.0), params.get('chunk', chunk_size)):
+        snap = N.empty(len(index))
+        snap[:] = paths.index(shells[i][0])
+        N.savetxt(fout, N.column_stack((snap, index, r, ra, dec, dist)), fmt="%d %d %e %e %e %.8f %.8f %e")
+    fout.close()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+# loadgen.py
+#
+# Load generator for remapserver.py.  A number of client threads, each with
+# its own connection, send remapping requests of a fixed size as fast as
+# they can (or at a fixed rate) for a while, and the request latencies and
+# overall throughput are reported.
+
+import sys
+import time
+import threading
+import numpy as N
+from remap import abort
+from remapserver import RemapClient
+
+
+def percentile(x, q):
+    """The q-th percentile of the list of values x."""
+    x = sorted(x)
+    return x[min(len(x) - 1, int(q/100.0*len(x)))]
+
+def client(address, matrices, size, duration, rate, seed, latencies):
+    """Send requests of 'size' random points for random matrices from the
+    list, for 'duration' seconds, appending the latency of each request to
+    the list 'latencies'.  If rate is given, wait so as to send at most that
+    many requests per second."""
+    rs = N.random.RandomState(seed)
+    c = RemapClient(address)
+    t0 = time.time()
+    k = 0
+    while True:
+        t = time.time()
+        if t - t0 > duration:
+            break
+        if rate:
+            wait = t0 + k/rate - t
+            if wait > 0:
+                time.sleep(wait)
+                t = time.time()
+        c.transform(matrices[rs.randint(len(matrices))], rs.rand(size, 3))
+        latencies.append(time.time() - t)
+        k += 1
+    c.close()
+
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "socket": params['socket'] = str(val)
+            elif name == "port": params['port'] = int(val)
+            elif name == "clients": params['clients'] = int(val)
+            elif name == "size": params['size'] = int(val)
+            elif name == "duration": params['duration'] = float(val)
+            elif name == "rate": params['rate'] = float(val)
+            elif name == "u": params['u'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "list": params['list'] = str(val)
+            elif name == "matrices": params['matrices'] = int(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python loadgen.py [socket=PATH | port=N] [clients=8] [size=100] [duration=10] [rate=R] [u=\"u11 ... u33\" | list=list7.txt [matrices=K]]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    address = params['port'] if 'port' in params else params.get('socket', "/tmp/boxremap.sock")
+    if 'list' in params:
+        from catalog import read_text
+        matrices = list(read_text(open(params['list'], "r"))[1]['u'])
+        if 'matrices' in params:
+            matrices = matrices[:params['matrices']]
+    else:
+        matrices = [params.get('u', [1,1,0, 0,0,1, 1,0,0])]
+    if len(matrices) == 0:
+        abort("!! No remappings given")
+    nclients = params.get('clients', 8)
+    size = params.get('size', 100)
+    duration = params.get('duration', 10.0)
+    rate = params.get('rate')
+
+    latencies = [[] for i in range(nclients)]
+    threads = [threading.Thread(target=client, args=(address, matrices, size, duration, rate, i, latencies[i]))
+               for i in range(nclients)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+
+    latencies = sum(latencies, [])
+    if len(latencies) == 0:
+        abort("!! No requests completed")
+    print "%d clients, %d points per request, %d matrices" % (nclients, size, len(matrices))
+    print "requests: %d in %.2f s (%.1f requests/s, %.3g points/s)" % (len(latencies), elapsed, len(latencies)/elapsed, len(latencies)*size/elapsed)
+    print "latency: p50 %.3f ms, p99 %.3f ms, max %.3f ms" % (1e3*percentile(latencies, 50), 1e3*percentile(latencies, 99), 1e3*max(latencies))
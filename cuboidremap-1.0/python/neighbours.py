@@ -0,0 +1,129 @@
+#!/usr/bin/python
+#
+# neighbours.py
+#
+# Fixed-radius neighbour searches for remapped points.  The cuboid is only
+# periodic along lattice directions, so two points near opposite faces of the
+# cuboid may still be close together in the periodic unit cube.  Rather than
+# padding the cuboid with ghost copies of the points, the points are mapped
+# back to the unit cube and indexed there in a periodic cell list, which sees
+# every pair of neighbours exactly once.  Separations are rotated back into
+# the cuboid basis (n1,n2,n3), which preserves lengths.
+
+import sys
+from math import *
+import numpy as N
+from remap import Cuboid, abort
+
+# Largest number of cells along each side of the cell list
+max_cells = 256
+
+# Number of query points handled at a time
+query_block = 1 << 14
+
+
+class NeighbourIndex:
+    """Cell list over the unit cube positions of an (n,3) array of cuboid
+    positions r, for finding all points within a distance 'radius' (at most
+    1/2) of given positions.  Distances are measured in the periodic unit
+    cube, which is the same as in the cuboid for points whose separation is
+    a short vector inside the cuboid, and also finds neighbours across the
+    non-periodic faces of the cuboid."""
+
+    def __init__(self, C, r, radius):
+        if not 0 < radius <= 0.5:
+            raise ValueError("radius should be between 0 and 1/2, not %g" % radius)
+        self.C = C
+        self.radius = radius
+        self.M = N.array([C.n1, C.n2, C.n3]).T
+        self.r = N.asarray(r, dtype=float).reshape(-1, 3)
+        x = C.inverse_transform_array(self.r)
+        self.ncells = int(max(1, min(floor(1/radius), max_cells, ceil(2*len(x)**(1/3.0)))))
+        cell = self._cell(x)
+        self.order = N.argsort(cell, kind='mergesort')
+        self.x = x[self.order]
+        self.start = N.searchsorted(cell[self.order], N.arange(self.ncells**3 + 1))
+
+        # Offsets to the neighbouring cells, without repeats when there are
+        # fewer than 3 cells along a side
+        o = sorted(set([k % self.ncells for k in (-1, 0, 1)]))
+        self.offsets = N.array([(a, b, c) for a in o for b in o for c in o])
+
+    def _cell(self, x, offset=(0, 0, 0)):
+        m = self.ncells
+        i = N.minimum((x*m).astype(int), m - 1)
+        i = (i + offset) % m
+        return (i[:,0]*m + i[:,1])*m + i[:,2]
+
+    def query(self, q, radius=None):
+        """Find the indexed points within the given radius (at most the radius
+        of the index) of each of the (k,3) cuboid positions q.  Returns arrays
+        (i, j, d) with one entry per pair: the index i of the position in q,
+        the index j of the point in r, and the separation d = r[j] - q[i] in
+        the cuboid basis, for the nearest periodic image of r[j]."""
+        radius = self.radius if radius is None else radius
+        if radius > self.radius:
+            raise ValueError("query radius %g exceeds the index radius %g" % (radius, self.radius))
+        q = N.asarray(q, dtype=float).reshape(-1, 3)
+        results = []
+        for b in range(0, len(q), query_block):
+            results.append(self._query_block(q[b:b+query_block], radius, b))
+        if len(results) == 0:
+            return N.zeros(0, dtype=int), N.zeros(0, dtype=int), N.zeros((0, 3))
+        return [N.concatenate(a) for a in zip(*results)]
+
+    def _query_block(self, q, radius, base):
+        xq = self.C.inverse_transform_array(q)
+        ii, jj, dd = [], [], []
+        for offset in self.offsets:
+            c = self._cell(xq, offset)
+            n = self.start[c+1] - self.start[c]
+            i = N.repeat(N.arange(len(q)), n)
+            first = N.repeat(self.start[c] - N.cumsum(n) + n, n)
+            j = first + N.arange(len(i))
+            d = self.x[j] - xq[i]
+            d -= N.round(d)
+            near = N.sum(d*d, axis=1) <= radius*radius
+            ii.append(i[near] + base)
+            jj.append(self.order[j[near]])
+            dd.append(N.dot(d[near], self.M))
+        return N.concatenate(ii), N.concatenate(jj), N.concatenate(dd)
+
+    def pairs(self, radius=None):
+        """Find all pairs of indexed points within the given radius of each
+        other.  Returns arrays (i, j, d) with i < j and d = r[j] - r[i] as in
+        query()."""
+        i, j, d = self.query(self.r, radius)
+        keep = i < j
+        return i[keep], j[keep], d[keep]
+
+
+if __name__ == '__main__':
+    # Count the pairs of points within a given distance in a remapped catalog
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "u": params['u'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "in": params['in'] = str(val)
+            elif name == "radius": params['radius'] = float(val)
+            elif name == "boxsize": params['boxsize'] = float(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python neighbours.py in=cuboid.npy u=\"u11 ... u33\" radius=R [boxsize=B]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    if 'in' not in params or 'radius' not in params:
+        abort("!! Input file ('in') and radius ('radius') must be given")
+    u = params.get('u', [1,0,0, 0,1,0, 0,0,1])
+    if len(u) != 9: abort("!! Input matrix 'u' should have 9 components, not %d" % len(u))
+    boxsize = params.get('boxsize', 1.0)
+    C = Cuboid(u[0:3], u[3:6], u[6:9])
+    r = N.load(params['in'], mmap_mode='r')
+    I = NeighbourIndex(C, N.asarray(r, dtype=float)/boxsize, params['radius']/boxsize)
+    i, j, d = I.pairs()
+    print "%d points, %d pairs within %g" % (len(r), len(i), params['radius'])
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+#
+# packed.py
+#
+# Compact binary format for remapped positions.  Each coordinate is stored as
+# a fixed-point integer relative to the cuboid edge length (r_k/L_k scaled to
+# the chosen number of bits), and the points are split into blocks that are
+# filtered and compressed separately:
+#     header     '<8sIII8s3dI'  magic "BOXRPACK", format version, bits per
+#                               coordinate, filter flags (1 = delta, 2 =
+#                               shuffle), codec name, L1, L2, L3, block size
+#     blocks     compressed data, one block after another
+#     index      nblocks x '<QI'  file offset and number of points of each
+#                                 block
+#     trailer    '<QQQ8s'        index offset, number of blocks, total number
+#                                of points, magic
+# Within a block the three coordinates are stored one after the other; the
+# delta filter replaces each value by its difference from the previous one
+# (modulo the word size), which helps for spatially sorted points, and the
+# shuffle filter groups the bytes of each word by significance.  The index
+# lets a reader decode any range of points without touching the rest of the
+# file.
+
+import sys
+import struct
+import zlib
+import bz2
+import numpy as N
+from remap import Cuboid, abort
+
+magic = "BOXRPACK"
+version = 1
+header = struct.Struct('<8sIII8s3dI')
+index_entry = struct.Struct('<QI')
+trailer = struct.Struct('<QQQ8s')
+
+DELTA = 1
+SHUFFLE = 2
+
+codecs = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+          'bz2': (lambda data: bz2.compress(data, 9), bz2.decompress),
+          'none': (str, str)}
+
+# Default number of points per block
+block_size = 1 << 16
+
+
+def _word(bits):
+    """Smallest unsigned integer type holding the given number of bits."""
+    if bits <= 8:
+        return N.dtype(N.uint8)
+    elif bits <= 16:
+        return N.dtype('<u2')
+    elif bits <= 32:
+        return N.dtype('<u4')
+    raise ValueError("at most 32 bits per coordinate are supported, not %d" % bits)
+
+def quantize(r, L, bits):
+    """Convert the (n,3) cuboid positions r to fixed-point integers: the
+    integer parts of r_k/L_k*2^bits, clipped to [0, 2^bits - 1]."""
+    scale = 2.0**bits/N.asarray(L, dtype=float)
+    q = N.floor(N.asarray(r, dtype=float)*scale)
+    return N.clip(q, 0, 2.0**bits - 1).astype(_word(bits))
+
+def dequantize(q, L, bits):
+    """Convert fixed-point integers back to cuboid positions, at the centres
+    of their quantization intervals."""
+    return (q + 0.5)*(N.asarray(L, dtype=float)/2.0**bits)
+
+def encode_block(q, filters, codec):
+    """Filter and compress an (n,3) array of fixed-point integers."""
+    q = N.ascontiguousarray(q.T)
+    if filters & DELTA:
+        q[:,1:] = N.diff(q, axis=1)
+    b = q.view(N.uint8).reshape(3, q.shape[1], q.itemsize)
+    if filters & SHUFFLE:
+        b = b.transpose(2, 0, 1)
+    return codecs[codec][0](N.ascontiguousarray(b).tostring())
+
+def decode_block(data, n, word, filters, codec):
+    """Decompress and unfilter a block of n points, as written by
+    encode_block.  Returns an (n,3) array of fixed-point integers."""
+    b = N.frombuffer(codecs[codec][1](data), dtype=N.uint8)
+    if filters & SHUFFLE:
+        b = b.reshape(word.itemsize, 3, n).transpose(1, 2, 0)
+    q = N.ascontiguousarray(b).view(word).reshape(3, n)
+    if filters & DELTA:
+        q = N.cumsum(q, axis=1, dtype=word)
+    return q.T
+
+
+class PackedWriter:
+    """Writes remapped positions to a packed file.  Points are added with
+    write() in chunks of any size, and buffered into blocks."""
+
+    def __init__(self, f, L, bits=16, codec='zlib', filters=DELTA|SHUFFLE, block=block_size):
+        """Start a packed file on the open file f (or path) for positions in
+        the cuboid with dimensions L = (L1,L2,L3)."""
+        if codec not in codecs:
+            raise ValueError("unknown codec '%s'" % codec)
+        self.f = open(f, "wb") if isinstance(f, str) else f
+        self.L = tuple([float(x) for x in L])
+        self.bits = bits
+        self.word = _word(bits)
+        self.codec = codec
+        self.filters = filters
+        self.block = block
+        self.buffer = []
+        self.nbuffer = 0
+        self.index = []
+        self.count = 0
+        self.f.write(header.pack(magic, version, bits, filters, codec, self.L[0], self.L[1], self.L[2], block))
+
+    def write(self, r):
+        """Add the (n,3) cuboid positions r."""
+        q = quantize(r, self.L, self.bits)
+        self.buffer.append(q)
+        self.nbuffer += len(q)
+        if self.nbuffer >= self.block:
+            q = N.concatenate(self.buffer)
+            full = len(q) - len(q) % self.block
+            for i in range(0, full, self.block):
+                self._write_block(q[i:i+self.block])
+            self.buffer = [q[full:]]
+            self.nbuffer = len(q) - full
+
+    def _write_block(self, q):
+        self.index.append((self.f.tell(), len(q)))
+        self.f.write(encode_block(q, self.filters, self.codec))
+        self.count += len(q)
+
+    def close(self):
+        """Write the remaining points and the index, and close the file."""
+        if self.nbuffer > 0:
+            self._write_block(N.concatenate(self.buffer))
+        self.buffer = []
+        self.nbuffer = 0
+        offset = self.f.tell()
+        for entry in self.index:
+            self.f.write(index_entry.pack(*entry))
+        self.f.write(trailer.pack(offset, len(self.index), self.count, magic))
+        self.f.close()
+
+
+class PackedReader:
+    """Reads a packed file, decoding blocks on demand.  len() gives the
+    number of points, and read(start, stop) decodes a range of them."""
+
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        fields = header.unpack(self.f.read(header.size))
+        if fields[0] != magic:
+            raise ValueError("'%s' is not a packed position file" % path)
+        if fields[1] != version:
+            raise ValueError("unsupported packed file version %d" % fields[1])
+        self.bits, self.filters = fields[2], fields[3]
+        self.codec = fields[4].rstrip('\0')
+        self.L = fields[5:8]
+        self.block = fields[8]
+        self.word = _word(self.bits)
+        self.f.seek(-trailer.size, 2)
+        offset, nblocks, self.count, m = trailer.unpack(self.f.read(trailer.size))
+        if m != magic:
+            raise ValueError("'%s' is truncated" % path)
+        self.f.seek(offset)
+        index = N.frombuffer(self.f.read(nblocks*index_entry.size), dtype=[('offset', '<u8'), ('count', '<u4')])
+        self.offsets = N.append(index['offset'], offset).astype(N.int64)
+        self.starts = N.append(0, N.cumsum(index['count'])).astype(N.int64)
+
+    def __len__(self):
+        return int(self.count)
+
+    def nblocks(self):
+        return len(self.starts) - 1
+
+    def read_block(self, i, quantized=False):
+        """Decode block i, returning positions (or their fixed-point integer
+        form, if quantized is true)."""
+        self.f.seek(self.offsets[i])
+        data = self.f.read(self.offsets[i+1] - self.offsets[i])
+        q = decode_block(data, int(self.starts[i+1] - self.starts[i]), self.word, self.filters, self.codec)
+        return q if quantized else dequantize(q, self.L, self.bits)
+
+    def read(self, start=0, stop=None, quantized=False):
+        """Decode the points with indices start <= i < stop."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if stop <= start:
+            return N.empty((0, 3), dtype=self.word if quantized else float)
+        b0 = N.searchsorted(self.starts, start, side='right') - 1
+        b1 = N.searchsorted(self.starts, stop, side='left')
+        q = N.concatenate([self.read_block(i, quantized=True) for i in range(b0, b1)])
+        q = q[start - self.starts[b0]:stop - self.starts[b0]]
+        return q if quantized else dequantize(q, self.L, self.bits)
+
+    def close(self):
+        self.f.close()
+
+
+if __name__ == '__main__':
+    # Decode a packed file to text
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "in": params['in'] = str(val)
+            elif name == "out": params['out'] = str(val)
+            elif name == "start": params['start'] = int(val)
+            elif name == "stop": params['stop'] = int(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python packed.py in=remapped.pack [out=remapped.txt] [start=I] [stop=J]"
+                sys.exit(0)
+            elif arg == "--info":
+                params['info'] = True
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    if 'in' not in params:
+        abort("!! A packed input file must be given")
+    P = PackedReader(params['in'])
+    if params.get('info'):
+        print "points = %d, blocks = %d, bits = %d, codec = %s, filters = %d" % (len(P), P.nblocks(), P.bits, P.codec, P.filters)
+        print "L = %g %g %g" % P.L
+        sys.exit(0)
+    fout = open(params['out'], "w") if params.get('out', "stdout") != "stdout" else sys.stdout
+    start = params.get('start', 0)
+    stop = params.get('stop', len(P))
+    for b in range(P.nblocks()):
+        b0, b1 = max(P.starts[b], start), min(P.starts[b+1], stop)
+        if b0 < b1:
+            N.savetxt(fout, P.read(b0, b1), fmt="%e")
+    fout.close()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+#
+# pipeline.py
+#
+# Remap many files with the same Cuboid, overlapping reading, remapping and
+# writing.  A reader thread, a transform thread and a writer thread pass
+# chunks of points to each other through bounded queues, so the next chunk
+# is read from disk while the current one is remapped and the previous one
+# written.  Numpy (and file I/O) release the GIL, so the stages run in
+# parallel.  Each stage records how long it was busy, which shows whether a
+# run is limited by I/O or by the remapping itself.
+
+import sys
+import time
+import threading
+import Queue
+import numpy as N
+
+# Default number of points per chunk
+chunk_size = 1 << 18
+
+# Default number of chunks that may wait between two stages
+queue_depth = 4
+
+
+def read_chunks(path, chunk=chunk_size):
+    """Read the points in the file at path, in (n,3) arrays of at most
+    'chunk' points.  The file is either an (n,3) .npy array or a text file
+    with 3 coordinates per line, like the input of remap.py."""
+    if path.endswith(".npy"):
+        pos = N.load(path, mmap_mode='r')
+        for i in range(0, len(pos), chunk):
+            yield N.array(pos[i:i+chunk], dtype=float)
+        return
+    f = open(path, "r")
+    points = []
+    for line in f:
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        coords = line.replace(',', ' ').split()
+        if len(coords) != 3:
+            print >> sys.stderr, "?? Expecting 3 coordinates per line, not '%s'" % line
+            continue
+        points.append([float(c) for c in coords])
+        if len(points) == chunk:
+            yield N.array(points)
+            points = []
+    f.close()
+    if len(points) > 0:
+        yield N.array(points)
+
+
+class _Output:
+    """Output file for remapped points: an .npy array of n points, or text
+    in the format of remap.py."""
+
+    def __init__(self, path, n=None):
+        self.npy = path.endswith(".npy")
+        if self.npy:
+            self.n = 0
+            if n == 0:
+                N.save(path, N.zeros((0, 3)))
+                self.r = None
+            else:
+                self.r = N.lib.format.open_memmap(path, mode='w+', dtype=float, shape=(n, 3))
+        else:
+            self.f = open(path, "w")
+
+    def write(self, r):
+        if self.npy:
+            self.r[self.n:self.n+len(r)] = r
+            self.n += len(r)
+        else:
+            N.savetxt(self.f, r, fmt="%e")
+
+    def close(self):
+        if self.npy:
+            if self.r is not None:
+                self.r.flush()
+            self.r = None
+        else:
+            self.f.close()
+
+
+def remap_files(C, pairs, chunk=chunk_size, depth=queue_depth, threads=None):
+    """Remap the points in each input file of the list of (inpath, outpath)
+    pairs with the Cuboid C, writing them to the output file.  .npy inputs
+    give .npy outputs, and text inputs text outputs.  The transform stage
+    passes threads on to C.transform_array.  Returns a dictionary with the
+    elapsed time 'wall' and the time each stage was busy, 'read',
+    'transform' and 'write' (excluding time spent waiting for the other
+    stages)."""
+    for inpath, outpath in pairs:
+        if inpath.endswith(".npy") != outpath.endswith(".npy"):
+            raise ValueError("'%s' and '%s' should both be .npy files, or both text files" % (inpath, outpath))
+    busy = {'read': 0.0, 'transform': 0.0, 'write': 0.0}
+    errors = []
+    loaded = Queue.Queue(depth)
+    remapped = Queue.Queue(depth)
+
+    # Each queue carries (i, points) items for file i, then (i, None) when
+    # file i is complete, then None after the last file
+    def reader():
+        try:
+            for i, (inpath, outpath) in enumerate(pairs):
+                chunks = read_chunks(inpath, chunk)
+                while len(errors) == 0:
+                    t = time.time()
+                    x = next(chunks, None)
+                    busy['read'] += time.time() - t
+                    if x is None:
+                        break
+                    loaded.put((i, x))
+                loaded.put((i, None))
+                if len(errors) > 0:
+                    break
+        except Exception:
+            errors.append(sys.exc_info())
+        loaded.put(None)
+
+    def transformer():
+        while True:
+            item = loaded.get()
+            if item is None:
+                break
+            i, x = item
+            if x is not None and len(errors) == 0:
+                try:
+                    t = time.time()
+                    x = C.transform_array(x, threads=threads)
+                    busy['transform'] += time.time() - t
+                except Exception:
+                    errors.append(sys.exc_info())
+            remapped.put((i, x))
+        remapped.put(None)
+
+    def writer():
+        out = None
+        while True:
+            item = remapped.get()
+            if item is None:
+                break
+            i, r = item
+            if len(errors) > 0:
+                continue
+            try:
+                t = time.time()
+                if out is None:
+                    inpath, outpath = pairs[i]
+                    n = len(N.load(inpath, mmap_mode='r')) if inpath.endswith(".npy") else None
+                    out = _Output(outpath, n)
+                if r is None:
+                    out.close()
+                    out = None
+                else:
+                    out.write(r)
+                busy['write'] += time.time() - t
+            except Exception:
+                errors.append(sys.exc_info())
+
+    start = time.time()
+    stages = [threading.Thread(target=f) for f in (reader, transformer, writer)]
+    for s in stages:
+        s.start()
+    for s in stages:
+        s.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    busy['wall'] = time.time() - start
+    return busy
+
+def utilization_report(times):
+    """Describe the stage times returned by remap_files."""
+    wall = max(times['wall'], 1e-9)
+    stages = ", ".join(["%s %.0f%%" % (s, 100*times[s]/wall) for s in ('read', 'transform', 'write')])
+    bound = max(('read', 'transform', 'write'), key=lambda s: times[s])
+    return "%.2f s; busy: %s (limited by %s)" % (times['wall'], stages, bound)
@@ -3,10 +3,45 @@
 # remap.py
 
 import sys
+import time
+import threading
 from math import *
 
 verbose = False
 
+# Points in no cell, but within this distance of the nearest one (through
+# rounding in the plane tests on a cell face), are placed in that cell
+boundary_tolerance = 1e-10
+
+# Cells covering less than this fraction of the unit cube count as slivers
+sliver_volume = 1e-3
+
+# Number of points handled at a time by Cuboid.transform_array
+transform_block = 1 << 16
+
+# Number of points generated at a time by Cuboid.random_points
+random_chunk = 1 << 20
+
+# Compiled kernel module (remapjit), loaded on first use if Numba is installed
+_jit = None
+
+# Number of fractional bits of fixed-point unit cube coordinates
+fixed_bits = 32
+
+# Number of voxels along each side of the cell lookup table of the 'lookup'
+# engine, and the margin by which the cells left out of a voxel must fail
+lookup_grid = 32
+lookup_margin = 1e-9
+
+# Transform engines for Cuboid.transform_array, by name (see register_engine)
+engines = {}
+engine_order = []
+
+# Number of random points, and of repetitions, timed for each engine by
+# Cuboid.calibrate
+calibration_points = 1 << 14
+calibration_repeat = 3
+
 
 try:
     # Use fast vec3 implementation if Numpy is available
@@ -127,6 +162,11 @@ class Cell:
                 return False
         return True
 
+    def margin(self, x, y, z):
+        """Return the smallest of the face tests of a point, which is negative
+        if the point is outside the cell."""
+        return min([f.test(x,y,z) for f in self.faces] + [float('inf')])
+
     
 def UnitCubeTest(P):
     """Return +1, 0, or -1 if the unit cube is above, below, or intersecting the plane."""
@@ -144,14 +184,18 @@ def UnitCubeTest(P):
 class Cuboid:
     """Cuboid remapping class."""
 
-    def __init__(self, u1=(1,0,0), u2=(0,1,0), u3=(0,0,1)):
-        """Initialize by passing a 3x3 invertible integer matrix."""
+    def __init__(self, u1=(1,0,0), u2=(0,1,0), u3=(0,0,1), engine=None):
+        """Initialize by passing a 3x3 invertible integer matrix.  The
+        optional engine becomes the default engine of transform_array; with
+        engine='auto', the fastest engine for this remapping is chosen by
+        calibrate()."""
         u1 = vec3(u1)
         u2 = vec3(u2)
         u3 = vec3(u3)
 
         if triple_scalar_product(u1, u2, u3) != 1:
             print >> sys.stderr, "!! Invalid lattice vectors: u1 = %s, u2 = %s, u3 = %s" % (u1,u2,u3)
+            self.u = ((1,0,0), (0,1,0), (0,0,1))
             self.e1 = vec3(1,0,0)
             self.e2 = vec3(0,1,0)
             self.e3 = vec3(0,0,1)
@@ -164,6 +208,7 @@ class Cuboid:
             alpha = -d12/s1
             gamma = -(alpha*d13 + d23)/(alpha*d12 + s2)
             beta = -(d13 + gamma*d12)/s1
+            self.u = tuple([tuple([int(round(c)) for c in v]) for v in (u1, u2, u3)])
             self.e1 = u1
             self.e2 = u2 + alpha*u1
             self.e3 = u3 + beta*u1 + gamma*u2
@@ -255,15 +300,32 @@ class Cuboid:
             for c in self.cells:
                 print "Cell at (%d,%d,%d) has %d non-trivial planes" % (c.ix, c.iy, c.iz, len(c.faces))
 
+        # Choose the default transform engine
+        self.engine = None
+        self.calibration = {}
+        if engine == 'auto':
+            self.engine = self.calibrate()['engine']
+        elif engine is not None:
+            if engine not in engines:
+                raise ValueError("unknown engine '%s'" % engine)
+            self.engine = engine
+
     def Transform(self, x, y, z):
         for c in self.cells:
             if c.contains(x,y,z):
-                x += c.ix
-                y += c.iy
-                z += c.iz
-                p = vec3(x,y,z)
-                return (dot(p, self.n1), dot(p, self.n2), dot(p, self.n3))
-        raise RuntimeError, "(%g, %g, %g) not contained in any cell" % (x,y,z)
+                break
+        else:
+            # Points on a cell face may fail the plane tests of every cell
+            # through rounding; use the cell they are closest to
+            margins = [c.margin(x,y,z) for c in self.cells]
+            c = self.cells[margins.index(max(margins))]
+            if max(margins) < -boundary_tolerance:
+                raise RuntimeError, "(%g, %g, %g) not contained in any cell" % (x,y,z)
+        x += c.ix
+        y += c.iy
+        z += c.iz
+        p = vec3(x,y,z)
+        return (dot(p, self.n1), dot(p, self.n2), dot(p, self.n3))
 
     def InverseTransform(self, r1, r2, r3):
         p = r1*self.n1 + r2*self.n2 + r3*self.n3
@@ -272,6 +334,458 @@ class Cuboid:
         x3 = fmod(p[2], 1) + (p[2] < 0)
         return vec3(x1, x2, x3)
 
+    def transform_array(self, x, v=None, threads=None, out=None, engine=None):
+        """Array version of Transform (requires Numpy): map an (n,3) array of
+        unit cube positions to cuboid coordinates.  Each point goes to the
+        first cell containing it, with the same plane tests and arithmetic as
+        Transform, so the results agree exactly.  If an (n,3) array of
+        velocities (or any other vectors) v is given, they are rotated into
+        the cuboid basis (n1,n2,n3) as well, and both arrays are returned.
+
+        The points are handled in blocks of transform_block points, which
+        are divided among the given number of threads; Numpy releases the
+        GIL for the arithmetic, so threads run in parallel.  The result is
+        written to out (an (n,3) float array) if given.
+
+        The engine may be 'numpy' (array operations), 'numba' (a compiled
+        per-point kernel, see remapjit.py), 'lookup' (only the cells listed
+        for the voxel of each point are tested, see cell_lookup), 'fixed'
+        (exact integer cell membership tests on fixed-point coordinates, see
+        fixed_point_bounds), any other engine added with register_engine,
+        or 'auto', the fastest engine for this remapping and (roughly) this
+        number of points, as found by calibrate().  By default the engine
+        given to the constructor is used, or else Numba if it is installed.
+        With Numba and no thread count, the 'numba' and 'lookup' kernels
+        handle the whole array in parallel.  A uint32 array x holds
+        fixed-point coordinates (see to_fixed), and is handled by the
+        'fixed' engine by default."""
+        x = N.asarray(x)
+        fixed = (x.dtype == N.uint32)
+        if engine is None:
+            engine = 'fixed' if fixed else self.default_engine()
+        elif engine == 'auto':
+            engine = 'fixed' if fixed else self._auto_engine(len(x))
+        if engine not in engines:
+            raise ValueError("unknown engine '%s'" % engine)
+        if not engines[engine][1]():
+            raise ValueError("the '%s' engine is not available%s" % (engine, " (it requires Numba)" if engine == 'numba' else ""))
+        if fixed and engine != 'fixed':
+            x = from_fixed(x)
+        x = N.ascontiguousarray(x, dtype=N.uint32 if fixed and engine == 'fixed' else float).reshape(-1, 3)
+        r = N.empty(x.shape) if out is None else out
+        if v is not None:
+            v = N.asarray(v, dtype=float).reshape(-1, 3)
+            w = N.empty_like(v)
+            M = N.array([self.n1, self.n2, self.n3]).T
+        if engine in ('numba', 'lookup') and threads is None and _jit_kernel() is not None:
+            engines[engine][0](self, x, r, parallel=True)
+            if v is not None:
+                N.dot(v, M, out=w)
+        else:
+            transform = engines[engine][0]
+            def block(i0, i1):
+                transform(self, x[i0:i1], r[i0:i1])
+                if v is not None:
+                    w[i0:i1] = N.dot(v[i0:i1], M)
+            _run_blocks(block, len(x), transform_block, threads)
+        if v is None:
+            return r
+        return r, w
+
+    def default_engine(self):
+        """Return the name of the engine transform_array uses for float
+        positions when none is given."""
+        if self.engine is not None:
+            return self.engine
+        return 'numba' if _jit_kernel() is not None else 'numpy'
+
+    def calibrate(self, batch=calibration_points, repeat=calibration_repeat):
+        """Time transform_array on 'batch' random points with each available
+        engine that engine='auto' may choose (requires Numpy), taking the
+        best of 'repeat' runs.  Returns a dictionary with the fastest engine
+        'engine', the number of points 'batch' and the time in seconds of
+        each engine 'timings', which is also kept in self.calibration (by
+        batch size), so it is saved along with the Cuboid."""
+        x = N.random.RandomState(0).rand(batch, 3)
+        timings = {}
+        for name in engine_order:
+            transform, available, auto = engines[name]
+            if not auto or not available():
+                continue
+            self.transform_array(x[:1], engine=name)    # compile or set up, untimed
+            best = None
+            for k in range(repeat):
+                t0 = time.time()
+                self.transform_array(x, engine=name)
+                dt = time.time() - t0
+                best = dt if best is None else min(best, dt)
+            timings[name] = best
+        engine = min([name for name in engine_order if name in timings], key=lambda name: timings[name])
+        self.calibration[batch] = {'engine': engine, 'batch': batch, 'timings': timings}
+        return self.calibration[batch]
+
+    def _auto_engine(self, n):
+        """Return the engine calibrated as fastest for about n points,
+        calibrating for the nearest power of 2 (between calibration_points
+        and transform_block) if needed."""
+        batch = calibration_points
+        while batch < min(n, transform_block):
+            batch *= 2
+        if batch not in self.calibration:
+            self.calibrate(batch)
+        return self.calibration[batch]['engine']
+
+    def cell_arrays(self):
+        """Return the cells as arrays (requires Numpy): the (ncells,6,4)
+        array of face coefficients (a,b,c,d), of which the first nfaces[c]
+        rows are used for cell c, the array nfaces, and the (ncells,3)
+        array of cell shifts (ix,iy,iz)."""
+        planes = N.zeros((len(self.cells), 6, 4))
+        nfaces = N.zeros(len(self.cells), dtype=int)
+        shifts = N.zeros((len(self.cells), 3), dtype=int)
+        for i, c in enumerate(self.cells):
+            nfaces[i] = len(c.faces)
+            shifts[i] = (c.ix, c.iy, c.iz)
+            for k, f in enumerate(c.faces):
+                planes[i,k] = (f.a, f.b, f.c, f.d)
+        return planes, nfaces, shifts
+
+    def _transform_jit(self, x, r, parallel=False):
+        """Transform the (n,3) positions x into r with the compiled kernel."""
+        if not hasattr(self, '_cell_arrays'):
+            self._cell_arrays = self.cell_arrays()
+        planes, nfaces, shifts = self._cell_arrays
+        found = N.empty(len(x), dtype=bool)
+        kernel = _jit_kernel().transform_parallel if parallel else _jit_kernel().transform_serial
+        kernel(x, planes, nfaces, shifts, N.array([self.n1, self.n2, self.n3]), boundary_tolerance, r, found)
+        if not N.all(found):
+            p = x[N.nonzero(~found)[0][0]]
+            raise RuntimeError, "(%g, %g, %g) not contained in any cell" % (p[0], p[1], p[2])
+
+    def fixed_point_bounds(self):
+        """Return the exact integer form of the cell membership tests used
+        by the 'fixed' engine (requires Numpy).
+
+        A point q lies in the closed cuboid if 0 <= E1.q <= s1, 0 <= E2.q <=
+        |E2|^2/s1 and 0 <= E3.q <= 1, for the integer normals E1 = u1, E2 =
+        s1*u2 - d12*u1 and E3 = u1 x u2 (parallel to e1, e2 and e3), with s1
+        = u1.u1 and d12 = u1.u2.  For a fixed-point position X (x scaled by
+        2^fixed_bits) and cell shift (ix,iy,iz), q = x + (ix,iy,iz), so the
+        tests become lo[c] <= A <= hi[c] for the integers A_k = E_k.X.
+        Returns E as a (3,3) array and the bounds lo and hi as (ncells,3)
+        arrays, all int64."""
+        u1, u2, u3 = self.u
+        def idot(a, b):
+            return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+        s1, d12 = idot(u1, u1), idot(u1, u2)
+        E = [u1,
+             [s1*u2[k] - d12*u1[k] for k in range(3)],
+             [u1[1]*u2[2] - u1[2]*u2[1], u1[2]*u2[0] - u1[0]*u2[2], u1[0]*u2[1] - u1[1]*u2[0]]]
+        one = 1 << fixed_bits
+        H = [s1*one, (idot(E[1], E[1])*one)//s1, one]
+        lo = [[-idot(E[k], (c.ix, c.iy, c.iz))*one for k in range(3)] for c in self.cells]
+        hi = [[lo[i][k] + H[k] for k in range(3)] for i in range(len(self.cells))]
+        bound = max([sum([abs(e) for e in E[k]])*one + max([abs(b) for b in hi[i] + lo[i]]) for i in range(len(lo)) for k in range(3)])
+        if bound >= 1 << 62:
+            raise ValueError("matrix too large for fixed-point cell tests")
+        return N.array(E, dtype=N.int64), N.array(lo, dtype=N.int64), N.array(hi, dtype=N.int64)
+
+    def _transform_fixed(self, x, r):
+        """Transform the (n,3) positions x (floats, or fixed-point uint32
+        coordinates) into r, using exact integer membership tests."""
+        if not hasattr(self, '_fixed_bounds'):
+            self._fixed_bounds = self.fixed_point_bounds()
+        E, lo, hi = self._fixed_bounds
+        X = x if x.dtype == N.uint32 else to_fixed(x)
+        X0, X1, X2 = [X[:,j].astype(N.int64) for j in range(3)]
+        A0, A1, A2 = [X0*E[k,0] + X1*E[k,1] + X2*E[k,2] for k in range(3)]
+        q = from_fixed(X)
+        todo = N.arange(len(X))
+        for i, c in enumerate(self.cells):
+            if len(todo) == 0:
+                break
+            inside = (A0 >= lo[i,0]) & (A0 <= hi[i,0])
+            inside &= (A1 >= lo[i,1]) & (A1 <= hi[i,1])
+            inside &= (A2 >= lo[i,2]) & (A2 <= hi[i,2])
+            k = todo[inside]
+            px, py, pz = q[k,0] + c.ix, q[k,1] + c.iy, q[k,2] + c.iz
+            for j, n in enumerate((self.n1, self.n2, self.n3)):
+                r[k,j] = px*n[0] + py*n[1] + pz*n[2]
+            rest = N.nonzero(~inside)[0]
+            todo, A0, A1, A2 = todo[rest], A0[rest], A1[rest], A2[rest]
+        if len(todo) > 0:
+            p = q[todo[0]]
+            raise RuntimeError, "(%g, %g, %g) not contained in any cell" % (p[0], p[1], p[2])
+
+    def cell_lookup(self, grid=lookup_grid, margin=lookup_margin):
+        """Return the cell lookup table of the 'lookup' engine (requires
+        Numpy).  The unit cube is divided into grid^3 voxels, and for each
+        voxel (numbered (i*grid + j)*grid + k) the candidate cells are those
+        whose plane tests may pass somewhere in it; every other cell fails
+        them by more than margin, so Transform never picks it.  The plane
+        tests are linear, so their largest value over a voxel is found
+        separately along each axis.  Returns a (grid^3,m) int32 array of the
+        candidates of each voxel, in cell order and padded with -1, and the
+        number of candidates of each voxel."""
+        lo = N.arange(grid)/float(grid)
+        hi = (N.arange(grid) + 1)/float(grid)
+        possible = N.ones((len(self.cells), grid, grid, grid), dtype=bool)
+        for i, c in enumerate(self.cells):
+            for f in c.faces:
+                t = [N.maximum(a*lo, a*hi) for a in (f.a, f.b, f.c)]
+                possible[i] &= (t[0][:,None,None] + t[1][None,:,None] + t[2][None,None,:] + f.d >= -margin)
+        possible = possible.reshape(len(self.cells), -1).T
+        ncand = N.sum(possible, axis=1)
+        voxel, cell = N.nonzero(possible)
+        start = N.concatenate(([0], N.cumsum(ncand)))
+        cand = N.empty((grid**3, max(1, ncand.max())), dtype=N.int32)
+        cand.fill(-1)
+        cand[voxel, N.arange(len(voxel)) - start[voxel]] = cell
+        return cand, ncand.astype(N.int32)
+
+    def _transform_lookup(self, x, r, parallel=False):
+        """Transform the (n,3) positions x into r, testing only the candidate
+        cells of the voxel of each point (see cell_lookup), with the compiled
+        kernel if Numba is installed.  Points that pass none of these tests
+        are handled as by the other engines."""
+        if not hasattr(self, '_lookup'):
+            self._lookup = self.cell_lookup()
+        if not hasattr(self, '_cell_arrays'):
+            self._cell_arrays = self.cell_arrays()
+        cand, ncand = self._lookup
+        planes, nfaces, shifts = self._cell_arrays
+        grid = int(round(len(cand)**(1/3.0)))
+        if _jit_kernel() is not None:
+            found = N.empty(len(x), dtype=bool)
+            kernel = _jit_kernel().lookup_parallel if parallel else _jit_kernel().lookup_serial
+            kernel(x, planes, nfaces, shifts, N.array([self.n1, self.n2, self.n3]), grid, cand, ncand, r, found)
+            rest = N.nonzero(~found)[0]
+        else:
+            v = N.floor(x*grid).astype(int)
+            incube = N.all((v >= 0) & (v < grid), axis=1)
+            voxel = (v[:,0]*grid + v[:,1])*grid + v[:,2]
+            todo = N.nonzero(incube)[0]
+            rest = [N.nonzero(~incube)[0]]
+            for k in range(cand.shape[1]):
+                if len(todo) == 0:
+                    break
+                cell = cand[voxel[todo],k]
+                rest.append(todo[cell < 0])
+                todo, cell = todo[cell >= 0], cell[cell >= 0]
+                px, py, pz = x[todo,0], x[todo,1], x[todo,2]
+                inside = N.ones(len(todo), dtype=bool)
+                p = planes[cell]
+                for f in range(planes.shape[1]):
+                    inside &= (p[:,f,0]*px + p[:,f,1]*py + p[:,f,2]*pz + p[:,f,3] >= 0) | (f >= nfaces[cell])
+                k = N.nonzero(inside)[0]
+                s = shifts[cell[k]]
+                px, py, pz = px[k] + s[:,0], py[k] + s[:,1], pz[k] + s[:,2]
+                for j, n in enumerate((self.n1, self.n2, self.n3)):
+                    r[todo[k],j] = px*n[0] + py*n[1] + pz*n[2]
+                todo = todo[~inside]
+            rest = N.sort(N.concatenate(rest + [todo]))
+        if len(rest) > 0:
+            rr = N.empty((len(rest), 3))
+            self._transform_block(x[rest], rr)
+            r[rest] = rr
+
+    def _transform_block(self, x, r):
+        """Transform the (n,3) positions x, writing the result to r."""
+        todo = N.arange(len(x))
+        for c in self.cells:
+            if len(todo) == 0:
+                break
+            px, py, pz = x[todo,0], x[todo,1], x[todo,2]
+            inside = N.ones(len(todo), dtype=bool)
+            t = N.empty(len(todo))
+            s = N.empty(len(todo))
+            for f in c.faces:
+                # t = f.a*px + f.b*py + f.c*pz + f.d, without temporaries
+                N.multiply(px, f.a, t)
+                t += N.multiply(py, f.b, s)
+                t += N.multiply(pz, f.c, s)
+                t += f.d
+                inside &= (t >= 0)
+            k = N.nonzero(inside)[0]
+            px, py, pz = px[k], py[k], pz[k]
+            px += c.ix
+            py += c.iy
+            pz += c.iz
+            for j, n in enumerate((self.n1, self.n2, self.n3)):
+                r[todo[k],j] = px*n[0] + py*n[1] + pz*n[2]
+            todo = todo[~inside]
+        if len(todo) > 0:
+            self._transform_nearest(x[todo], todo, r)
+
+    def _transform_nearest(self, x, todo, r):
+        """Transform the (n,3) positions x, which failed the plane tests of
+        every cell, with the cell closest to each (as Transform does), writing
+        the result to r[todo]."""
+        best = N.empty(len(x), dtype=int)
+        bestmargin = N.empty(len(x))
+        bestmargin.fill(-N.inf)
+        for i, c in enumerate(self.cells):
+            m = N.empty(len(x))
+            m.fill(N.inf)
+            for f in c.faces:
+                m = N.minimum(m, f.a*x[:,0] + f.b*x[:,1] + f.c*x[:,2] + f.d)
+            closer = m > bestmargin
+            best[closer] = i
+            bestmargin[closer] = m[closer]
+        if N.any(bestmargin < -boundary_tolerance):
+            p = x[N.nonzero(bestmargin < -boundary_tolerance)[0][0]]
+            raise RuntimeError, "(%g, %g, %g) not contained in any cell" % (p[0], p[1], p[2])
+        shifts = N.array([(c.ix, c.iy, c.iz) for c in self.cells])[best]
+        px, py, pz = x[:,0] + shifts[:,0], x[:,1] + shifts[:,1], x[:,2] + shifts[:,2]
+        for j, n in enumerate((self.n1, self.n2, self.n3)):
+            r[todo,j] = px*n[0] + py*n[1] + pz*n[2]
+
+    def inverse_transform_array(self, r):
+        """Array version of InverseTransform (requires Numpy): map an (n,3)
+        array of cuboid coordinates back to the unit cube."""
+        p = N.dot(N.asarray(r, dtype=float), N.array([self.n1, self.n2, self.n3]))
+        x = N.fmod(p, 1)
+        x += (p < 0)
+        return x
+
+    def random_points(self, n, seed=None, chunk=random_chunk, preimages=False):
+        """Generate n points uniformly distributed in the cuboid
+        [0,L1)x[0,L2)x[0,L3) (requires Numpy), in (chunk,3) arrays (the
+        last one may be shorter).  The remapping preserves volume, so these
+        are distributed just like remapped uniform points in the unit cube,
+        but no cell tests are needed.  The seed is passed to Numpy's
+        RandomState.  If preimages is true, each chunk is a pair (r, x) of
+        the cuboid positions and the unit cube positions that remap to
+        them, found with inverse_transform_array."""
+        rs = N.random.RandomState(seed)
+        L = N.array([self.L1, self.L2, self.L3])
+        for i in range(0, n, chunk):
+            r = rs.random_sample((min(chunk, n - i), 3))
+            r *= L
+            if preimages:
+                yield r, self.inverse_transform_array(r)
+            else:
+                yield r
+
+    def cell_volumes(self):
+        """Return the volume of the part of the unit cube covered by each cell
+        (requires Numpy).  The volumes add up to 1."""
+        import clip
+        planes = [[(f.a, f.b, f.c, f.d) for f in c.faces] for c in self.cells]
+        return clip.volumes(clip.clip_cubes(planes))
+
+    def stats(self, sliver=sliver_volume):
+        """Return a dictionary of statistics about how the unit cube is divided
+        into cells (requires Numpy): the number of cells 'ncells', the
+        smallest and largest cell volumes 'vmin' and 'vmax', and the number
+        of sliver cells 'slivers', covering less than the fraction sliver of
+        the unit cube.  Cells that only touch the unit cube have zero volume
+        and are counted as slivers.  The default engine of transform_array
+        is given as 'engine', and the results of calibrate(), if it was
+        run, as 'calibration'."""
+        v = self.cell_volumes()
+        s = {'ncells': len(v), 'vmin': v.min(), 'vmax': v.max(), 'slivers': int(N.sum(v < sliver)),
+             'engine': self.default_engine()}
+        if len(self.calibration) > 0:
+            s['calibration'] = self.calibration
+        return s
+
+
+def to_fixed(x):
+    """Convert unit cube coordinates to fixed-point form (requires Numpy):
+    the integer parts of x*2^fixed_bits, as uint32 (values of exactly 1 are
+    rounded down to the largest fixed-point value).  Raises ValueError for
+    coordinates outside [0,1]."""
+    x = N.asarray(x, dtype=float)
+    if x.size > 0 and not (x.min() >= 0 and x.max() <= 1):
+        raise ValueError("coordinates outside the unit cube cannot be converted to fixed point")
+    return N.minimum(N.floor(x*2.0**fixed_bits), 2.0**fixed_bits - 1).astype(N.uint32)
+
+def from_fixed(X):
+    """Convert fixed-point unit cube coordinates back to floats."""
+    return N.asarray(X)*2.0**-fixed_bits
+
+def _jit_kernel():
+    """Return the remapjit module if Numba is installed, or None."""
+    global _jit
+    if _jit is None:
+        try:
+            import remapjit
+            _jit = remapjit if remapjit.available else False
+        except ImportError:
+            _jit = False
+    return _jit or None
+
+def register_engine(name, transform, available=None, auto=True):
+    """Add a transform engine for Cuboid.transform_array.  transform(C, x, r)
+    should remap the (n,3) positions x with the Cuboid C, writing the result
+    to r, and raise RuntimeError for a point that is in no cell.
+    available() tells whether the engine can be used (by default it always
+    can), and auto whether engine='auto' may choose it, which should only be
+    the case if its results agree exactly with Transform."""
+    if name not in engines:
+        engine_order.append(name)
+    engines[name] = (transform, available or (lambda: True), auto)
+
+register_engine('numpy', Cuboid._transform_block)
+register_engine('numba', Cuboid._transform_jit, lambda: _jit_kernel() is not None)
+register_engine('lookup', Cuboid._transform_lookup)
+register_engine('fixed', Cuboid._transform_fixed, auto=False)
+
+def _run_blocks(func, n, block, threads=None):
+    """Call func(i0, i1) for consecutive blocks [i0,i1) of at most 'block'
+    elements covering range(n), spread over the given number of threads.  An
+    exception raised in any thread is raised again in the caller."""
+    blocks = [(i, min(i + block, n)) for i in range(0, n, block)]
+    if threads is None or threads <= 1 or len(blocks) <= 1:
+        for i0, i1 in blocks:
+            func(i0, i1)
+        return
+    lock = threading.Lock()
+    queue = iter(blocks)
+    errors = []
+    def worker():
+        while len(errors) == 0:
+            lock.acquire()
+            try:
+                b = next(queue, None)
+            finally:
+                lock.release()
+            if b is None:
+                return
+            try:
+                func(*b)
+            except Exception:
+                errors.append(sys.exc_info())
+    workers = [threading.Thread(target=worker) for k in range(min(threads, len(blocks)))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def edge_vectors(u):
+    """Array version of the edge vector calculation in Cuboid.__init__
+    (requires Numpy): return the (n,3,3) array of edge vectors (e1,e2,e3) for
+    an (n,9) or (n,3,3) array of invertible integer matrices."""
+    u = N.asarray(u, dtype=float).reshape(-1, 3, 3)
+    u1, u2, u3 = u[:,0], u[:,1], u[:,2]
+    s1 = N.sum(u1*u1, axis=1)
+    s2 = N.sum(u2*u2, axis=1)
+    d12 = N.sum(u1*u2, axis=1)
+    d23 = N.sum(u2*u3, axis=1)
+    d13 = N.sum(u1*u3, axis=1)
+    alpha = -d12/s1
+    gamma = -(alpha*d13 + d23)/(alpha*d12 + s2)
+    beta = -(d13 + gamma*d12)/s1
+    e = N.empty_like(u)
+    e[:,0] = u1
+    e[:,1] = u2 + alpha[:,None]*u1
+    e[:,2] = u3 + beta[:,None]*u1 + gamma[:,None]*u2
+    return e
+
 
 def abort(msg=None, code=1):
     if msg:
@@ -293,6 +807,15 @@ if __name__ == '__main__':
             elif name == "u3": params['u3'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
             elif name == "in": params['in'] = str(val)
             elif name == "out": params['out'] = str(val)
+            elif name == "bits": params['bits'] = int(val)
+            elif name == "codec": params['codec'] = str(val)
+            elif name == "sort": params['sort'] = str(val)
+            elif name == "sortbits": params['sortbits'] = int(val)
+            elif name == "prefix": params['prefix'] = int(val)
+            elif name == "files": params['files'] = str(val)
+            elif name == "chunk": params['chunk'] = int(val)
+            elif name == "depth": params['depth'] = int(val)
+            elif name == "threads": params['threads'] = int(val)
             else: abort("Unrecognized parameter '%s'" % name)
         else:
             if arg == "-v" or arg == "--verbose":
@@ -302,17 +825,38 @@ if __name__ == '__main__':
             else:
                 abort("Unrecognized option '%s'" % arg)
 
+    # Several files are remapped by a pipeline, after the Cuboid is set up
+    pairs = None
+    if 'files' in params:
+        pairs = [line.split() for line in open(params['files']) if len(line.split()) > 0 and not line.startswith('#')]
+        if len([p for p in pairs if len(p) != 2]) > 0:
+            abort("!! Each line of '%s' should hold an input and an output file name" % params['files'])
+    elif 'in' in params and len(set(params['in']) & set("*?[")) > 0:
+        import glob
+        import os.path
+        if '%s' not in params.get('out', ''):
+            abort("!! Output file name should contain %s for the input file name")
+        pairs = [(f, params['out'] % os.path.basename(f)) for f in sorted(glob.glob(params['in']))]
+    if pairs is not None and ('bits' in params or 'sort' in params):
+        abort("!! Packed or sorted output (bits=... or sort=...) is written for one input file at a time")
+
     # Open input and output files
-    if 'in' not in params or params['in'] == "stdin":
-        fin = sys.stdin
-    else:
-        fin = open(params['in'], "r")
-        if not fin: abort("Could not open input file '%s'" % params['in'])
-    if 'out' not in params or params['out'] == "stdout":
-        fout = sys.stdout
-    else:
-        fout = open(params['out'], "w")
-        if not fout: abort("!! Could not open output file '%s'" % params['out'])
+    if pairs is None:
+        if 'in' not in params or params['in'] == "stdin":
+            fin = sys.stdin
+        else:
+            fin = open(params['in'], "r")
+            if not fin: abort("Could not open input file '%s'" % params['in'])
+        if 'bits' in params or 'sort' in params:
+            if 'out' not in params or params['out'] == "stdout":
+                abort("!! Packed or sorted output (bits=... or sort=...) must be written to a file")
+            if params.get('sort', 'hilbert') not in ('morton', 'hilbert'):
+                abort("!! Unknown curve '%s' (use sort=morton or sort=hilbert)" % params['sort'])
+        if 'out' not in params or params['out'] == "stdout":
+            fout = sys.stdout
+        elif 'bits' not in params:
+            fout = open(params['out'], "w")
+            if not fout: abort("!! Could not open output file '%s'" % params['out'])
 
     # Initialize remapping
     if 'm' in params and 'n' in params:
@@ -341,6 +885,59 @@ if __name__ == '__main__':
         print "u1 = %s, u2 = %s, u3 = %s" % (u1,u2,u3)
     C = Cuboid(u1, u2, u3)
 
+    if pairs is not None:
+        import pipeline
+        times = pipeline.remap_files(C, pairs, params.get('chunk', pipeline.chunk_size), params.get('depth', pipeline.queue_depth), params.get('threads'))
+        print >> sys.stderr, "Remapped %d files in %s" % (len(pairs), pipeline.utilization_report(times))
+        sys.exit(0)
+
+    if 'bits' in params or 'sort' in params:
+        # Remap chunks of points at once
+        import packed
+        def chunks():
+            chunk = []
+            for line in fin:
+                line = line.strip()
+                if len(line) == 0 or line.startswith('#'):
+                    continue
+                coords = line.replace(',', ' ').split()
+                if len(coords) != 3:
+                    print >> sys.stderr, "?? Expecting 3 coordinates per line, not '%s'" % line
+                    continue
+                chunk.append([float(c) for c in coords])
+                if len(chunk) == packed.block_size:
+                    yield C.transform_array(chunk)
+                    chunk = []
+            if len(chunk) > 0:
+                yield C.transform_array(chunk)
+        blocks = chunks()
+
+        # Optionally sort along a space-filling curve, and index the output
+        # by key prefix
+        if 'sort' in params:
+            import spatialsort
+            L = (C.L1, C.L2, C.L3)
+            index = spatialsort.KeyIndex(L, params['sort'], params.get('sortbits', spatialsort.curve_bits), params.get('prefix', 12))
+            def sorted_blocks(unsorted):
+                for keys, r, order in spatialsort.sort_chunks(unsorted, L, index.curve, index.bits):
+                    index.add(keys)
+                    yield r
+            blocks = sorted_blocks(blocks)
+
+        if 'bits' in params:
+            writer = packed.PackedWriter(params['out'], (C.L1, C.L2, C.L3), params['bits'], params.get('codec', 'zlib'))
+            for r in blocks:
+                writer.write(r)
+            writer.close()
+        else:
+            for r in blocks:
+                N.savetxt(fout, r, fmt="%e")
+            fout.close()
+        if 'sort' in params:
+            index.save(params['out'] + ".index.npz")
+        fin.close()
+        sys.exit(0)
+
     for line in fin:
         line = line.strip()
         if len(line) == 0 or line.startswith('#'):
@@ -0,0 +1,91 @@
+# remapjit.py
+#
+# Compiled per-point kernel for Cuboid.transform_array, used automatically
+# when Numba is installed.  Each point is tested against the faces of one
+# cell after another, stopping at the first failed test and the first cell
+# that contains it (as Cell.contains and Cuboid.Transform do), so unlike the
+# array version no temporaries are created for points that have already
+# been placed.  The arithmetic is the same as in Transform, in the same
+# order, so the results agree exactly.  A second kernel, for the 'lookup'
+# engine, only tests the candidate cells of the voxel of each point.
+
+import numpy
+
+try:
+    import numba
+    available = True
+except ImportError:
+    available = False
+
+
+def _transform(x, planes, nplanes, shifts, n, tolerance, r, found):
+    """Transform the (m,3) positions x into r, given the cell faces as an
+    (ncells,6,4) array 'planes' of which the first nplanes[c] rows are used
+    for cell c, the (ncells,3) cell shifts and the rows (n1,n2,n3) of n.
+    Points in no cell go to the cell whose plane tests they fail by the
+    least, if that is at most 'tolerance'.  found[i] is set to whether point
+    i was placed in any cell."""
+    for i in numba.prange(x.shape[0]):
+        px, py, pz = x[i,0], x[i,1], x[i,2]
+        found[i] = False
+        for c in range(planes.shape[0]):
+            inside = True
+            for k in range(nplanes[c]):
+                if not (planes[c,k,0]*px + planes[c,k,1]*py + planes[c,k,2]*pz + planes[c,k,3] >= 0):
+                    inside = False
+                    break
+            if inside:
+                qx, qy, qz = px + shifts[c,0], py + shifts[c,1], pz + shifts[c,2]
+                for j in range(3):
+                    r[i,j] = qx*n[j,0] + qy*n[j,1] + qz*n[j,2]
+                found[i] = True
+                break
+        if not found[i]:
+            best = 0
+            bestmargin = -numpy.inf
+            for c in range(planes.shape[0]):
+                m = numpy.inf
+                for k in range(nplanes[c]):
+                    m = min(m, planes[c,k,0]*px + planes[c,k,1]*py + planes[c,k,2]*pz + planes[c,k,3])
+                if m > bestmargin:
+                    best = c
+                    bestmargin = m
+            if bestmargin >= -tolerance:
+                qx, qy, qz = px + shifts[best,0], py + shifts[best,1], pz + shifts[best,2]
+                for j in range(3):
+                    r[i,j] = qx*n[j,0] + qy*n[j,1] + qz*n[j,2]
+                found[i] = True
+
+def _transform_lookup(x, planes, nplanes, shifts, n, grid, cand, ncand, r, found):
+    """Transform the (m,3) positions x into r like _transform, but test only
+    the ncand[v] candidate cells cand[v] of the voxel v of each point (see
+    Cuboid.cell_lookup).  found[i] is set to whether point i passed the
+    tests of one of them; the other points are left to _transform."""
+    for i in numba.prange(x.shape[0]):
+        px, py, pz = x[i,0], x[i,1], x[i,2]
+        found[i] = False
+        vx, vy, vz = numpy.floor(px*grid), numpy.floor(py*grid), numpy.floor(pz*grid)
+        if not (vx >= 0 and vx < grid and vy >= 0 and vy < grid and vz >= 0 and vz < grid):
+            continue
+        v = (int(vx)*grid + int(vy))*grid + int(vz)
+        for l in range(ncand[v]):
+            c = cand[v,l]
+            inside = True
+            for k in range(nplanes[c]):
+                if not (planes[c,k,0]*px + planes[c,k,1]*py + planes[c,k,2]*pz + planes[c,k,3] >= 0):
+                    inside = False
+                    break
+            if inside:
+                qx, qy, qz = px + shifts[c,0], py + shifts[c,1], pz + shifts[c,2]
+                for j in range(3):
+                    r[i,j] = qx*n[j,0] + qy*n[j,1] + qz*n[j,2]
+                found[i] = True
+                break
+
+if available:
+    # Parallel version for whole arrays, and a serial one that releases the
+    # GIL, for blocks handled by the threads of transform_array
+    transform_parallel = numba.njit(parallel=True, nogil=True, cache=True)(_transform)
+    transform_serial = numba.njit(nogil=True, cache=True)(_transform)
+    lookup_parallel = numba.njit(parallel=True, nogil=True, cache=True)(_transform_lookup)
+    lookup_serial = numba.njit(nogil=True, cache=True)(_transform_lookup)
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+#
+# remapserver.py
+#
+# A long-running local remapping service, for interactive tools that remap
+# many small batches of points and would otherwise pay the cost of starting
+# Python and constructing a Cuboid for each one.  Clients connect over a
+# Unix socket (or a TCP port on localhost) and send binary requests:
+#     header   '<I9iI'   operation (0 = Transform, 1 = InverseTransform),
+#                        matrix coefficients u11 ... u33, number of points n
+#     data     n x 3 float64 (little-endian) positions
+# and receive binary responses:
+#     header   '<iI'     status (0 = ok), number of points n (or the length of
+#                        the error message)
+#     data     n x 3 float64 remapped positions (or the error message)
+# Several requests may be sent over one connection.  Cuboids for recently
+# used matrices are kept in an LRU cache, and requests arriving at about the
+# same time are coalesced into larger batches for each matrix, so that many
+# concurrent clients cost little more than one.
+
+import os
+import sys
+import stat
+import time
+import struct
+import socket
+import threading
+import Queue
+import SocketServer
+from collections import OrderedDict
+import numpy as N
+from remap import Cuboid, triple_scalar_product, vec3, abort
+
+request_header = struct.Struct('<I9iI')
+response_header = struct.Struct('<iI')
+
+TRANSFORM = 0
+INVERSE_TRANSFORM = 1
+
+# Number of Cuboid objects kept in the cache
+cache_size = 64
+
+# Longest time (in seconds) a request waits for others to share its batch
+batch_wait = 0.0005
+
+# Largest number of points in a coalesced batch
+batch_points = 1 << 20
+
+
+class CuboidCache:
+    """Cuboid objects for the most recently used matrices (an LRU cache)."""
+
+    def __init__(self, size=None):
+        self.size = size or cache_size
+        self.cuboids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, u):
+        """Return the Cuboid for the matrix u (a tuple of 9 integers),
+        constructing it if necessary.  Raises ValueError if u is not a valid
+        remapping matrix."""
+        self.lock.acquire()
+        try:
+            C = self.cuboids.pop(u, None)
+        finally:
+            self.lock.release()
+        if C is None:
+            if triple_scalar_product(vec3(u[0:3]), vec3(u[3:6]), vec3(u[6:9])) != 1:
+                raise ValueError("invalid lattice vectors %s" % (u,))
+            C = Cuboid(u[0:3], u[3:6], u[6:9])
+        self.lock.acquire()
+        try:
+            self.cuboids[u] = C
+            while len(self.cuboids) > self.size:
+                self.cuboids.popitem(last=False)
+        finally:
+            self.lock.release()
+        return C
+
+
+class Request:
+    """A pending request, completed by the batcher."""
+
+    def __init__(self, op, u, points):
+        self.op = op
+        self.u = u
+        self.points = points
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def _compute(C, op, points):
+    if op == TRANSFORM:
+        return C.transform_array(points)
+    elif op == INVERSE_TRANSFORM:
+        return C.inverse_transform_array(points)
+    raise ValueError("unknown operation %d" % op)
+
+class Batcher(threading.Thread):
+    """Worker thread that coalesces concurrent requests.  It takes the first
+    queued request, collects whatever else arrives within batch_wait (up to
+    batch_points points in all), and handles all requests for the same
+    operation and matrix with a single array operation."""
+
+    def __init__(self, cache):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cache = cache
+        self.queue = Queue.Queue()
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, request):
+        self.queue.put(request)
+        request.done.wait()
+        return request
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            npoints = len(pending[0].points)
+            deadline = time.time() + batch_wait
+            while npoints < batch_points:
+                try:
+                    timeout = deadline - time.time()
+                    r = self.queue.get(timeout > 0, max(timeout, 0))
+                except Queue.Empty:
+                    break
+                pending.append(r)
+                npoints += len(r.points)
+
+            groups = OrderedDict()
+            for r in pending:
+                groups.setdefault((r.op, r.u), []).append(r)
+            for (op, u), requests in groups.items():
+                self._run_group(op, u, requests)
+            self.batches += len(groups)
+            self.requests += len(pending)
+
+    def _run_group(self, op, u, requests):
+        try:
+            C = self.cache.get(u)
+            if len(requests) == 1:
+                requests[0].result = _compute(C, op, requests[0].points)
+            else:
+                result = _compute(C, op, N.concatenate([r.points for r in requests]))
+                start = 0
+                for r in requests:
+                    r.result = result[start:start+len(r.points)]
+                    start += len(r.points)
+        except Exception, e:
+            if len(requests) > 1:
+                # Retry one by one, so that only the offending requests fail
+                for r in requests:
+                    self._run_group(op, u, [r])
+                return
+            requests[0].error = str(e)
+        for r in requests:
+            r.done.set()
+
+
+def _recv(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise EOFError
+    return data
+
+class RemapHandler(SocketServer.StreamRequestHandler):
+    """Serve requests on one connection until the client hangs up."""
+
+    def handle(self):
+        while True:
+            try:
+                header = _recv(self.rfile, request_header.size)
+            except EOFError:
+                return
+            fields = request_header.unpack(header)
+            op, u, n = fields[0], tuple(fields[1:10]), fields[10]
+            points = N.frombuffer(_recv(self.rfile, 24*n), dtype='<f8').reshape(n, 3)
+            r = self.server.batcher.submit(Request(op, u, points))
+            if r.error is not None:
+                self.wfile.write(response_header.pack(1, len(r.error)) + r.error)
+            else:
+                data = N.ascontiguousarray(r.result, dtype='<f8').tostring()
+                self.wfile.write(response_header.pack(0, len(r.result)) + data)
+            self.wfile.flush()
+
+class RemapTCPHandler(RemapHandler):
+    disable_nagle_algorithm = True
+
+
+class RemapServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Remapping server listening on a Unix socket."""
+    daemon_threads = True
+
+    def __init__(self, path):
+        # Remove a socket left by an earlier server, but nothing else
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ValueError("'%s' exists and is not a socket; not removing it" % path)
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, RemapHandler)
+        self.batcher = Batcher(CuboidCache())
+        self.batcher.start()
+
+class RemapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Remapping server listening on a TCP port on localhost."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", port), RemapTCPHandler)
+        self.batcher = Batcher(CuboidCache())
+        self.batcher.start()
+
+
+class RemapClient:
+    """Client for a remapping server, given the path of its Unix socket or
+    its TCP port on localhost."""
+
+    def __init__(self, address):
+        if isinstance(address, int):
+            self.sock = socket.create_connection(("127.0.0.1", address))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.rfile = self.sock.makefile('rb')
+
+    def _call(self, op, u, points):
+        u = [int(x) for x in N.ravel(u)]
+        if len(u) != 9:
+            raise ValueError("matrix should have 9 components, not %d" % len(u))
+        points = N.ascontiguousarray(points, dtype='<f8').reshape(-1, 3)
+        self.sock.sendall(request_header.pack(op, *(u + [len(points)])) + points.tostring())
+        status, n = response_header.unpack(_recv(self.rfile, response_header.size))
+        if status != 0:
+            raise RuntimeError(_recv(self.rfile, n))
+        return N.frombuffer(_recv(self.rfile, 24*n), dtype='<f8').reshape(n, 3)
+
+    def transform(self, u, x):
+        """Remap the (n,3) unit cube positions x to the cuboid for matrix u."""
+        return self._call(TRANSFORM, u, x)
+
+    def inverse_transform(self, u, r):
+        """Map the (n,3) cuboid positions r back to the unit cube."""
+        return self._call(INVERSE_TRANSFORM, u, r)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "socket": params['socket'] = str(val)
+            elif name == "port": params['port'] = int(val)
+            elif name == "cache": cache_size = int(val)
+            elif name == "wait": batch_wait = float(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python remapserver.py [socket=PATH | port=N] [cache=N] [wait=SECONDS]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    if 'port' in params:
+        server = RemapTCPServer(params['port'])
+        print >> sys.stderr, "Listening on 127.0.0.1:%d" % params['port']
+    else:
+        path = params.get('socket', "/tmp/boxremap.sock")
+        try:
+            server = RemapServer(path)
+        except ValueError, e:
+            abort("!! %s" % e)
+        print >> sys.stderr, "Listening on %s" % path
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    b = server.batcher
+    print >> sys.stderr, "Served %d requests in %d batches" % (b.requests, b.batches)
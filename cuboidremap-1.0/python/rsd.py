@@ -0,0 +1,108 @@
+#!/usr/bin/python
+#
+# rsd.py
+#
+# Remap positions to the cuboid and move them to redshift space in the same
+# pass.  Velocities are rotated into the cuboid basis (n1,n2,n3) alongside
+# the positions, each particle is displaced along the line of sight (either
+# a fixed cuboid axis or the direction from an observer), and particles
+# displaced out of the cuboid are brought back to their periodic image
+# inside it.
+
+import sys
+import numpy as N
+from remap import Cuboid, abort
+
+# Default number of particles handled per chunk
+chunk_size = 1 << 20
+
+
+def wrap(C, r):
+    """Replace the (n,3) cuboid positions r that lie outside the cuboid
+    [0,L1)x[0,L2)x[0,L3) by their periodic images inside it, in place.  The
+    cuboid is only periodic along directions that are lattice vectors, so
+    this is done by mapping the points back to the unit cube and remapping
+    them, rather than by wrapping each coordinate separately."""
+    L = N.array([C.L1, C.L2, C.L3])
+    out = N.nonzero(N.any((r < 0) | (r >= L), axis=1))[0]
+    if len(out) > 0:
+        r[out] = C.transform_array(C.inverse_transform_array(r[out]))
+    return r
+
+def redshift_space(C, x, v, scale, axis=2, observer=None):
+    """Remap the (n,3) unit cube positions x to the cuboid and displace them
+    by their velocities v along the line of sight, which is the cuboid axis
+    n1, n2 or n3 (axis=0, 1 or 2) in the plane-parallel approximation, or
+    the direction from the observer (a position in cuboid coordinates) if
+    one is given.  A velocity v is converted to a displacement scale*v, so
+    scale is 1/(aH) in the units of the positions and velocities.  Returns
+    the redshift-space positions in the cuboid and the rotated velocities."""
+    r, w = C.transform_array(x, v)
+    if observer is None:
+        r[:,axis] += scale*w[:,axis]
+    else:
+        d = r - N.asarray(observer, dtype=float)
+        dist = N.sqrt(N.sum(d*d, axis=1))
+        los = d/N.where(dist > 0, dist, 1)[:,None]
+        r += (scale*N.sum(w*los, axis=1))[:,None]*los
+    return wrap(C, r), w
+
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "u": params['u'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "scale": params['scale'] = float(val)
+            elif name == "axis": params['axis'] = int(val)
+            elif name == "observer": params['observer'] = [float(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "boxsize": params['boxsize'] = float(val)
+            elif name == "chunk": params['chunk'] = int(val)
+            elif name == "in": params['in'] = str(val)
+            elif name == "vel": params['vel'] = str(val)
+            elif name == "out": params['out'] = str(val)
+            elif name == "velout": params['velout'] = str(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python rsd.py in=pos.npy vel=vel.npy out=rsd.npy u=\"u11 ... u33\" scale=S [axis=1|2|3 | observer=\"r1 r2 r3\"] [velout=vel.npy] [boxsize=B] [chunk=N]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    if 'in' not in params or 'vel' not in params or 'out' not in params:
+        abort("!! Position ('in'), velocity ('vel') and output ('out') files (.npy) must be given")
+    if 'scale' not in params:
+        abort("!! The velocity scale factor 'scale' must be given")
+    u = params.get('u', [1,0,0, 0,1,0, 0,0,1])
+    if len(u) != 9: abort("!! Input matrix 'u' should have 9 components, not %d" % len(u))
+    axis = params.get('axis', 3)
+    if axis not in (1, 2, 3): abort("!! Line of sight axis should be 1, 2 or 3, not %d" % axis)
+    boxsize = params.get('boxsize', 1.0)
+    observer = params.get('observer')
+    if observer is not None:
+        if len(observer) != 3: abort("!! Observer position should have 3 components, not %d" % len(observer))
+        observer = N.array(observer)/boxsize
+    C = Cuboid(u[0:3], u[3:6], u[6:9])
+
+    # Memory-map inputs and outputs, so that only one chunk is ever held in memory
+    pos = N.load(params['in'], mmap_mode='r')
+    vel = N.load(params['vel'], mmap_mode='r')
+    if pos.shape != vel.shape or pos.ndim != 2 or pos.shape[1] != 3:
+        abort("!! Positions and velocities should be (n,3) arrays of the same shape")
+    out = N.lib.format.open_memmap(params['out'], mode='w+', dtype=pos.dtype, shape=pos.shape)
+    velout = None
+    if 'velout' in params:
+        velout = N.lib.format.open_memmap(params['velout'], mode='w+', dtype=vel.dtype, shape=vel.shape)
+    chunk = params.get('chunk', chunk_size)
+    for start in range(0, len(pos), chunk):
+        x = N.asarray(pos[start:start+chunk], dtype=float)/boxsize
+        r, w = redshift_space(C, x, vel[start:start+chunk], params['scale']/boxsize, axis - 1, observer)
+        out[start:start+len(r)] = boxsize*r
+        if velout is not None:
+            velout[start:start+len(w)] = w
+    out.flush()
+    if velout is not None:
+        velout.flush()
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# shard.py
+#
+# Remap positions to the cuboid and split them into K slabs along one of the
+# cuboid axes in the same pass.  Each chunk of remapped points is bucketed by
+# destination slab and appended to one shard file per slab, through a buffer
+# per shard, so the shards are ready for parallel processing without a
+# separate scatter pass over the remapped points.  With several worker
+# processes, each worker remaps its own range of the input once, into its own
+# part file of every shard, and each shard is then described by a small index
+# listing its parts in order, so the remapped points are never read again.
+
+import os
+import sys
+import struct
+import multiprocessing
+import numpy as N
+from remap import Cuboid, abort
+
+# Default number of particles remapped per chunk
+chunk_size = 1 << 20
+
+# Default number of points buffered per shard before it is written
+buffer_size = 1 << 16
+
+# Length of the .npy headers written for shard files, fixed so that the
+# header can be rewritten in place once the number of points is known
+header_size = 128
+
+
+def slab_index(r, L, nslabs, axis=0):
+    """Return the slab (0 <= k < nslabs) containing each of the (n,3) cuboid
+    positions r, for slabs of equal thickness along the given cuboid axis
+    (0, 1 or 2) of the cuboid with edges L = (L1,L2,L3)."""
+    k = N.floor(N.asarray(r)[:,axis]*(nslabs/float(L[axis])))
+    return N.clip(k, 0, nslabs - 1).astype(int)
+
+def _write_header(f, n, dtype=float):
+    """Write the header of an .npy file holding an (n,3) array, padded to
+    header_size bytes, at the start of the open file f."""
+    d = "{'descr': %r, 'fortran_order': False, 'shape': (%d, 3), }" % (N.dtype(dtype).str, n)
+    d = d + ' '*(header_size - 10 - 1 - len(d)) + '\n'
+    f.seek(0)
+    f.write('\x93NUMPY\x01\x00' + struct.pack('<H', len(d)) + d)
+
+
+class ShardWriter:
+    """Append points to nshards files of raw positions, keeping a buffer of
+    up to 'buffer' points per shard.  If header is true, the files are .npy
+    files whose headers are brought up to date by close()."""
+
+    def __init__(self, paths, buffer=buffer_size, header=True, dtype=float):
+        self.paths = list(paths)
+        self.buffer = buffer
+        self.header = header
+        self.dtype = N.dtype(dtype)
+        self.files = [open(p, "wb") for p in self.paths]
+        if header:
+            for f in self.files:
+                _write_header(f, 0, self.dtype)
+        self.counts = N.zeros(len(self.paths), dtype=N.int64)
+        self.pending = [[] for p in self.paths]
+        self.npending = N.zeros(len(self.paths), dtype=N.int64)
+
+    def write(self, r, shard):
+        """Add the (n,3) positions r to the shards given by the array shard."""
+        r = N.asarray(r, dtype=self.dtype)
+        order = N.argsort(shard, kind='mergesort')
+        n = N.bincount(shard, minlength=len(self.paths))
+        start = N.concatenate(([0], N.cumsum(n)))
+        for k in N.nonzero(n)[0]:
+            self.pending[k].append(r[order[start[k]:start[k+1]]])
+            self.npending[k] += n[k]
+            if self.npending[k] >= self.buffer:
+                self._flush(k)
+
+    def _flush(self, k):
+        for a in self.pending[k]:
+            a.tofile(self.files[k])
+        self.counts[k] += self.npending[k]
+        self.pending[k] = []
+        self.npending[k] = 0
+
+    def close(self):
+        """Write out all buffered points and close the files.  Returns the
+        number of points in each shard."""
+        for k, f in enumerate(self.files):
+            self._flush(k)
+            if self.header:
+                _write_header(f, self.counts[k], self.dtype)
+            f.close()
+        return self.counts
+
+
+def _remap_range(args):
+    """Remap the points start <= i < stop of the .npy file at inpath into a
+    set of shard files.  Runs in a worker process."""
+    u, inpath, paths, start, stop, nslabs, axis, boxsize, chunk, buffer = args
+    C = Cuboid(u[0], u[1], u[2])
+    L = (C.L1, C.L2, C.L3)
+    pos = N.load(inpath, mmap_mode='r')
+    W = ShardWriter(paths, buffer)
+    for i in range(start, stop, chunk):
+        r = C.transform_array(N.asarray(pos[i:min(i+chunk, stop)], dtype=float)/boxsize)
+        W.write(boxsize*r, slab_index(r, L, nslabs, axis))
+    return W.close()
+
+def part_paths(path, processes):
+    """Return the names of the part files of the shard at path written by
+    each of the given number of worker processes."""
+    root, ext = os.path.splitext(path)
+    return ["%s.part%d%s" % (root, w, ext) for w in range(processes)]
+
+def index_path(path):
+    """Return the name of the index listing the part files of the shard at
+    path."""
+    return path + ".parts"
+
+def shard_file(C, inpath, outpaths, axis=0, boxsize=1.0, chunk=chunk_size, buffer=buffer_size, processes=None):
+    """Remap the positions in the .npy file at inpath (an (n,3) array in
+    [0,boxsize)^3) to the cuboid and write them to one .npy file per slab,
+    for len(outpaths) slabs along the given cuboid axis (0, 1 or 2).
+    Points keep their input order within each shard.  If processes is
+    given, contiguous ranges of the input are remapped by that many worker
+    processes, each into its own part file of every shard (see
+    part_paths), and instead of the .npy file each shard gets an index
+    (see index_path) listing its parts in order with their numbers of
+    points; load_shard reads either form.  Every point is remapped and
+    written exactly once.  Returns the number of points in each shard."""
+    nslabs = len(outpaths)
+    n = len(N.load(inpath, mmap_mode='r'))
+    if processes is None or processes < 2:
+        for path in outpaths:
+            if os.path.exists(index_path(path)):
+                os.remove(index_path(path))
+        return _remap_range((C.u, inpath, outpaths, 0, n, nslabs, axis, boxsize, chunk, buffer))
+
+    bounds = [n*w//processes for w in range(processes + 1)]
+    parts = [part_paths(path, processes) for path in outpaths]
+    jobs = [(C.u, inpath, [p[w] for p in parts], bounds[w], bounds[w+1], nslabs, axis, boxsize, chunk, buffer) for w in range(processes)]
+    pool = multiprocessing.Pool(processes)
+    counts = pool.map(_remap_range, jobs)
+    pool.close()
+    pool.join()
+
+    # Describe each shard by its parts, and remove any complete shard file
+    # from an earlier run, which would otherwise be read instead
+    for k, path in enumerate(outpaths):
+        f = open(index_path(path), "w")
+        for w in range(processes):
+            f.write("%s %d\n" % (os.path.basename(parts[k][w]), counts[w][k]))
+        f.close()
+        if os.path.exists(path):
+            os.remove(path)
+    return N.sum(counts, axis=0)
+
+def load_shard(path, mmap_mode=None):
+    """Load the points of the shard at path written by shard_file, either
+    from its .npy file or, for a shard written by several processes, from
+    the part files listed in its index, in order."""
+    if not os.path.exists(index_path(path)):
+        return N.load(path, mmap_mode=mmap_mode)
+    parts = []
+    for line in open(index_path(path)):
+        if len(line.split()) == 2:
+            name, n = line.split()
+            parts.append(N.load(os.path.join(os.path.dirname(path), name), mmap_mode=mmap_mode))
+    if len(parts) == 0:
+        return N.zeros((0, 3))
+    return N.concatenate(parts)
+
+
+if __name__ == '__main__':
+    params = {}
+    for arg in sys.argv[1:]:
+        pair = arg.split('=', 1)
+        if len(pair) == 2:
+            name, val = pair
+            if   name == "u": params['u'] = [int(f) for f in val.strip("[()]").replace(',', ' ').split()]
+            elif name == "in": params['in'] = str(val)
+            elif name == "out": params['out'] = str(val)
+            elif name == "slabs": params['slabs'] = int(val)
+            elif name == "axis": params['axis'] = int(val)
+            elif name == "boxsize": params['boxsize'] = float(val)
+            elif name == "chunk": params['chunk'] = int(val)
+            elif name == "buffer": params['buffer'] = int(val)
+            elif name == "processes": params['processes'] = int(val)
+            else: abort("Unrecognized parameter '%s'" % name)
+        else:
+            if arg == "-h" or arg == "--help":
+                print "Usage: python shard.py in=pos.npy out=shard%d.npy u=\"u11 ... u33\" slabs=K [axis=1|2|3] [boxsize=B] [chunk=N] [buffer=N] [processes=P]"
+                sys.exit(0)
+            else:
+                abort("Unrecognized option '%s'" % arg)
+
+    if 'in' not in params or 'out' not in params:
+        abort("!! Input ('in') and output ('out') files must be given")
+    if '%d' not in params['out']:
+        abort("!! Output file name '%s' should contain %%d for the slab number" % params['out'])
+    if params.get('slabs', 0) < 1:
+        abort("!! The number of slabs 'slabs' must be given")
+    u = params.get('u', [1,0,0, 0,1,0, 0,0,1])
+    if len(u) != 9: abort("!! Input matrix 'u' should have 9 components, not %d" % len(u))
+    axis = params.get('axis', 1)
+    if axis not in (1, 2, 3): abort("!! Slab axis should be 1, 2 or 3, not %d" % axis)
+    C = Cuboid(u[0:3], u[3:6], u[6:9])
+
+    outpaths = [params['out'] % k for k in range(params['slabs'])]
+    counts = shard_file(C, params['in'], outpaths, axis - 1, params.get('boxsize', 1.0),
+                        params.get('chunk', chunk_size), params.get('buffer', buffer_size), params.get('processes'))
+    for path, n in zip(outpaths, counts):
+        print "%s %d" % (index_path(path) if os.path.exists(index_path(path)) else path, n)
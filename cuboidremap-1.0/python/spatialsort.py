@@ -0,0 +1,271 @@
+#!/usr/bin/python
+#
+# spatialsort.py
+#
+# Sort remapped points along a space-filling curve (Morton or Hilbert) in
+# cuboid coordinates, so that points close together in the cuboid end up
+# close together in the output.  The cuboid is covered by a grid of nearly
+# cubic cells: the longest edge gets the given number of bits, and the
+# shorter edges correspondingly fewer, so a thin cuboid is not sliced into
+# long needles.  Inputs larger than memory are sorted in runs that are
+# spilled to temporary files and merged.  An index of the offsets at which
+# each key prefix starts lets consumers read the points in any coarse cell
+# of the grid directly.
+
+import os
+import tempfile
+import shutil
+from math import *
+import numpy as N
+
+# Default number of bits along the longest cuboid edge
+curve_bits = 21
+
+# Default number of points sorted in memory at once
+run_size = 1 << 22
+
+
+def axis_bits(L, bits=curve_bits):
+    """Return the number of grid bits along each cuboid axis, for a grid
+    with 2^bits cells along the longest edge and cells as close to cubic as
+    possible.  The total is at most 63, so keys fit in 64 bits."""
+    Lmax = max(L)
+    b = [max(0, bits - int(floor(log(Lmax/Lk, 2) + 0.5))) for Lk in L]
+    if sum(b) > 63:
+        raise ValueError("too many key bits (%d) for cuboid %s; use fewer bits" % (sum(b), tuple(L)))
+    return b
+
+def _grid(r, L, b):
+    """Integer grid coordinates of the (n,3) cuboid positions r."""
+    r = N.asarray(r, dtype=float)
+    return [N.clip(N.floor(r[:,k]*(2.0**b[k]/L[k])), 0, 2.0**b[k] - 1).astype(N.uint64) for k in range(3)]
+
+def _interleave(X, b, levels):
+    """Interleave the bits of the coordinates X, from bit levels-1 down to
+    bit 0, taking a bit from each axis k whose b[k] is above that level."""
+    key = N.zeros(len(X[0]), dtype=N.uint64)
+    one = N.uint64(1)
+    for j in range(levels - 1, -1, -1):
+        for k in range(3):
+            if b[k] > j:
+                key <<= one
+                key |= (X[k] >> N.uint64(j)) & one
+    return key
+
+def morton_keys(r, L, bits=curve_bits):
+    """Morton (Z-order) keys of the (n,3) cuboid positions r in the cuboid
+    with edges L = (L1,L2,L3).  Higher key bits split the longer axes
+    first."""
+    b = axis_bits(L, bits)
+    return _interleave(_grid(r, L, b), b, max(b))
+
+def _hilbert(X, m):
+    """Hilbert curve index of the three m-bit coordinates X, by Skilling's
+    method (transform the coordinates in place, then interleave)."""
+    X = [x.copy() for x in X]
+    Q = 1 << (m - 1)
+    while Q > 1:
+        P, q = N.uint64(Q - 1), N.uint64(Q)
+        for i in range(3):
+            high = (X[i] & q) != 0
+            if i == 0:
+                X[0] = N.where(high, X[0] ^ P, X[0])
+            else:
+                t = N.where(high, 0, (X[0] ^ X[i]) & P).astype(N.uint64)
+                X[0] = N.where(high, X[0] ^ P, X[0] ^ t)
+                X[i] ^= t
+        Q >>= 1
+    X[1] ^= X[0]
+    X[2] ^= X[1]
+    t = N.zeros_like(X[0])
+    Q = 1 << (m - 1)
+    while Q > 1:
+        t = N.where((X[2] & N.uint64(Q)) != 0, t ^ N.uint64(Q - 1), t).astype(N.uint64)
+        Q >>= 1
+    for i in range(3):
+        X[i] ^= t
+    return _interleave(X, [m, m, m], m)
+
+def hilbert_keys(r, L, bits=curve_bits):
+    """Hilbert keys of the (n,3) cuboid positions r in the cuboid with edges
+    L = (L1,L2,L3).  The grid is divided into cubes of 2^m cells on a side
+    (m being the fewest bits of any axis); the cubes are ordered as for
+    morton_keys, and the cells within each cube along a Hilbert curve."""
+    b = axis_bits(L, bits)
+    m = min(b)
+    X = _grid(r, L, b)
+    if m == 0:
+        return _interleave(X, b, max(b))
+    low = N.uint64((1 << m) - 1)
+    coarse = _interleave([X[k] >> N.uint64(m) for k in range(3)], [bk - m for bk in b], max(b) - m)
+    return (coarse << N.uint64(3*m)) | _hilbert([x & low for x in X], m)
+
+curves = {'morton': morton_keys, 'hilbert': hilbert_keys}
+
+def spatial_keys(r, L, curve='hilbert', bits=curve_bits):
+    """Keys along the given curve ('morton' or 'hilbert')."""
+    if curve not in curves:
+        raise ValueError("unknown curve '%s'" % curve)
+    return curves[curve](r, L, bits)
+
+
+def _merge(runs, block):
+    """Merge sorted runs, each a tuple (keys, r, index) of memory-mapped
+    arrays, yielding sorted (keys, r, index) blocks.  Each step loads the
+    next block of every run and emits everything up to the smallest of
+    their last keys, which no later point can precede."""
+    pos = [0]*len(runs)
+    pending = [(N.zeros(0, dtype=N.uint64), N.zeros((0, 3)), N.zeros(0, dtype=N.int64))]
+    while True:
+        loaded = []
+        bound = None
+        for i, (k, r, idx) in enumerate(runs):
+            if pos[i] < len(k):
+                j = min(pos[i] + block, len(k))
+                loaded.append((k[pos[i]:j], r[pos[i]:j], idx[pos[i]:j]))
+                if j < len(k):
+                    bound = k[j-1] if bound is None else min(bound, k[j-1])
+                pos[i] = j
+        if len(loaded) == 0 and len(pending[0][0]) == 0:
+            return
+        k = N.concatenate([p[0] for p in pending] + [l[0] for l in loaded])
+        r = N.concatenate([p[1] for p in pending] + [l[1] for l in loaded])
+        idx = N.concatenate([p[2] for p in pending] + [l[2] for l in loaded])
+        order = N.lexsort((idx, k))
+        k, r, idx = k[order], r[order], idx[order]
+        n = len(k) if bound is None else N.searchsorted(k, bound, side='right')
+        if n > 0:
+            yield k[:n], r[:n], idx[:n]
+        pending = [(k[n:], r[n:], idx[n:])]
+
+def sort_chunks(chunks, L, curve='hilbert', bits=curve_bits, run=run_size, tmpdir=None):
+    """Sort points arriving in chunks of (n,3) cuboid positions along a
+    space-filling curve, yielding sorted blocks (keys, r, index), where
+    index is the position of each point in the input.  Points with equal
+    keys keep their input order.  Up to 'run' points are sorted in memory;
+    beyond that, sorted runs are written to temporary files (in tmpdir) and
+    merged, so memory use stays bounded."""
+    buf = []
+    nbuf = 0
+    start = 0
+    runs = []
+    workdir = None
+    try:
+        for c in chunks:
+            c = N.asarray(c, dtype=float).reshape(-1, 3)
+            buf.append(c)
+            nbuf += len(c)
+            while nbuf >= run:
+                r = N.concatenate(buf)
+                if workdir is None:
+                    workdir = tempfile.mkdtemp(prefix="spatialsort", dir=tmpdir)
+                runs.append(_write_run(workdir, len(runs), r[:run], L, curve, bits, start))
+                start += run
+                buf = [r[run:]]
+                nbuf = len(buf[0])
+        r = N.concatenate(buf) if len(buf) > 0 else N.zeros((0, 3))
+        if len(runs) == 0:
+            k = spatial_keys(r, L, curve, bits)
+            order = N.argsort(k, kind='mergesort')
+            if len(order) > 0:
+                yield k[order], r[order], order.astype(N.int64)
+            return
+        if len(r) > 0:
+            runs.append(_write_run(workdir, len(runs), r, L, curve, bits, start))
+        for block in _merge(runs, max(1, run//len(runs))):
+            yield block
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def _write_run(workdir, i, r, L, curve, bits, start):
+    """Sort one run and save it, returning memory maps of its arrays."""
+    k = spatial_keys(r, L, curve, bits)
+    order = N.argsort(k, kind='mergesort')
+    arrays = (k[order], r[order], start + order.astype(N.int64))
+    paths = [os.path.join(workdir, "run%d_%s.npy" % (i, name)) for name in ("keys", "r", "index")]
+    for path, a in zip(paths, arrays):
+        N.save(path, a)
+    return tuple([N.load(path, mmap_mode='r') for path in paths])
+
+
+class KeyIndex:
+    """Offsets of key prefixes in a sorted output: the points whose keys
+    start with the prefix p (the top prefix_bits of the key bits) are
+    points offsets[p] <= i < offsets[p+1]."""
+
+    def __init__(self, L, curve='hilbert', bits=curve_bits, prefix_bits=12):
+        self.L = tuple(L)
+        self.curve = curve
+        self.bits = bits
+        self.keybits = sum(axis_bits(L, bits))
+        self.prefix_bits = min(prefix_bits, self.keybits)
+        self.counts = N.zeros(1 << self.prefix_bits, dtype=N.int64)
+
+    def add(self, keys):
+        """Count a block of sorted keys."""
+        p = (keys >> N.uint64(self.keybits - self.prefix_bits)).astype(N.int64)
+        self.counts += N.bincount(p, minlength=len(self.counts))
+
+    def offsets(self):
+        return N.concatenate(([0], N.cumsum(self.counts)))
+
+    def prefix(self, r):
+        """Key prefixes of the (n,3) cuboid positions r."""
+        k = spatial_keys(r, self.L, self.curve, self.bits)
+        return (k >> N.uint64(self.keybits - self.prefix_bits)).astype(N.int64)
+
+    def range(self, p):
+        """Return the points (start, stop) whose keys have the prefix p."""
+        o = self.offsets()
+        return o[p], o[p+1]
+
+    def _prefix_grid(self):
+        """Number of bits along each axis of a grid fine enough that each of
+        its cells lies within the region of a single key prefix."""
+        b = axis_bits(self.L, self.bits)
+        m = min(b) if self.curve == 'hilbert' else 0
+        order = []
+        for j in range(max(b) - m - 1, -1, -1):
+            order += [k for k in range(3) if b[k] - m > j]
+        order += [0, 1, 2]*m
+        t = self.prefix_bits
+        if t > len(order) - 3*m:
+            t = len(order) - 3*m + 3*int(ceil((t - len(order) + 3*m)/3.0))
+        return [order[:t].count(k) for k in range(3)]
+
+    def box_ranges(self, rmin, rmax):
+        """Return the ranges (start, stop) of the sorted points that may lie
+        in the box rmin <= r < rmax of the cuboid, as a list of disjoint
+        ranges in increasing order.  These cover every point in the box,
+        and some points of the coarse cells around its edges."""
+        g = self._prefix_grid()
+        axes = []
+        for k in range(3):
+            n = 2**g[k]
+            lo = max(0, int(floor(rmin[k]/self.L[k]*n)))
+            hi = min(n, int(ceil(rmax[k]/self.L[k]*n)))
+            axes.append((N.arange(lo, hi) + 0.5)*self.L[k]/n)
+        if min([len(a) for a in axes]) == 0:
+            return []
+        centres = N.array([a.ravel() for a in N.meshgrid(*axes, indexing='ij')]).T
+        o = self.offsets()
+        ranges = []
+        for p in N.unique(self.prefix(centres)):
+            if o[p] == o[p+1]:
+                continue
+            if len(ranges) > 0 and ranges[-1][1] == o[p]:
+                ranges[-1] = (ranges[-1][0], o[p+1])
+            else:
+                ranges.append((o[p], o[p+1]))
+        return ranges
+
+    def save(self, path):
+        N.savez(path, L=self.L, curve=self.curve, bits=self.bits, prefix_bits=self.prefix_bits, offsets=self.offsets())
+
+    @classmethod
+    def load(cls, path):
+        f = N.load(path)
+        I = cls(tuple(f['L']), str(f['curve']), int(f['bits']), int(f['prefix_bits']))
+        I.counts = N.diff(f['offsets'])
+        return I